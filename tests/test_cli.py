@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 """Tests for cli.py."""
 import os
+import sys
+import subprocess
 from unittest import mock
 
 from click.testing import CliRunner
@@ -66,7 +68,7 @@ def test_file_checker_no_path(mock_exit, mock_echo):
     assert mock_exit.call_count == 0
 
 
-@mock.patch("ubittool.cli.read_python_code", autospec=True)
+@mock.patch("ubittool.cmds.read_python_code", autospec=True)
 def test_read_code(mock_read_python_code, check_no_board_connected):
     """Test the read-code command without a file option."""
     python_code = "Python code here"
@@ -93,7 +95,91 @@ def test_read_code_no_board(check_no_board_connected):
     assert "Did not find any connected boards." in result.output
 
 
-@mock.patch("ubittool.cli.read_python_code", autospec=True)
+@mock.patch("ubittool.cmds.read_micropython_files", autospec=True)
+def test_read_files(mock_read_files, check_no_board_connected):
+    """Test the read-files command printing the files to the console."""
+    mock_read_files.return_value = [
+        cmds.filesystem.MicroPythonFile("main.py", b"import data\n"),
+        cmds.filesystem.MicroPythonFile("data.py", b"value = 1\n"),
+    ]
+    runner = CliRunner()
+
+    result = runner.invoke(cli.read_files)
+
+    assert "MicroPython files will be output to console." in result.output
+    assert "Found 2 files." in result.output
+    assert "----- main.py -----" in result.output
+    assert "import data" in result.output
+    assert "value = 1" in result.output
+    assert result.exit_code == 0
+
+
+@mock.patch("ubittool.cmds.read_micropython_files", autospec=True)
+def test_read_files_dir(mock_read_files, tmpdir, check_no_board_connected):
+    """Test the read-files command saving the files into a directory."""
+    mock_read_files.return_value = [
+        cmds.filesystem.MicroPythonFile("main.py", b"import data\n"),
+        cmds.filesystem.MicroPythonFile("../data.bin", b"\x00\xff"),
+    ]
+    dir_path = tmpdir.join("files")
+    runner = CliRunner()
+
+    result = runner.invoke(cli.read_files, ["-d", str(dir_path)])
+    result_exists = runner.invoke(cli.read_files, ["-d", str(dir_path)])
+
+    assert result.exit_code == 0
+    assert dir_path.join("main.py").read_binary() == b"import data\n"
+    assert dir_path.join("data.bin").read_binary() == b"\x00\xff"
+    assert result_exists.exit_code != 0
+    assert "already exists" in result_exists.output
+
+
+def test_read_files_no_board(check_no_board_connected):
+    """Test the read-files command when no board is connected."""
+    runner = CliRunner()
+
+    result = runner.invoke(cli.read_files)
+
+    assert result.exit_code != 0
+    assert "Did not find any connected boards." in result.output
+
+
+@mock.patch("ubittool.cmds.flash_python_code", autospec=True)
+def test_write_code(mock_flash_python_code, tmpdir, check_no_board_connected):
+    """Test the write-code command programs the script from the file."""
+    python_code = "from microbit import *\ndisplay.scroll('hi')\n"
+    file_path = tmpdir.join("main.py")
+    file_path.write_text(python_code, encoding="utf-8")
+    mock_flash_python_code.return_value = 1
+    runner = CliRunner()
+
+    result = runner.invoke(cli.write_code, ["-f", str(file_path)])
+
+    mock_flash_python_code.assert_called_once_with(python_code)
+    assert "Programmed 1 flash pages." in result.output
+    assert "Finished successfully" in result.output
+    assert result.exit_code == 0
+
+
+@mock.patch("ubittool.cmds.flash_python_code", autospec=True)
+def test_write_code_errors(mock_flash_python_code, tmpdir):
+    """Test the write-code command with a missing file or a failed write."""
+    file_path = tmpdir.join("main.py")
+    runner = CliRunner()
+
+    result_no_file = runner.invoke(cli.write_code, ["-f", str(file_path)])
+    file_path.write_text("print(1)", encoding="utf-8")
+    mock_flash_python_code.side_effect = Exception("Different runtime")
+    result_error = runner.invoke(cli.write_code, ["-f", str(file_path)])
+
+    assert result_no_file.exit_code != 0
+    assert "Abort: File does not exists" in result_no_file.output
+    assert result_error.exit_code != 0
+    assert "Error: Different runtime" in result_error.output
+    assert mock_flash_python_code.call_count == 1
+
+
+@mock.patch("ubittool.cmds.read_python_code", autospec=True)
 def test_read_code_path(mock_read_python_code, check_no_board_connected):
     """Test the read-code command with a file option."""
     mock_read_python_code.return_value = "Python code here"
@@ -133,11 +219,13 @@ def test_read_code_path_no_board(check_no_board_connected):
     assert not os.path.isfile(file_name), "File does not exist"
 
 
-@mock.patch("ubittool.cli.read_flash_hex", autospec=True)
-def test_read_flash(mock_read_flash_hex, check_no_board_connected):
+@mock.patch("ubittool.cmds.write_flash_hex", autospec=True)
+def test_read_flash(mock_write_flash_hex, check_no_board_connected):
     """Test the read-flash command without a file option."""
     flash_hex_content = "Intel Hex lines here"
-    mock_read_flash_hex.return_value = flash_hex_content
+    mock_write_flash_hex.side_effect = lambda out, **kwargs: out.write(
+        flash_hex_content
+    )
     runner = CliRunner()
 
     result = runner.invoke(cli.read_flash)
@@ -149,6 +237,76 @@ def test_read_flash(mock_read_flash_hex, check_no_board_connected):
     assert result.exit_code == 0
 
 
+@mock.patch("ubittool.cmds.write_flash_hex", autospec=True)
+def test_read_flash_pretty(mock_write_flash_hex, check_no_board_connected):
+    """Test the read-flash command with the output format options."""
+    runner = CliRunner()
+
+    results = [
+        runner.invoke(cli.read_flash, ["--pretty"]),
+        runner.invoke(cli.read_flash, ["-p", "--collapse-erased"]),
+        runner.invoke(cli.read_flash, ["--trim-erased"]),
+    ]
+
+    assert [c[1] for c in mock_write_flash_hex.call_args_list] == [
+        {"decode_hex": True, "collapse_erased": False, "trim_erased": False},
+        {"decode_hex": True, "collapse_erased": True, "trim_erased": False},
+        {"decode_hex": False, "collapse_erased": False, "trim_erased": True},
+    ]
+    for result in results:
+        assert "Finished successfully" in result.output
+        assert result.exit_code == 0
+
+
+@mock.patch("ubittool.cmds.write_memory_image", autospec=True)
+def test_read_flash_image_format(
+    mock_write_memory_image, check_no_board_connected
+):
+    """Test the read-flash command with the binary image formats."""
+    file_name = "thisfile.bin"
+    runner = CliRunner()
+
+    results = [
+        runner.invoke(cli.read_flash, ["-f", file_name, "--format", "bin"]),
+        runner.invoke(
+            cli.read_flash,
+            ["-f", file_name, "--format", "elf", "--trim-erased"],
+        ),
+    ]
+
+    assert mock_write_memory_image.call_args_list == [
+        mock.call(file_name, "bin", trim_erased=False),
+        mock.call(file_name, "elf", trim_erased=True),
+    ]
+    for result in results:
+        assert "Saving the flash contents..." in result.output
+        assert "Finished successfully" in result.output
+        assert result.exit_code == 0
+
+
+@mock.patch("ubittool.cmds.write_memory_image", autospec=True)
+def test_read_flash_image_format_bad_options(
+    mock_write_memory_image, check_no_board_connected
+):
+    """Test the read-flash binary formats can only be written to a file."""
+    runner = CliRunner()
+
+    result_console = runner.invoke(cli.read_flash, ["--format", "uf2"])
+    result_pretty = runner.invoke(
+        cli.read_flash, ["-f", "thisfile.uf2", "--format", "uf2", "--pretty"]
+    )
+
+    assert mock_write_memory_image.call_count == 0
+    assert result_console.exit_code != 0
+    assert "The uf2 format can only be written to a file" in (
+        result_console.output
+    )
+    assert result_pretty.exit_code != 0
+    assert "The --pretty option can only be used with the hex format" in (
+        result_pretty.output
+    )
+
+
 def test_read_flash_no_board(check_no_board_connected):
     """Test the read-flash command when no board is connected."""
     runner = CliRunner()
@@ -160,23 +318,29 @@ def test_read_flash_no_board(check_no_board_connected):
     assert "Did not find any connected boards." in result.output
 
 
-@mock.patch("ubittool.cli.read_flash_hex", autospec=True)
-def test_read_flash_path(mock_read_flash_hex, check_no_board_connected):
+@mock.patch("ubittool.cmds.write_flash_hex", autospec=True)
+def test_read_flash_path(mock_write_flash_hex, check_no_board_connected):
     """Test the read-code command with a file option."""
-    flash_hex_content = "Intel Hex lines here"
-    mock_read_flash_hex.return_value = flash_hex_content
     file_name = "thisfile.py"
     runner = CliRunner()
 
-    with mock.patch("ubittool.cli.open", mock.mock_open()) as m_open:
-        results = [runner.invoke(cli.read_flash, ["--file_path", file_name])]
-    with mock.patch("ubittool.cli.open", mock.mock_open()) as m_open2:
-        results.append(runner.invoke(cli.read_flash, ["-f", file_name]))
-
-    m_open.assert_called_once_with(file_name, "w")
-    m_open2.assert_called_once_with(file_name, "w")
-    m_open().write.assert_called_once_with(flash_hex_content)
-    m_open2().write.assert_called_once_with(flash_hex_content)
+    results = [
+        runner.invoke(cli.read_flash, ["--file_path", file_name]),
+        runner.invoke(cli.read_flash, ["-f", file_name]),
+    ]
+
+    assert (
+        mock_write_flash_hex.call_args_list
+        == [
+            mock.call(
+                file_name,
+                decode_hex=False,
+                collapse_erased=False,
+                trim_erased=False,
+            )
+        ]
+        * 2
+    )
     for result in results:
         assert (
             "micro:bit flash hex will be written to: {}".format(file_name)
@@ -210,11 +374,13 @@ def test_read_flash_path_no_board(check_no_board_connected):
     assert not os.path.isfile(file_name), "File does not exist"
 
 
-@mock.patch("ubittool.cli.read_flash_uicr_hex", autospec=True)
-def test_read_flash_uicr(mock_read_flash_uicr_hex, check_no_board_connected):
+@mock.patch("ubittool.cmds.write_flash_uicr_hex", autospec=True)
+def test_read_flash_uicr(mock_write_flash_uicr_hex, check_no_board_connected):
     """Test the read-flash-uicr command without a file option."""
     flash_hex_content = "Intel Hex lines here"
-    mock_read_flash_uicr_hex.return_value = flash_hex_content
+    mock_write_flash_uicr_hex.side_effect = lambda out, **kwargs: out.write(
+        flash_hex_content
+    )
     runner = CliRunner()
 
     result = runner.invoke(cli.read_flash_uicr)
@@ -243,27 +409,47 @@ def test_read_flash_uicr_no_board(check_no_board_connected):
     assert "Did not find any connected boards." in result.output
 
 
-@mock.patch("ubittool.cli.read_flash_uicr_hex", autospec=True)
+@mock.patch("ubittool.cmds.write_memory_image", autospec=True)
+def test_read_flash_uicr_image_format(
+    mock_write_memory_image, check_no_board_connected
+):
+    """Test the read-flash-uicr command with the binary image formats."""
+    file_name = "thisfile.elf"
+    runner = CliRunner()
+
+    result = runner.invoke(
+        cli.read_flash_uicr, ["-f", file_name, "--format", "elf", "--ram"]
+    )
+    result_hex_ram = runner.invoke(cli.read_flash_uicr, ["--ram"])
+
+    assert mock_write_memory_image.call_args_list == [
+        mock.call(file_name, "elf", uicr=True, ram=True, trim_erased=False)
+    ]
+    assert "Finished successfully" in result.output
+    assert result.exit_code == 0
+    assert result_hex_ram.exit_code != 0
+    assert "The --ram option can only be used with the binary formats" in (
+        result_hex_ram.output
+    )
+
+
+@mock.patch("ubittool.cmds.write_flash_uicr_hex", autospec=True)
 def test_read_flash_uicr_path(
-    mock_read_flash_uicr_hex, check_no_board_connected
+    mock_write_flash_uicr_hex, check_no_board_connected
 ):
     """Test the read-code-uicr command with a file option."""
-    flash_hex_content = "Intel Hex lines here"
-    mock_read_flash_uicr_hex.return_value = flash_hex_content
     file_name = "thisfile.py"
     runner = CliRunner()
 
-    with mock.patch("ubittool.cli.open", mock.mock_open()) as m_open:
-        results = [
-            runner.invoke(cli.read_flash_uicr, ["--file_path", file_name])
-        ]
-    with mock.patch("ubittool.cli.open", mock.mock_open()) as m_open2:
-        results.append(runner.invoke(cli.read_flash_uicr, ["-f", file_name]))
+    results = [
+        runner.invoke(cli.read_flash_uicr, ["--file_path", file_name]),
+        runner.invoke(cli.read_flash_uicr, ["-f", file_name, "--trim-erased"]),
+    ]
 
-    m_open.assert_called_once_with(file_name, "w")
-    m_open2.assert_called_once_with(file_name, "w")
-    m_open().write.assert_called_once_with(flash_hex_content)
-    m_open2().write.assert_called_once_with(flash_hex_content)
+    assert mock_write_flash_uicr_hex.call_args_list == [
+        mock.call(file_name, trim_erased=False),
+        mock.call(file_name, trim_erased=True),
+    ]
     for result in results:
         assert (
             "micro:bit flash and UICR hex will be written to: {}".format(
@@ -277,7 +463,7 @@ def test_read_flash_uicr_path(
 
 
 @mock.patch("ubittool.cli.os.path.isfile", autospec=True)
-@mock.patch("ubittool.cli.compare_full_flash_hex", autospec=True)
+@mock.patch("ubittool.cmds.compare_full_flash_hex", autospec=True)
 def test_compare_flash(mock_compare, mock_isfile, check_no_board_connected):
     """Test the compare-flash command."""
     file_name = "random_file_name.hex"
@@ -298,7 +484,7 @@ def test_compare_flash(mock_compare, mock_isfile, check_no_board_connected):
 
 
 @mock.patch("ubittool.cli.os.path.isfile", autospec=True)
-@mock.patch("ubittool.cli.compare_full_flash_hex", autospec=True)
+@mock.patch("ubittool.cmds.compare_full_flash_hex", autospec=True)
 def test_compare_flash_diffs(
     mock_compare, mock_isfile, check_no_board_connected
 ):
@@ -323,11 +509,66 @@ def test_compare_flash_diffs(
         assert result.exit_code != 0, "Exit code non-zero"
 
 
+@mock.patch("ubittool.cli.os.path.isfile", autospec=True)
+@mock.patch("ubittool.cmds.compare_full_flash_hex", autospec=True)
+def test_compare_flash_crc(
+    mock_compare, mock_isfile, check_no_board_connected
+):
+    """Test the compare command only reading the pages with different CRC."""
+    file_name = "random_file_name.hex"
+    mock_isfile.return_value = True
+    mock_compare.return_value = 0
+    runner = CliRunner()
+
+    result = runner.invoke(cli.compare, ["-f", file_name, "--crc"])
+
+    mock_compare.assert_called_once_with(file_name, crc=True)
+    assert "Diff output loaded in the default browser." in result.output
+    assert result.exit_code == 0
+
+
+@mock.patch("ubittool.cli.os.path.isfile", autospec=True)
+@mock.patch("ubittool.cmds.compare_full_flash_hex", autospec=True)
+@mock.patch("ubittool.cmds.check_flash_hex", autospec=True)
+def test_compare_flash_max_diffs(
+    mock_check, mock_compare, mock_isfile, check_no_board_connected
+):
+    """Test the compare command go/no-go check without a report."""
+    file_name = "random_file_name.hex"
+    mock_isfile.return_value = True
+    mock_check.side_effect = [0, 1]
+    runner = CliRunner()
+
+    result_pass = runner.invoke(
+        cli.compare, ["-f", file_name, "--max-diffs", "1"]
+    )
+    result_fail = runner.invoke(
+        cli.compare, ["-f", file_name, "--max-diffs", "5", "--crc"]
+    )
+    result_bad = runner.invoke(
+        cli.compare, ["-f", file_name, "--max-diffs", "0"]
+    )
+
+    assert mock_compare.call_count == 0
+    assert mock_check.call_args_list == [
+        mock.call(file_name, max_diffs=1, crc=False),
+        mock.call(file_name, max_diffs=5, crc=True),
+    ]
+    assert result_pass.exit_code == 0
+    assert (
+        "No diffs between micro:bit flash and hex file" in result_pass.output
+    )
+    assert "browser" not in result_pass.output
+    assert result_fail.exit_code == 1
+    assert "There are some differences" in result_fail.output
+    assert result_bad.exit_code != 0
+
+
 @mock.patch("ubittool.cli.os.path.isfile", autospec=True)
 def test_compare_flash_no_board(mock_isfile, check_no_board_connected):
     """Test the compare-flash command when no board is connected."""
     file_name = "random_file_name.hex"
-    file_content = "Intel Hex lines here"
+    file_content = ":0400000001020304F2\n:00000001FF\n"
     mock_isfile.return_value = True
     runner = CliRunner()
 
@@ -371,8 +612,8 @@ def test_compare_flash_no_file():
 
 
 @mock.patch("ubittool.cli.os.path.isfile", autospec=True)
-@mock.patch("ubittool.cli.flash_drag_n_drop", autospec=True)
-@mock.patch("ubittool.cli.compare_full_flash_hex", autospec=True)
+@mock.patch("ubittool.cmds.flash_drag_n_drop", autospec=True)
+@mock.patch("ubittool.cmds.compare_full_flash_hex", autospec=True)
 def test_flash_compare(
     mock_compare, mock_flash, mock_isfile, check_no_board_connected
 ):
@@ -444,7 +685,7 @@ def test_flash_compare_exception(mock_isfile, check_no_board_connected):
     assert "Error: Could not find a MICROBIT" in result.output
 
 
-@mock.patch("ubittool.cli.open_gui", autospec=True)
+@mock.patch("ubittool.gui.open_gui", autospec=True)
 def test_gui(mock_open_gui, check_no_board_connected):
     """Test the gui command."""
     runner = CliRunner()
@@ -476,10 +717,205 @@ def test_batch_flash_exit_keyboardexception(
 
     # Inject KeyboardException to stop the command
     with mock.patch(
-        "ubittool.cli.batch_flash_hex", autospec=True
+        "ubittool.cmds.batch_flash_hex", autospec=True
     ) as mock_batch_flash_hex:
         mock_batch_flash_hex.side_effect = KeyboardInterrupt
         result = runner.invoke(cli.batch_flash, ["--file-path", file_path])
 
     assert result.exit_code == 0, "Exit code zero"
     assert "Batch flash of hex file" in result.output
+
+
+@mock.patch("ubittool.cli.os.path.isfile", autospec=True)
+@mock.patch("ubittool.cmds.batch_flash_hex", autospec=True)
+def test_batch_flash_incremental(
+    mock_batch_flash_hex, mock_isfile, check_no_board_connected
+):
+    """Test the batch-flash command passes its options."""
+    runner = CliRunner()
+    file_path = "/path/to/hex/file.hex"
+    mock_isfile.return_value = True
+
+    result = runner.invoke(
+        cli.batch_flash,
+        [
+            "--file-path",
+            file_path,
+            "--incremental",
+            "--workers",
+            "3",
+            "--metrics-file",
+            "metrics.csv",
+            "--metrics-format",
+            "csv",
+            "--max-per-hub",
+            "2",
+            "--max-attempts",
+            "3",
+            "--stage-timeout",
+            "program=90",
+            "--stage-timeout",
+            "reset=5.5",
+            "--heartbeat-timeout",
+            "20",
+            "--skip-matching",
+            "--journal",
+            "journal.db",
+        ],
+    )
+
+    assert result.exit_code == 0
+    mock_batch_flash_hex.assert_called_once_with(
+        file_path,
+        incremental=True,
+        workers=3,
+        metrics_output="metrics.csv",
+        metrics_format="csv",
+        max_per_hub=2,
+        max_attempts=3,
+        stage_timeouts={"program": 90.0, "reset": 5.5},
+        heartbeat_timeout=20.0,
+        skip_matching=True,
+        journal_path="journal.db",
+    )
+
+
+@pytest.mark.parametrize(
+    "stage_timeout, message",
+    [
+        ("verify=10", "Unknown stage 'verify'"),
+        ("program", "Invalid number of seconds in 'program'"),
+        ("program=0", "The timeout in 'program=0' must be positive"),
+    ],
+)
+def test_batch_flash_invalid_stage_timeout(stage_timeout, message):
+    """Test the batch-flash command rejects invalid stage timeouts."""
+    runner = CliRunner()
+
+    result = runner.invoke(
+        cli.batch_flash,
+        ["--file-path", "file.hex", "--stage-timeout", stage_timeout],
+    )
+
+    assert result.exit_code == 2
+    assert message in result.output
+
+
+@mock.patch("ubittool.cli.daemon_call", autospec=True)
+def test_read_flash_daemon(mock_daemon_call, check_no_board_connected):
+    """Test the read-flash command prints the hex returned by the daemon."""
+    mock_daemon_call.return_value = ":00000001FF\n"
+    runner = CliRunner()
+
+    result = runner.invoke(
+        cli.read_flash, env={cli.SOCKET_ENV_VAR: "/tmp/ubit.sock"}
+    )
+
+    mock_daemon_call.assert_called_once_with(
+        "write_flash_hex",
+        socket_path="/tmp/ubit.sock",
+        output=None,
+        decode_hex=False,
+        collapse_erased=False,
+        trim_erased=False,
+    )
+    assert ":00000001FF" in result.output
+    assert "Finished successfully" in result.output
+    assert result.exit_code == 0
+
+
+@mock.patch("ubittool.cli.daemon_call", autospec=True)
+def test_read_files_daemon(mock_daemon_call, tmpdir, check_no_board_connected):
+    """Test the read-files command saves the files sent by the daemon."""
+    mock_daemon_call.return_value = [["main.py", "AP8="]]
+    dir_path = tmpdir.join("files")
+    runner = CliRunner()
+
+    result = runner.invoke(
+        cli.read_files,
+        ["-d", str(dir_path)],
+        env={cli.SOCKET_ENV_VAR: "/tmp/ubit.sock"},
+    )
+
+    mock_daemon_call.assert_called_once_with(
+        "read_micropython_files", socket_path="/tmp/ubit.sock"
+    )
+    assert "Found 1 files." in result.output
+    assert dir_path.join("main.py").read_binary() == b"\x00\xff"
+    assert result.exit_code == 0
+
+
+@mock.patch("ubittool.cli.os.path.isfile", autospec=True)
+@mock.patch("ubittool.cli.daemon_call", autospec=True)
+def test_compare_flash_max_diffs_daemon(
+    mock_daemon_call, mock_isfile, check_no_board_connected
+):
+    """Test the compare command sends an absolute path to the daemon."""
+    mock_isfile.return_value = True
+    mock_daemon_call.side_effect = Exception("Daemon error")
+    runner = CliRunner()
+
+    result = runner.invoke(
+        cli.compare,
+        ["-f", "file.hex", "--max-diffs", "2"],
+        env={cli.SOCKET_ENV_VAR: "/tmp/ubit.sock"},
+    )
+
+    mock_daemon_call.assert_called_once_with(
+        "check_flash_hex",
+        socket_path="/tmp/ubit.sock",
+        hex_file_path=os.path.abspath("file.hex"),
+        max_diffs=2,
+        crc=False,
+    )
+    assert "Error: Daemon error" in result.output
+    assert result.exit_code == 1
+
+
+@mock.patch("ubittool.cli.Daemon", autospec=True)
+def test_daemon(mock_daemon, check_no_board_connected):
+    """Test the daemon command serves until Ctrl+C and then closes."""
+    mock_daemon.return_value.serve_forever.side_effect = KeyboardInterrupt
+    runner = CliRunner()
+
+    result = runner.invoke(cli.daemon, ["--socket", "/tmp/ubit.sock"])
+
+    mock_daemon.assert_called_once_with("/tmp/ubit.sock")
+    mock_daemon.return_value.close.assert_called_once_with()
+    assert "Listening on /tmp/ubit.sock" in result.output
+    assert result.exit_code == 0
+
+
+def test_help_import_time():
+    """Test the --help output does not import the heavy modules."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "ubittool", "--help"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    # Lines with "import time: self [us] | cumulative | imported package"
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "[us]" not in line:
+            _, cumulative, package = line.split(":", 1)[1].split("|")
+            import_times[package.strip()] = int(cumulative)
+
+    assert result.returncode == 0
+    assert "Commands:" in result.stdout
+    for module in ("ubittool.cmds", "pyocd", "uflash", "intelhex", "tkinter"):
+        assert module not in import_times, "{} imported in {} us".format(
+            module, import_times["ubittool.cli"]
+        )
+
+
+def test_batch_flash_invalid_hex(tmp_path):
+    """Test the batch-flash command with a hex file that can not be parsed."""
+    hex_path = tmp_path / "invalid.hex"
+    hex_path.write_text("not a hex file\n")
+    runner = CliRunner()
+
+    result = runner.invoke(cli.batch_flash, ["--file-path", str(hex_path)])
+
+    assert "Error: Invalid Intel Hex record in line 1" in result.output
+    assert result.exit_code == 1
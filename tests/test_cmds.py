@@ -2,8 +2,16 @@
 # -*- coding: utf-8 -*-
 """Tests for cmds.py module."""
 import os
+import re
+import json
+import time
+import zlib
+import signal
+import multiprocessing
+import itertools
 from io import StringIO
 from unittest import mock
+from multiprocessing.sharedctypes import RawArray
 
 import pytest
 from intelhex import IntelHex
@@ -26,9 +34,123 @@ def ihex_to_str(ih):
     return hex_str
 
 
+def mock_connected_v1(return_value):
+    """Create a MicrobitMcu method side effect that sets the V1 regions."""
+
+    def side_effect(self, *args, **kwargs):
+        self.mem = cmds.programmer.MEM_REGIONS_MB_V1
+        self.board_id = "9900"
+        return return_value
+
+    return side_effect
+
+
+###############################################################################
+# Connection reuse
+###############################################################################
+@mock.patch.object(cmds.programmer.MicrobitMcu, "read_uicr", autospec=True)
+@mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
+@mock.patch(
+    "ubittool.programmer.ConnectHelper.session_with_chosen_probe",
+    autospec=True,
+)
+def test_commands_reuse_connection(
+    mock_session_with_chosen_probe, mock_read_flash, mock_read_uicr
+):
+    """Check commands given a connected micro:bit do not connect again."""
+    session = mock.Mock()
+    session.board.unique_id = "99000000000000000000"
+    mock_session_with_chosen_probe.return_value = session
+    mock_read_flash.return_value = (0x3E000, b"\xff" * 4)
+    mock_read_uicr.return_value = (0x10001000, b"\xff" * 0x100)
+    mb = cmds.programmer.MicrobitMcu().connect()
+
+    code = cmds.read_python_code(mcu=mb)
+    uicr = cmds.read_uicr_hex(mcu=mb)
+    flash = cmds.read_flash_hex(mcu=mb, address=0x3E000, count=4)
+
+    assert code == ""
+    assert uicr.startswith(":020000041000EA")
+    assert flash.startswith(":020000040003F7")
+    assert mock_session_with_chosen_probe.call_count == 1
+    assert session.close.call_count == 0
+    mb.close()
+    assert session.close.call_count == 1
+
+
 ###############################################################################
 # Data format conversions
 ###############################################################################
+def test_as_bytes():
+    """Test the data is converted into a memoryview of bytes."""
+    data_bytes = bytes([1, 2, 3, 4])
+    data_bytearray = bytearray(data_bytes)
+
+    from_list = cmds._as_bytes([1, 2, 3, 4])
+    from_bytes = cmds._as_bytes(data_bytes)
+    from_bytearray = cmds._as_bytes(data_bytearray)
+    from_view = cmds._as_bytes(memoryview(data_bytes)[1:3])
+
+    assert from_list == data_bytes
+    assert from_bytes == data_bytes
+    assert from_bytes.obj is data_bytes
+    assert from_bytearray.obj is data_bytearray
+    assert from_view == bytes([2, 3])
+
+
+def test_as_bytes_invalid_data():
+    """Test a list with values that are not bytes raises an exception."""
+    with pytest.raises((TypeError, ValueError)):
+        cmds._as_bytes([1, 2, 3, 4, "500"])
+    with pytest.raises((TypeError, ValueError)):
+        cmds._as_bytes([1, 2, 3, 4, 500])
+
+
+def test_trim_erased():
+    """Test erased pages are removed and the rest kept with their address."""
+    page = bytes(range(256)) * 4
+    erased = b"\xff" * 1024
+    data = page + erased + erased + page + page + erased
+    data_offsets = [cmds.DataAndOffset(data, 0x1000)]
+
+    result = list(cmds._trim_erased(data_offsets, 1024))
+
+    assert result == [
+        cmds.DataAndOffset(page, 0x1000),
+        cmds.DataAndOffset(page + page, 0x1C00),
+    ]
+
+
+def test_trim_erased_unaligned():
+    """Test the partial pages at the edges are checked with the bytes read."""
+    data = b"\xff" * 0x10 + b"\x00" + b"\xff" * 0x1F0 + b"\xff" * 0x20
+    data_offsets = [
+        cmds.DataAndOffset(data, 0x3F0),
+        cmds.DataAndOffset(b"\xff" * 8, 0x800),
+    ]
+
+    result = list(cmds._trim_erased(data_offsets, 0x200))
+
+    assert result == [cmds.DataAndOffset(data[0x10:0x210], 0x400)]
+    assert list(cmds._trim_erased([(b"\xff" * 0x10, 0x3F0)], 0x200)) == []
+
+
+def test_bytes_to_intel_hex_bytes_like():
+    """Test the Intel Hex conversion is the same for any data container."""
+    data = [x for x in range(256)] * 4
+    data_offsets = [cmds.DataAndOffset(data=data, offset=0x10000)]
+
+    results = [
+        cmds._bytes_to_intel_hex([cmds.DataAndOffset(bytes(data), 0x10000)]),
+        cmds._bytes_to_intel_hex(
+            [cmds.DataAndOffset(memoryview(bytearray(data)), 0x10000)]
+        ),
+    ]
+
+    for result in results:
+        assert result == cmds._bytes_to_intel_hex(data_offsets)
+
+
 def test_bytes_to_intel_hex():
     """Test the data to Intel Hex string conversion."""
     data = [1, 2, 3, 4, 5]
@@ -164,6 +286,20 @@ def test_read_flash_hex(mock_read_flash):
     assert result == ihex_str
 
 
+@mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
+def test_read_flash_hex_trim_erased(mock_read_flash):
+    """Test read_flash_hex() leaving the erased pages out."""
+    data_bytes = bytes(range(256)) * 4 + b"\xff" * 2048 + bytes(1024)
+    mock_read_flash.side_effect = mock_connected_v1((0, data_bytes))
+    intel_hex = IntelHex()
+    intel_hex.frombytes(data_bytes[:1024])
+    intel_hex.frombytes(data_bytes[3072:], 3072)
+
+    result = cmds.read_flash_hex(trim_erased=True)
+
+    assert result == ihex_to_str(intel_hex)
+
+
 @mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
 def test_read_flash_hex_decoded(mock_read_flash):
     """Test read_flash_hex() with decoding hex."""
@@ -255,39 +391,225 @@ def test_read_uicr_customer_hex(mock_read_uicr_customer):
     assert result == ihex_str
 
 
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_flash", autospec=True)
+def test_read_flash_chunks(mock_iter_flash):
+    """Test read_flash_chunks() yields the data with its address."""
+    mock_iter_flash.return_value = iter([(0, b"\x01\x02"), (2, b"\x03")])
+
+    result = list(cmds.read_flash_chunks(chunk_size=2))
+
+    assert result == [
+        cmds.DataAndOffset(b"\x01\x02", 0),
+        cmds.DataAndOffset(b"\x03", 2),
+    ]
+    assert mock_iter_flash.call_args[1] == {"chunk_size": 2}
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_flash", autospec=True)
+def test_read_flash_chunks_trim_erased(mock_iter_flash):
+    """Test read_flash_chunks() splits and skips chunks at erased pages."""
+    page = bytes(1024)
+    erased = b"\xff" * 1024
+    mock_iter_flash.side_effect = mock_connected_v1(
+        iter([(0, page + erased + page), (3072, erased), (4096, page)])
+    )
+
+    result = list(cmds.read_flash_chunks(trim_erased=True))
+
+    assert result == [
+        cmds.DataAndOffset(page, 0),
+        cmds.DataAndOffset(page, 2048),
+        cmds.DataAndOffset(page, 4096),
+    ]
+    assert mock_iter_flash.call_args[1] == {}
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_uicr", autospec=True)
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_ram", autospec=True)
+def test_read_ram_uicr_chunks(mock_iter_ram, mock_iter_uicr):
+    """Test read_ram_chunks() and read_uicr_chunks() yield the chunks."""
+    mock_iter_ram.return_value = iter([(0x20000000, b"\x01")])
+    mock_iter_uicr.return_value = iter([(0x10001000, b"\x02")])
+
+    ram_result = list(cmds.read_ram_chunks())
+    uicr_result = list(cmds.read_uicr_chunks())
+
+    assert ram_result == [cmds.DataAndOffset(b"\x01", 0x20000000)]
+    assert uicr_result == [cmds.DataAndOffset(b"\x02", 0x10001000)]
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_flash", autospec=True)
+def test_write_flash_hex(mock_iter_flash):
+    """Test write_flash_hex() streams the same output as read_flash_hex()."""
+    data_bytes = bytes([x for x in range(256)] * 1024)
+    mock_iter_flash.return_value = (
+        (i, data_bytes[i:][:4096]) for i in range(0, len(data_bytes), 4096)
+    )
+    intel_hex = IntelHex()
+    intel_hex.frombytes(data_bytes)
+    output = StringIO()
+
+    cmds.write_flash_hex(output)
+
+    assert output.getvalue() == ihex_to_str(intel_hex)
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_flash", autospec=True)
+def test_write_flash_hex_non_zero_address(mock_iter_flash):
+    """Test write_flash_hex() with a read within the first 64 KB."""
+    data_bytes = bytes([x for x in range(128)])
+    mock_iter_flash.return_value = iter([(1024, data_bytes)])
+    output = StringIO()
+
+    cmds.write_flash_hex(output, address=1024, count=128)
+
+    assert output.getvalue() == ihex_to_str(
+        IntelHex({x + 1024: x for x in range(128)})
+    )
+    assert mock_iter_flash.call_args[1] == {"address": 1024, "count": 128}
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_uicr", autospec=True)
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_flash", autospec=True)
+def test_write_flash_uicr_hex(mock_iter_flash, mock_iter_uicr, tmp_path):
+    """Test write_flash_uicr_hex() writes the hex into a file path."""
+    flash_data_bytes = bytes([x for x in range(256)] * 4)
+    uicr_data_bytes = bytes([x for x in range(64)])
+    mock_iter_flash.return_value = iter([(0, flash_data_bytes)])
+    mock_iter_uicr.return_value = iter([(0x10001000, uicr_data_bytes)])
+    intel_hex = IntelHex()
+    intel_hex.frombytes(flash_data_bytes)
+    intel_hex.frombytes(uicr_data_bytes, 0x10001000)
+    file_path = str(tmp_path / "flash_uicr.hex")
+
+    cmds.write_flash_uicr_hex(file_path)
+
+    with open(file_path) as f:
+        assert f.read() == ihex_to_str(intel_hex)
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "read_ram", autospec=True)
+@mock.patch.object(cmds.programmer.MicrobitMcu, "read_uicr", autospec=True)
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_flash", autospec=True)
+def test_write_memory_image_bin(
+    mock_iter_flash, mock_read_uicr, mock_read_ram, tmp_path
+):
+    """Test write_memory_image() saves the raw binary and its metadata."""
+    flash_data = bytes(range(256)) * 4 + b"\xff" * 1024
+    mock_iter_flash.side_effect = mock_connected_v1(iter([(0, flash_data)]))
+    mock_read_uicr.return_value = (0x10001000, b"\x01" * 0x100)
+    mock_read_ram.return_value = (0x20000000, b"\x02" * 0x4000)
+    file_path = str(tmp_path / "flash.bin")
+
+    cmds.write_memory_image(
+        file_path, "bin", uicr=True, ram=True, trim_erased=True
+    )
+
+    with open(file_path, "rb") as f:
+        assert (
+            f.read() == flash_data[:1024] + b"\x01" * 0x100 + b"\x02" * 0x4000
+        )
+    with open(file_path + ".json") as f:
+        metadata = json.load(f)
+    assert metadata["board_id"] == "9900"
+    assert metadata["regions"] == [
+        {"address": 0, "size": 1024, "offset": 0},
+        {"address": 0x10001000, "size": 0x100, "offset": 1024},
+        {"address": 0x20000000, "size": 0x4000, "offset": 1024 + 0x100},
+    ]
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_flash", autospec=True)
+def test_write_memory_image_uf2_elf(mock_iter_flash, tmp_path):
+    """Test write_memory_image() saves the UF2 and ELF formats."""
+    flash_data = bytes(range(256)) * 4
+    mock_iter_flash.side_effect = mock_connected_v1(iter([(0, flash_data)]))
+    uf2_path = str(tmp_path / "flash.uf2")
+    elf_path = str(tmp_path / "flash.elf")
+
+    cmds.write_memory_image(uf2_path, "uf2")
+    mock_iter_flash.side_effect = mock_connected_v1(iter([(0, flash_data)]))
+    cmds.write_memory_image(elf_path, "elf")
+
+    with open(uf2_path, "rb") as f:
+        assert f.read() == b"".join(
+            cmds.formats.uf2_blocks(
+                [(flash_data, 0)], cmds.formats.UF2_FAMILY_NRF51
+            )
+        )
+    with open(elf_path, "rb") as f:
+        assert f.read() == cmds.formats.elf_image([(flash_data, 0)])
+    assert not os.path.exists(uf2_path + ".json")
+
+
+def test_write_memory_image_bad_format(tmp_path):
+    """Test an unknown image format raises an error before reading."""
+    file_path = str(tmp_path / "flash.img")
+
+    with pytest.raises(ValueError, match="Unknown image format"):
+        cmds.write_memory_image(file_path, "hex")
+
+    assert not os.path.exists(file_path)
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "iter_flash", autospec=True)
+def test_write_flash_hex_no_file_on_error(mock_iter_flash, tmp_path):
+    """Test the output file is not created if the flash cannot be read."""
+    mock_iter_flash.side_effect = Exception("Did not find any boards")
+    file_path = str(tmp_path / "flash.hex")
+
+    with pytest.raises(Exception, match="Did not find any boards"):
+        cmds.write_flash_hex(file_path)
+
+    assert not os.path.exists(file_path)
+
+
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "find_micropython_end", autospec=True
+)
 @mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
-def test_read_micropython(mock_read_flash):
-    """Test read_micropython() with default arguments."""
+def test_read_micropython(mock_read_flash, mock_find_micropython_end):
+    """Test read_micropython() reads until the end of the runtime."""
     data_bytes = bytes([x for x in range(256)] * 4)
     intel_hex = IntelHex()
     intel_hex.frombytes(data_bytes)
     ihex_str = ihex_to_str(intel_hex)
+    mock_find_micropython_end.return_value = 1024
     mock_read_flash.return_value = (0, data_bytes)
 
     result = cmds.read_micropython()
 
     assert result == ihex_str
+    assert mock_read_flash.call_args[1] == {"address": 0, "count": 1024}
+
+
+def mock_read_code_flash(code_area):
+    """Create a read_flash() side effect reading from the Python code area."""
+
+    def side_effect(self, address, count):
+        offset = address - cmds.programmer.PYTHON_CODE_START
+        return address, code_area[offset:][:count]
+
+    return side_effect
 
 
 @mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
-@mock.patch("ubittool.cmds._bytes_to_intel_hex", autospec=True)
-def test_read_python_code(mock_bytes_to_intel_hex, mock_read_flash):
-    """."""
-    python_code_hex = "\n".join(
-        [
-            ":020000040003F7",
-            ":10E000004D509600232041646420796F7572205032",
-            ":10E010007974686F6E20636F646520686572652E21",
-            ":10E0200020452E672E0A66726F6D206D6963726FD0",
-            ":10E0300062697420696D706F7274202A0A7768694A",
-            ":10E040006C6520547275653A0A202020206469733B",
-            ":10E05000706C61792E7363726F6C6C282748656CE5",
-            ":10E060006C6F2C20576F726C642127290A202020A6",
-            ":10E0700020646973706C61792E73686F7728496DBD",
-            ":10E080006167652E4845415254290A20202020739B",
-            ":10E090006C656570283230303029000000000000C7",
-            ":10E0A000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF80",
-        ]
+def test_read_python_code(mock_read_flash):
+    """Check only the code header and the code bytes are read."""
+    code_area = (
+        bytes.fromhex(
+            "4D509600232041646420796F75722050"
+            "7974686F6E20636F646520686572652E"
+            "20452E672E0A66726F6D206D6963726F"
+            "62697420696D706F7274202A0A776869"
+            "6C6520547275653A0A20202020646973"
+            "706C61792E7363726F6C6C282748656C"
+            "6C6F2C20576F726C642127290A202020"
+            "20646973706C61792E73686F7728496D"
+            "6167652E4845415254290A2020202073"
+            "6C65657028323030302900000000000000"
+        )
+        + b"\xff" * 0x100
     )
     python_code = "\n".join(
         [
@@ -299,40 +621,126 @@ def test_read_python_code(mock_bytes_to_intel_hex, mock_read_flash):
             "    sleep(2000)",
         ]
     )
-    mock_read_flash.return_value = (0, "")
-    mock_bytes_to_intel_hex.return_value = python_code_hex
+    mock_read_flash.side_effect = mock_read_code_flash(code_area)
 
     result = cmds.read_python_code()
 
     assert result == python_code
+    assert [c[1] for c in mock_read_flash.call_args_list] == [
+        {"address": 0x3E000, "count": 4},
+        {"address": 0x3E004, "count": 0x96},
+    ]
 
 
 @mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
 def test_read_python_code_empty(mock_read_flash):
     """Check an emptry Python code is returned on an empty flash."""
     data_bytes = bytes([x for x in range(64)])
-    mock_read_flash.return_value = (0x3E000, data_bytes)
+    mock_read_flash.side_effect = mock_read_code_flash(data_bytes)
 
     result = cmds.read_python_code()
 
     assert result == ""
+    assert mock_read_flash.call_count == 1
 
 
 @mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
-@mock.patch("ubittool.cmds.uflash.extract_script", autospec=True)
-def test_read_python_code_exception(mock_extract_script, mock_read_flash):
-    """Check error thrown if failing to find Python code in flash."""
-    data_bytes = bytes([x for x in range(64)])
-    mock_read_flash.return_value = (0x3E000, data_bytes)
+def test_read_python_code_exception(mock_read_flash):
+    """Check error thrown if failing to decode the Python code in flash."""
+    mock_read_flash.side_effect = mock_read_code_flash(
+        b"MP\x04\x00\xff\xfe\xfd\xfc"
+    )
 
-    mock_extract_script.side_effect = Exception("Boom")
+    with pytest.raises(Exception) as exc_info:
+        cmds.read_python_code()
+    assert str(exc_info.value) == (
+        "Could not decode the MicroPython code from flash"
+    )
 
-    try:
+    mock_read_flash.side_effect = mock_read_code_flash(b"MP\xfd\x1f")
+    with pytest.raises(Exception, match="invalid code length 8189"):
         cmds.read_python_code()
-    except Exception as e:
-        assert str(e) == "Could not decode the MicroPython code from flash"
-    else:
-        raise AssertionError("Expected excepion not thrown.")
+
+
+@mock.patch("ubittool.cmds.filesystem.read_files", autospec=True)
+@mock.patch("ubittool.cmds.filesystem.find_region_table", autospec=True)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "memory_regions", autospec=True
+)
+def test_read_micropython_files(
+    mock_memory_regions, mock_find_region_table, mock_read_files
+):
+    """Check the files are read from the filesystem region."""
+    mock_memory_regions.return_value = cmds.programmer.MEM_REGIONS_MB_V2
+    mock_find_region_table.return_value = [
+        cmds.filesystem.FlashRegion(2, 0x1C000, 0x50000),
+        cmds.filesystem.FlashRegion(3, 0x6D000, 0x3000),
+    ]
+    files = [cmds.filesystem.MicroPythonFile("main.py", b"print(1)")]
+    mock_read_files.return_value = files
+
+    result = cmds.read_micropython_files()
+
+    assert result == files
+    assert mock_find_region_table.call_args[0][1:] == (0, 0x80000, 4096)
+    assert mock_read_files.call_args[0][1:] == (0x6D000, 0x3000)
+
+
+@mock.patch("ubittool.cmds.filesystem.find_region_table", autospec=True)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "memory_regions", autospec=True
+)
+def test_read_micropython_files_no_fs(
+    mock_memory_regions, mock_find_region_table
+):
+    """Check an error is raised without a filesystem region."""
+    mock_memory_regions.return_value = cmds.programmer.MEM_REGIONS_MB_V1
+
+    for regions in (None, [cmds.filesystem.FlashRegion(2, 0, 0x1000)]):
+        mock_find_region_table.return_value = regions
+        with pytest.raises(Exception, match="Could not find the MicroPython"):
+            cmds.read_micropython_files()
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "reset", autospec=True)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "program_flash_sectors", autospec=True
+)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "changed_flash_sectors", autospec=True
+)
+def test_flash_python_code(mock_changed, mock_program, mock_reset):
+    """Check only the changed sectors of the script area are programmed."""
+    mock_changed.side_effect = [[], [0x3E000, 0x3E400]]
+
+    result = cmds.flash_python_code("print('hello')\n")
+
+    assert result == 2
+    runtime_call, script_call = mock_changed.call_args_list
+    assert runtime_call[1] == {"address": 0, "count": 0x38074}
+    assert script_call[1] == {"address": 0x3E000, "count": 0x2000}
+    script_image = mock_program.call_args[0][1]
+    assert script_image.read(0x3E000, 20) == (
+        b"MP\x0f\x00print('hello')\n\x00"
+    )
+    assert mock_program.call_args[0][2] == [0x3E000, 0x3E400]
+    assert mock_reset.call_count == 1
+
+
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "program_flash_sectors", autospec=True
+)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "changed_flash_sectors", autospec=True
+)
+def test_flash_python_code_different_runtime(mock_changed, mock_program):
+    """Check nothing is programmed if the runtime is not the expected one."""
+    mock_changed.return_value = [0x1000]
+
+    with pytest.raises(Exception, match="flash the full hex file"):
+        cmds.flash_python_code("print('hello')\n")
+
+    assert mock_program.call_count == 0
 
 
 ###############################################################################
@@ -378,34 +786,190 @@ def test_gen_diff_html(mock_diff):
     assert html.count(to_lines) == 1
 
 
-@mock.patch("ubittool.cmds.read_flash_hex", autospec=True)
-@mock.patch("ubittool.cmds._gen_diff_html", autospec=True)
+def test_gen_ranges_html():
+    """Check the HTML contains the titles, summary and highlighted bytes."""
+    diff_lines = [(0x3E000, b"\x01\x02", b"\x01\x03")]
+
+    html = cmds._gen_ranges_html("<file>", "micro:bit", diff_lines, "A & B")
+
+    assert "&lt;file&gt;" in html
+    assert "A &amp; B" in html
+    assert "<td>0003E000</td>" in html
+    assert '01 <span class="diff_chg">02</span>' in html
+    assert '01 <span class="diff_chg">03</span>' in html
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
 @mock.patch("ubittool.cmds._open_temp_html", autospec=True)
-def test_compare_full_flash_hex(
-    mock_open_temp_html, mock_gen_diff_html, mock_read_flash_hex
-):
-    """Check that file contents."""
+def test_compare_full_flash_hex(mock_open_temp_html, mock_read_flash, capsys):
+    """Check the file is compared by address, not by hex record lines."""
+    flash_data = bytes(range(256)) * 4 + b"\xff" * 1024
+    file_data = bytearray(flash_data[:1024])
+    file_data[0x10] = 0xAA
+    file_data[0x11] = 0xBB
+    file_data[0x200] = 0xCC
+    # Different record size and letter case than the flash hex
+    file_hex_content = "".join(
+        cmds.formats.intel_hex_lines([(file_data, 0)], record_size=32)
+    ).lower()
+    mock_read_flash.return_value = (0, flash_data)
     file_hex_path = os.path.join("path", "to", "file.hex")
-    file_hex_content = "This is the hex file content"
-    flash_hex_content = "This is the flash hex content"
-    mock_read_flash_hex.return_value = flash_hex_content
 
     with mock.patch(
         "ubittool.cmds.open", mock.mock_open(read_data=file_hex_content)
     ) as m_open:
-        cmds.compare_full_flash_hex(file_hex_path)
+        result = cmds.compare_full_flash_hex(file_hex_path)
 
     m_open.assert_called_once_with(file_hex_path, encoding="utf-8")
-    assert mock_read_flash_hex.call_count == 1
-    assert mock_read_flash_hex.call_args[1] == {"decode_hex": False}
-    assert mock_gen_diff_html.call_count == 1
-    assert mock_gen_diff_html.call_args[0] == (
-        "micro:bit",
-        [flash_hex_content],
-        "Hex file",
-        [file_hex_content],
-    )
+    assert result == 1
     assert mock_open_temp_html.call_count == 1
+    html = mock_open_temp_html.call_args[0][0]
+    assert "<td>00000010</td>" in html
+    assert "<td>00000200</td>" in html
+    assert html.count("<tr><td>") == 2
+    out = capsys.readouterr().out
+    assert "Found 3 bytes different in 2 ranges" in out
+    assert "0x00000010 - 0x00000011 (2 bytes)" in out
+    assert "0x00000200 - 0x00000200 (1 bytes)" in out
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
+@mock.patch("ubittool.cmds._open_temp_html", autospec=True)
+def test_compare_full_flash_hex_equal(
+    mock_open_temp_html, mock_read_flash, capsys
+):
+    """Check an equal file with extra UICR data returns no differences."""
+    flash_data = bytes(range(256)) * 4 + b"\xff" * 1024
+    file_hex_content = "".join(
+        cmds.formats.intel_hex_lines(
+            [(flash_data[:1024], 0), (b"\x00" * 4, 0x10001014)]
+        )
+    )
+    mock_read_flash.return_value = (0, flash_data)
+
+    with mock.patch(
+        "ubittool.cmds.open", mock.mock_open(read_data=file_hex_content)
+    ):
+        result = cmds.compare_full_flash_hex("file.hex")
+
+    assert result == 0
+    out = capsys.readouterr().out
+    assert "No differences found." in out
+    assert "4 bytes from the hex file are not in flash." in out
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "_read_memory", autospec=True)
+def test_check_flash_hex(mock_read_memory):
+    """Check the flash read stops after the maximum number of differences."""
+    flash_data = bytearray(b"\xff" * (256 * 1024))
+    flash_data[0x1000] = 0
+    flash_data[0x1002] = 0
+    flash_data[0x20000:0x20100] = bytes(0x100)
+    flash_data[0x30000] = 0
+    file_hex_content = "".join(
+        cmds.formats.intel_hex_lines([(bytes(0x100), 0x20000)])
+    )
+
+    def read_memory(self, address, count):
+        self.mem = cmds.programmer.MEM_REGIONS_MB_V1
+        return bytes(flash_data[address:][:count])
+
+    mock_read_memory.side_effect = read_memory
+    connect = mock.patch.object(
+        cmds.programmer.MicrobitMcu,
+        "_connect",
+        autospec=True,
+        side_effect=mock_connected_v1(None),
+    )
+
+    with connect, mock.patch(
+        "ubittool.cmds.open", mock.mock_open(read_data=file_hex_content)
+    ):
+        result_first = cmds.check_flash_hex("file.hex")
+        reads_first = mock_read_memory.call_count
+        result_two = cmds.check_flash_hex("file.hex", max_diffs=2)
+        reads_two = mock_read_memory.call_count - reads_first
+        result_all = cmds.check_flash_hex("file.hex", max_diffs=10)
+        reads_all = mock_read_memory.call_count - reads_first - reads_two
+        flash_data[0x1000] = flash_data[0x1002] = flash_data[0x30000] = 0xFF
+        result_equal = cmds.check_flash_hex("file.hex", max_diffs=10)
+
+    assert (result_first, result_two, result_all) == (1, 1, 1)
+    assert result_equal == 0
+    assert reads_first == reads_two == 2
+    assert reads_all == 64
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "flash_sector_crc32", autospec=True
+)
+def test_check_flash_hex_crc(mock_crc32, mock_read_flash):
+    """Check only the flash sectors with a different CRC are read."""
+    flash_data = bytearray(b"\xff" * (256 * 1024))
+    flash_data[0x20000:0x20100] = bytes(0x100)
+    flash_data[0x30010] = 0
+    file_hex_content = "".join(
+        cmds.formats.intel_hex_lines([(bytes(0x100), 0x20000)])
+    )
+    mock_crc32.side_effect = mock_connected_v1(
+        [zlib.crc32(flash_data[a:][:1024]) for a in range(0, 0x40000, 1024)]
+    )
+    mock_read_flash.side_effect = lambda self, address, count: (
+        address,
+        bytes(flash_data[address:][:count]),
+    )
+
+    with mock.patch(
+        "ubittool.cmds.open", mock.mock_open(read_data=file_hex_content)
+    ):
+        result = cmds.check_flash_hex("file.hex", max_diffs=10, crc=True)
+
+    assert result == 1
+    mock_crc32.assert_called_once_with(mock.ANY, address=None, count=None)
+    assert mock_read_flash.call_args_list == [
+        mock.call(mock.ANY, address=0x30000, count=1024)
+    ]
+
+
+@mock.patch.object(cmds.programmer.MicrobitMcu, "read_flash", autospec=True)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "flash_sector_crc32", autospec=True
+)
+@mock.patch("ubittool.cmds._open_temp_html", autospec=True)
+def test_compare_full_flash_hex_crc(
+    mock_open_temp_html, mock_crc32, mock_read_flash, capsys
+):
+    """Check the report is generated from the sectors with a different CRC."""
+    file_data = bytes(range(256)) * 4
+    flash_data = bytearray(file_data + b"\xff" * (255 * 1024))
+    flash_data[0x10] = 0xAA
+    file_hex_content = "".join(
+        cmds.formats.intel_hex_lines(
+            [(file_data, 0), (b"\x00" * 4, 0x10001014)]
+        )
+    )
+    mock_crc32.side_effect = mock_connected_v1(
+        [zlib.crc32(flash_data[a:][:1024]) for a in range(0, 0x40000, 1024)]
+    )
+    mock_read_flash.return_value = (0, bytes(flash_data[:1024]))
+
+    with mock.patch(
+        "ubittool.cmds.open", mock.mock_open(read_data=file_hex_content)
+    ):
+        result = cmds.compare_full_flash_hex("file.hex", crc=True)
+
+    assert result == 1
+    mock_read_flash.assert_called_once_with(mock.ANY, address=0, count=1024)
+    out = capsys.readouterr().out
+    assert "0x00000010 - 0x00000010 (1 bytes)" in out
+    assert "4 bytes from the hex file are not in flash." in out
+
+
+def test_check_flash_hex_bad_max_diffs():
+    """Check the maximum number of differences must be positive."""
+    with pytest.raises(ValueError):
+        cmds.check_flash_hex("file.hex", max_diffs=0)
 
 
 @mock.patch("ubittool.cmds.read_uicr_customer_hex", autospec=True)
@@ -427,7 +991,10 @@ def test_compare_uicr_customer(
 
     m_open.assert_called_once_with(file_hex_path, encoding="utf-8")
     assert mock_read_uicr_customer.call_count == 1
-    assert mock_read_uicr_customer.call_args[1] == {"decode_hex": False}
+    assert mock_read_uicr_customer.call_args[1] == {
+        "decode_hex": False,
+        "mcu": None,
+    }
     assert mock_gen_diff_html.call_count == 1
     assert mock_gen_diff_html.call_args[0] == (
         "micro:bit",
@@ -475,3 +1042,516 @@ def test_flash_pyocd(mock_microbit_mcu_flash_hex):
     assert (
         mock_microbit_mcu_flash_hex.call_args[0][1] == "path/to/hex_file.hex"
     )
+
+
+class FakeDiscovery(object):
+    """Discovery backend with a list of (board IDs, changed) steps."""
+
+    def __init__(self, microbit_ids, steps):
+        """Store the boards connected at the start and the steps."""
+        self.microbit_ids = microbit_ids
+        self.steps = list(steps)
+        self.enumerations = 0
+        self.timeouts = []
+        self.closed = False
+
+    def connected_ids(self):
+        """Get the boards of the current step."""
+        self.enumerations += 1
+        return self.microbit_ids
+
+    def wait(self, timeout=None):
+        """Move to the next step, stop like Ctrl+C after the last one."""
+        self.timeouts.append(timeout)
+        if not self.steps:
+            raise KeyboardInterrupt
+        self.microbit_ids, changed = self.steps.pop(0)
+        return changed
+
+    def close(self):
+        """Record the backend was closed."""
+        self.closed = True
+
+
+def mock_batch_context(mock_get_context):
+    """Make the mock multiprocessing context allocate real shared memory."""
+    mock_get_context.return_value.RawArray.side_effect = RawArray
+
+
+def mock_flash_result(error=None, skipped=False):
+    """Create a finished AsyncResult mock, with the error if given."""
+    flash_result = mock.Mock()
+    flash_result.ready.return_value = True
+    flash_result.get.return_value = (
+        {"program": 2.0, "reset": 0.5},
+        error,
+        skipped,
+    )
+    return flash_result
+
+
+@mock.patch("ubittool.cmds.multiprocessing.get_context", autospec=True)
+@mock.patch("ubittool.cmds.discovery.usb_hub", autospec=True)
+@mock.patch("ubittool.scheduler.time", autospec=True)
+def test_batch_flash_hex(
+    mock_time, mock_usb_hub, mock_get_context, tmp_path, capsys
+):
+    """Test boards are only enumerated on changes and to retry failures."""
+    # Each scheduler step is 10 seconds later, after the retry delay
+    mock_time.monotonic.side_effect = itertools.count(0, 10)
+    mock_usb_hub.return_value = None
+    mock_batch_context(mock_get_context)
+    hex_path = tmp_path / "file.hex"
+    hex_path.write_text(":0100000001FE\n" + INTEL_HEX_EOF)
+    mock_pool = mock_get_context.return_value.Pool.return_value
+    mock_pool.apply_async.side_effect = [
+        mock_flash_result(),
+        mock_flash_result("Board unplugged"),
+        mock_flash_result(),
+    ]
+    watcher = FakeDiscovery(
+        ("9900",),
+        [(("9900", "9901"), True), (("9900", "9901"), False), ((), False)],
+    )
+
+    with pytest.raises(KeyboardInterrupt):
+        cmds.batch_flash_hex(
+            str(hex_path),
+            incremental=True,
+            watcher=watcher,
+            workers=4,
+            metrics_output=str(tmp_path / "metrics.jsonl"),
+        )
+
+    mock_get_context.assert_called_once_with("spawn")
+    mock_get_context.return_value.Pool.assert_called_once_with(
+        4, cmds._init_batch_worker, ({None: [(b"\x01", 0)]}, mock.ANY)
+    )
+    heartbeat_slots = mock_get_context.return_value.Pool.call_args[0][2][1]
+    assert heartbeat_slots.size == 4
+    assert [c[0][1][4:] for c in mock_pool.apply_async.call_args_list] == [
+        (0, 1),
+        (0, 2),
+        (0, 3),
+    ]
+    assert [c[0][1][:2] for c in mock_pool.apply_async.call_args_list] == [
+        ("9900", True),
+        ("9901", True),
+        ("9901", True),
+    ]
+    metrics_lines = (tmp_path / "metrics.jsonl").read_text().splitlines()
+    assert [json.loads(line)["result"] for line in metrics_lines] == [
+        "ok",
+        "failed",
+        "ok",
+    ]
+    assert json.loads(metrics_lines[1])["error"] == "Board unplugged"
+    output = capsys.readouterr().out
+    assert (
+        "Flashing of 9901 failed (Board unplugged), retrying in 1 s..."
+        in output
+    )
+    assert "finished successfully in 2.5 s" in output
+    assert "2 boards flashed" in output
+    assert re.search(r"9901 +- +2 +ok\n", output)
+    # The retry uses the boards found in the last enumeration
+    assert watcher.enumerations == 2
+    assert watcher.closed
+    mock_pool.__exit__.assert_called_once()
+
+
+@mock.patch("ubittool.cmds.multiprocessing.get_context", autospec=True)
+@mock.patch("ubittool.cmds.discovery.usb_hub", autospec=True)
+@mock.patch("ubittool.scheduler.time", autospec=True)
+def test_batch_flash_hex_retry_no_free_slot(
+    mock_time, mock_usb_hub, mock_get_context, tmp_path
+):
+    """Test the loop does not spin with a retry due and no free workers."""
+    mock_usb_hub.return_value = None
+    mock_batch_context(mock_get_context)
+    hex_path = tmp_path / "file.hex"
+    hex_path.write_text(":0100000001FE\n" + INTEL_HEX_EOF)
+    not_ready = mock.Mock()
+    not_ready.ready.return_value = False
+    mock_pool = mock_get_context.return_value.Pool.return_value
+    mock_pool.apply_async.side_effect = [
+        mock_flash_result("Failed"),
+        not_ready,
+        not_ready,
+    ]
+    watcher = FakeDiscovery(("a", "b", "c"), [(("a", "b", "c"), False)] * 4)
+    # The retry of "a" is due after the second wait, when "c" took its slot
+    mock_time.monotonic.side_effect = lambda: len(watcher.timeouts) * 0.75
+
+    with pytest.raises(KeyboardInterrupt):
+        cmds.batch_flash_hex(str(hex_path), watcher=watcher, workers=2)
+
+    assert [c[0][1][0] for c in mock_pool.apply_async.call_args_list] == [
+        "a",
+        "b",
+        "c",
+    ]
+    assert watcher.timeouts == [cmds.BATCH_CHECK_INTERVAL] * 5
+
+
+@mock.patch("ubittool.cmds.multiprocessing.get_context", autospec=True)
+@mock.patch("ubittool.cmds.discovery.usb_hub", autospec=True)
+@mock.patch("ubittool.scheduler.time", autospec=True)
+def test_batch_flash_hex_retry_unplugged(
+    mock_time, mock_usb_hub, mock_get_context, tmp_path, capsys
+):
+    """Test a failed board unplugged counts its retries until giving up."""
+    mock_usb_hub.return_value = None
+    mock_batch_context(mock_get_context)
+    hex_path = tmp_path / "file.hex"
+    hex_path.write_text(":0100000001FE\n" + INTEL_HEX_EOF)
+    mock_pool = mock_get_context.return_value.Pool.return_value
+    mock_pool.apply_async.side_effect = [mock_flash_result("Failed")]
+    watcher = FakeDiscovery(("9900",), [((), True), ((), False)])
+    mock_time.monotonic.side_effect = lambda: len(watcher.timeouts) * 0.75
+
+    with pytest.raises(KeyboardInterrupt):
+        cmds.batch_flash_hex(str(hex_path), watcher=watcher, max_attempts=2)
+
+    mock_pool.apply_async.assert_called_once()
+    assert watcher.timeouts == [cmds.BATCH_CHECK_INTERVAL] * 3
+    output = capsys.readouterr().out
+    assert (
+        "Flashing of 9900 failed (Board not connected), giving up after 2 "
+        "attempts" in output
+    )
+    assert re.search(r"9900 +- +2 +gave up \(Board not connected\)", output)
+
+
+@mock.patch("ubittool.cmds.multiprocessing.get_context", autospec=True)
+@mock.patch("ubittool.cmds.discovery.usb_hub", autospec=True)
+def test_batch_flash_hex_journal(
+    mock_usb_hub, mock_get_context, tmp_path, capsys
+):
+    """Test only the boards in the journal with the hex file are checked."""
+    mock_usb_hub.return_value = None
+    mock_batch_context(mock_get_context)
+    hex_path = tmp_path / "file.hex"
+    hex_path.write_text(":0100000001FE\n" + INTEL_HEX_EOF)
+    image_hash = cmds.journal.hash_image(hex_path.read_bytes())
+    journal_path = str(tmp_path / "journal.db")
+    flash_journal = cmds.journal.FlashJournal(journal_path)
+    flash_journal.record("9900", image_hash)
+    flash_journal.record("9901", "old image")
+    mock_pool = mock_get_context.return_value.Pool.return_value
+    mock_pool.apply_async.side_effect = [
+        mock_flash_result(skipped=True),
+        mock_flash_result(),
+    ]
+
+    with pytest.raises(KeyboardInterrupt):
+        cmds.batch_flash_hex(
+            str(hex_path),
+            watcher=FakeDiscovery(("9900", "9901"), []),
+            journal_path=journal_path,
+        )
+
+    assert [c[0][1][3] for c in mock_pool.apply_async.call_args_list] == [
+        True,
+        False,
+    ]
+    assert flash_journal.contains("9900", image_hash)
+    assert flash_journal.contains("9901", image_hash)
+    flash_journal.close()
+    output = capsys.readouterr().out
+    assert (
+        "Flashing of 9900 skipped, it already contains the hex file" in output
+    )
+    assert "1 boards flashed, 1 skipped" in output
+    assert re.search(r"9900 +- +1 +skipped\n", output)
+
+
+@mock.patch("ubittool.cmds.watchdog.HEARTBEAT_INTERVAL", 0.01)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "flash_hex_sections", autospec=True
+)
+def test_flash_batch_microbit(mock_flash_hex_sections):
+    """Test the batch worker flashes the hex file it was started with."""
+    hex_sections = {None: [(b"\x01", 0)]}
+    heartbeat_slots = cmds.watchdog.HeartbeatSlots(
+        multiprocessing.get_context(), 2
+    )
+    heartbeats = []
+
+    def flash_hex_sections(mb, sections, incremental, timings, skip_matching):
+        with cmds.programmer._timed(timings, "program"):
+            time.sleep(0.1)
+            heartbeats.append(heartbeat_slots.read(1))
+        return True
+
+    mock_flash_hex_sections.side_effect = flash_hex_sections
+    heartbeat_slots.assign(1, 7)
+    with mock.patch("ubittool.cmds.signal.signal", autospec=True):
+        cmds._init_batch_worker(hex_sections, heartbeat_slots)
+    timings, error, skipped = cmds._flash_batch_microbit(
+        "9900", True, time.time(), slot=1, task_id=7
+    )
+
+    mb = mock_flash_hex_sections.call_args[0][0]
+    assert mb.unique_id == "9900"
+    mock_flash_hex_sections.assert_called_once_with(
+        mb,
+        hex_sections,
+        incremental=True,
+        timings=mock.ANY,
+        skip_matching=False,
+    )
+    assert list(timings) == ["queue", "program"]
+    assert error is None
+    assert skipped is False
+    task_id, pid, beats, stage, stage_timings = heartbeats[0]
+    assert (task_id, pid, stage) == (7, os.getpid(), "program")
+    assert beats > 1
+    assert set(stage_timings) == {"queue"}
+    # The slot is released when the board is finished
+    assert heartbeat_slots.read(1)[:2] == (0, 0)
+    assert heartbeat_slots.read(0).beats == 0
+
+
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "flash_hex_sections", autospec=True
+)
+def test_flash_batch_microbit_error(mock_flash_hex_sections):
+    """Test the batch worker returns the error instead of raising it."""
+    mock_flash_hex_sections.side_effect = Exception("No board")
+
+    _, error, skipped = cmds._flash_batch_microbit("9900", False, time.time())
+
+    assert error == "No board"
+    assert skipped is False
+
+
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "flash_hex_sections", autospec=True
+)
+def test_flash_batch_microbit_cancelled(mock_flash_hex_sections):
+    """Test the batch worker does not flash a board no longer watched."""
+    heartbeat_slots = cmds.watchdog.HeartbeatSlots(
+        multiprocessing.get_context(), 1
+    )
+    # The slot of the task was assigned to the next board
+    heartbeat_slots.assign(0, 8)
+    with mock.patch("ubittool.cmds.signal.signal", autospec=True):
+        cmds._init_batch_worker({}, heartbeat_slots)
+
+    _, error, skipped = cmds._flash_batch_microbit(
+        "9900", False, time.time(), slot=0, task_id=7
+    )
+
+    assert error == "Cancelled before reaching a worker"
+    assert skipped is False
+    mock_flash_hex_sections.assert_not_called()
+    assert heartbeat_slots.read(0)[:3] == (8, 0, 0)
+
+
+def stuck_batch_flash(pid):
+    """Create a batch with a board stuck in the program stage of a worker."""
+    heartbeat_slots = cmds.watchdog.HeartbeatSlots(
+        multiprocessing.get_context(), 1
+    )
+    batch_watchdog = cmds.watchdog.BatchWatchdog(
+        heartbeat_slots, stage_timeouts={"program": 0}
+    )
+    batch_scheduler = cmds.scheduler.BatchScheduler(1)
+    batch_scheduler.add("9900")
+    batch_scheduler.start_ready(["9900"])
+    slot, task_id = batch_watchdog.start("9900")
+    heartbeat_slots.write(slot, task_id, pid, "program", {"connect": 0.5})
+    flash_result = mock.Mock()
+    flash_result.ready.return_value = False
+    batch_flashes = [cmds.BatchFlash(flash_result, "9900", 0.0)]
+    return batch_scheduler, batch_flashes, batch_watchdog
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGSTOP"), reason="POSIX signals")
+@mock.patch("ubittool.cmds.os.kill", autospec=True)
+def test_check_batch_flashes_timeout(mock_kill, capsys):
+    """Test the worker of a board stuck in a stage is terminated."""
+    batch_scheduler, batch_flashes, batch_watchdog = stuck_batch_flash(1234)
+    output = StringIO()
+
+    cmds._check_batch_flashes(
+        batch_scheduler,
+        batch_flashes,
+        cmds.metrics.BatchMetrics(output),
+        batch_watchdog,
+        None,
+        None,
+    )
+
+    assert mock_kill.call_args_list == [
+        mock.call(1234, signal.SIGSTOP),
+        mock.call(1234, signal.SIGKILL),
+    ]
+    assert batch_flashes == []
+    assert batch_watchdog.boards == {}
+    assert batch_scheduler.boards["9900"].state == "retry"
+    row = json.loads(output.getvalue())
+    assert row["error"].startswith("Timed out in the program stage after")
+    assert row["connect"] == 0.5
+    assert "Flashing of 9900 failed (Timed out" in capsys.readouterr().out
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGSTOP"), reason="POSIX signals")
+@mock.patch("ubittool.cmds.os.kill", autospec=True)
+def test_check_batch_flashes_timeout_finished(mock_kill):
+    """Test a worker that finished the board before the check is resumed."""
+    batch_scheduler, batch_flashes, batch_watchdog = stuck_batch_flash(1234)
+    batch_watchdog.receive()
+    # The worker released the slot, it could be flashing a different board
+    batch_watchdog.slots.clear(0)
+    output = StringIO()
+
+    cmds._check_batch_flashes(
+        batch_scheduler,
+        batch_flashes,
+        cmds.metrics.BatchMetrics(output),
+        batch_watchdog,
+        None,
+        None,
+    )
+
+    assert mock_kill.call_args_list == [
+        mock.call(1234, signal.SIGSTOP),
+        mock.call(1234, signal.SIGCONT),
+    ]
+    assert len(batch_flashes) == 1
+    assert "9900" in batch_watchdog.boards
+    assert batch_scheduler.boards["9900"].state == "flashing"
+    assert output.getvalue() == ""
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "fork"), reason="The workers need the test mocks"
+)
+@mock.patch("ubittool.cmds.watchdog.HEARTBEAT_INTERVAL", 0.0001)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "flash_hex_sections", autospec=True
+)
+def test_batch_worker_killed_during_heartbeat(mock_flash_hex_sections):
+    """Test killing a worker writing heartbeats does not block the rest."""
+
+    def flash_hex_sections(mb, sections, incremental, timings, skip_matching):
+        with cmds.programmer._timed(timings, "program"):
+            time.sleep(60 if mb.unique_id == "9900" else 0.5)
+        return True
+
+    mock_flash_hex_sections.side_effect = flash_hex_sections
+    context = multiprocessing.get_context("fork")
+    heartbeat_slots = cmds.watchdog.HeartbeatSlots(context, 2)
+    batch_watchdog = cmds.watchdog.BatchWatchdog(
+        heartbeat_slots, stage_timeouts={"program": 0.05}
+    )
+
+    with context.Pool(2, cmds._init_batch_worker, ({}, heartbeat_slots)) as p:
+        slot, task_id = batch_watchdog.start("9900")
+        stuck = p.apply_async(
+            cmds._flash_batch_microbit,
+            ("9900", False, time.time(), False, slot, task_id),
+        )
+        deadline = time.monotonic() + 10
+        while heartbeat_slots.read(slot).stage != "program":
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        time.sleep(0.1)
+        batch_watchdog.receive()
+        time.sleep(0.1)
+        # Killed while it is continuously writing heartbeats
+        (timed_out,) = batch_watchdog.expired()
+        stuck_flash = cmds.BatchFlash(stuck, "9900", 0.0)
+        assert cmds._terminate_batch_worker(
+            stuck_flash, timed_out, batch_watchdog
+        )
+        batch_watchdog.forget("9900")
+
+        slot, task_id = batch_watchdog.start("9901")
+        flashing = p.apply_async(
+            cmds._flash_batch_microbit,
+            ("9901", False, time.time(), False, slot, task_id),
+        )
+        stages = set()
+        while not flashing.ready():
+            assert time.monotonic() < deadline
+            batch_watchdog.receive()
+            stages.add(batch_watchdog.boards["9901"].stage)
+            time.sleep(0.01)
+        timings, error, skipped = flashing.get()
+
+    assert stuck.ready() is False
+    assert error is None
+    assert "program" in timings
+    assert "program" in stages
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "fork"), reason="The workers need the test mocks"
+)
+@mock.patch("ubittool.cmds.watchdog.HEARTBEAT_INTERVAL", 0.01)
+@mock.patch.object(
+    cmds.programmer.MicrobitMcu, "flash_hex_sections", autospec=True
+)
+def test_batch_flash_waiting_for_worker(mock_flash_hex_sections, capsys):
+    """Test a board waiting longer than the heartbeat timeout is not retried.
+
+    The pool has a single worker, so the second board waits for it to finish
+    the first one.
+    """
+    context = multiprocessing.get_context("fork")
+    flash_count = context.RawArray("i", 2)
+
+    def flash_hex_sections(mb, sections, incremental, timings, skip_matching):
+        flash_count[int(mb.unique_id) - 9900] += 1
+        with cmds.programmer._timed(timings, "program"):
+            time.sleep(0.5)
+        return True
+
+    mock_flash_hex_sections.side_effect = flash_hex_sections
+    heartbeat_slots = cmds.watchdog.HeartbeatSlots(context, 2)
+    batch_watchdog = cmds.watchdog.BatchWatchdog(
+        heartbeat_slots, heartbeat_timeout=0.2
+    )
+    batch_scheduler = cmds.scheduler.BatchScheduler(2)
+    batch_scheduler.add("9900")
+    batch_scheduler.add("9901")
+    output = StringIO()
+    batch_flashes = []
+
+    with context.Pool(1, cmds._init_batch_worker, ({}, heartbeat_slots)) as p:
+        cmds._start_batch_flashes(
+            p,
+            batch_scheduler.start_ready(["9900", "9901"]),
+            {},
+            batch_flashes,
+            batch_watchdog,
+            False,
+            False,
+            None,
+            None,
+        )
+        deadline = time.monotonic() + 10
+        while batch_flashes:
+            assert time.monotonic() < deadline
+            cmds._check_batch_flashes(
+                batch_scheduler,
+                batch_flashes,
+                cmds.metrics.BatchMetrics(output),
+                batch_watchdog,
+                None,
+                None,
+            )
+            time.sleep(0.05)
+
+    rows = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [(r["board"], r["result"]) for r in rows] == [
+        ("9900", "ok"),
+        ("9901", "ok"),
+    ]
+    assert rows[1]["queue"] > 0.4
+    assert list(flash_count) == [1, 1]
+    assert batch_scheduler.boards["9901"].state == "ok"
+    assert " failed (" not in capsys.readouterr().out
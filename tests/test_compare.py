@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for compare.py module."""
+import zlib
+
+import pytest
+
+from ubittool import compare
+from ubittool.compare import DiffRange
+
+
+###############################################################################
+# SparseImage
+###############################################################################
+def test_sparse_image_read():
+    """Test reading areas with and without data."""
+    image = compare.SparseImage(
+        [(b"\x03" * 4, 0x30), (b"\x01" * 4, 0x10), (b"\x01" * 4, 0x14)]
+    )
+
+    assert image.areas == [(b"\x01" * 8, 0x10), (b"\x03" * 4, 0x30)]
+    assert len(image) == 12
+    assert image.read(0x10, 8) == b"\x01" * 8
+    assert image.read(0x0E, 4) == b"\xff\xff\x01\x01"
+    assert image.read(0x16, 0x20, fill=0) == (
+        b"\x01\x01" + bytes(0x18) + b"\x03" * 4 + bytes(2)
+    )
+    assert image.read(0x40, 2) == b"\xff\xff"
+    assert compare.SparseImage([]).read(0, 2) == b"\xff\xff"
+
+
+def test_sparse_image_count_outside():
+    """Test counting the bytes outside the areas of another image."""
+    image = compare.SparseImage([(bytes(0x20), 0x10), (bytes(8), 0x1000)])
+    other = compare.SparseImage([(bytes(0x18), 0x00)])
+
+    assert image.count_outside(other) == 0x20
+    assert other.count_outside(image) == 0x10
+    assert image.count_inside(0x18, 0x1000) == 0x20
+    assert image.count_inside(0x0, 0x10) == 0
+
+
+def test_sparse_image_sector_crc32():
+    """Test the sector CRCs include the fill value for bytes without data."""
+    image = compare.SparseImage([(b"\x01" * 0x10, 0x108)])
+
+    assert image.sector_crc32(0x100, 0x200, 0x100) == [
+        zlib.crc32(b"\xff" * 8 + b"\x01" * 0x10 + b"\xff" * 0xE8),
+        zlib.crc32(b"\xff" * 0x100),
+    ]
+    assert (
+        image.sector_crc32(0x200, 0x100, 0x80, fill=0)
+        == [zlib.crc32(bytes(0x80))] * 2
+    )
+
+
+###############################################################################
+# diff_buffers() and diff_images()
+###############################################################################
+def test_diff_buffers():
+    """Test contiguous differing bytes are merged into ranges."""
+    expected = bytes(1024)
+    actual = bytearray(expected)
+    actual[0] = 1
+    actual[255:258] = b"\x01\x02\x03"
+    actual[1023] = 1
+
+    result = compare.diff_buffers(0x1000, expected, actual)
+
+    assert result == [
+        DiffRange(0x1000, 0x1001),
+        DiffRange(0x10FF, 0x1102),
+        DiffRange(0x13FF, 0x1400),
+    ]
+    assert compare.diff_buffers(0, expected, expected) == []
+
+
+def test_diff_buffers_max_ranges():
+    """Test the comparison stops once the maximum number of ranges is found."""
+    expected = bytes(2048)
+    actual = bytearray(expected)
+    actual[10] = actual[12] = actual[1500] = 1
+    ranges = [DiffRange(0, 1)]
+
+    result = compare.diff_buffers(0x1000, expected, actual, ranges, 2)
+
+    assert result is ranges
+    assert result == [DiffRange(0, 1), DiffRange(0x100A, 0x100B)]
+    assert len(compare.diff_buffers(0, expected, actual, max_ranges=3)) == 3
+
+
+def test_diff_buffers_different_length():
+    """Test buffers with different lengths raise an error."""
+    with pytest.raises(ValueError):
+        compare.diff_buffers(0, b"\x00", b"\x00\x00")
+
+
+def test_diff_images():
+    """Test missing expected data is compared against the erased value."""
+    actual = compare.SparseImage([(b"\x01" * 8 + b"\xff" * 8 + b"\x00", 0)])
+    expected = compare.SparseImage(
+        [(b"\x01" * 4, 0), (b"\x02" * 4, 4), (b"\x00", 0x10), (b"\x05", 0x20)]
+    )
+
+    result = compare.diff_images(expected, actual)
+
+    assert result == [DiffRange(4, 8)]
+    assert compare.diff_images(expected, actual, fill=0) == [
+        DiffRange(4, 0x10)
+    ]
+
+
+###############################################################################
+# Reports
+###############################################################################
+def test_diff_lines():
+    """Test each line with differences is yielded once."""
+    expected = compare.SparseImage([(bytes(0x40), 0)])
+    actual = compare.SparseImage([(bytes(0x40), 0)])
+    ranges = [
+        DiffRange(0x02, 0x03),
+        DiffRange(0x0F, 0x11),
+        DiffRange(0x30, 0x31),
+    ]
+
+    result = list(compare.diff_lines(expected, actual, ranges))
+
+    assert [line[0] for line in result] == [0x00, 0x10, 0x30]
+    assert result[0][1:] == (bytes(16), bytes(16))
+
+
+def test_ranges_report():
+    """Test the text summary of the ranges."""
+    ranges = [DiffRange(0x10, 0x12), DiffRange(0x10001000, 0x10001001)]
+
+    assert compare.ranges_report(ranges) == (
+        "Found 3 bytes different in 2 ranges:\n"
+        "  0x00000010 - 0x00000011 (2 bytes)\n"
+        "  0x10001000 - 0x10001000 (1 bytes)\n"
+    )
+    assert compare.ranges_report([]) == "No differences found.\n"
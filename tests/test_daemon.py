@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for daemon.py module."""
+import os
+import json
+import threading
+from unittest import mock
+
+import pytest
+
+from ubittool import cli, cmds, daemon
+
+
+###############################################################################
+# Helpers
+###############################################################################
+def request(command, args=None, unique_id=None):
+    """Create a JSON request line."""
+    return json.dumps(
+        {"command": command, "args": args or {}, "unique_id": unique_id}
+    ).encode("utf-8")
+
+
+@pytest.fixture
+def mock_mcu():
+    """Replace the MicrobitMcu class, connect() returns the same instance."""
+    with mock.patch(
+        "ubittool.programmer.MicrobitMcu", autospec=True
+    ) as mock_class:
+        mcu = mock_class.return_value
+        mcu.connect.return_value = mcu
+        yield mock_class
+
+
+@pytest.fixture
+def running_daemon(tmp_path, mock_mcu):
+    """Serve requests from a thread on a temporary socket."""
+    ubit_daemon = daemon.Daemon(str(tmp_path / "ubittool.sock"))
+    ubit_daemon.start()
+    thread = threading.Thread(target=ubit_daemon.serve_forever)
+    thread.start()
+    yield ubit_daemon
+    ubit_daemon.shutdown()
+    thread.join()
+    ubit_daemon.close()
+
+
+###############################################################################
+# Daemon
+###############################################################################
+@mock.patch("ubittool.cmds.read_python_code", autospec=True)
+def test_execute_reuses_connection(mock_read_python_code, mock_mcu):
+    """Test the same MicrobitMcu is used for the requests to a board."""
+    mock_read_python_code.return_value = "code"
+    ubit_daemon = daemon.Daemon()
+
+    results = [
+        ubit_daemon.execute(request("read_python_code")),
+        ubit_daemon.execute(request("read_python_code")),
+        ubit_daemon.execute(request("read_python_code", unique_id="9900")),
+    ]
+
+    assert results == [{"result": "code"}] * 3
+    assert mock_mcu.call_args_list == [
+        mock.call(unique_id=None),
+        mock.call(unique_id="9900"),
+    ]
+    assert (
+        mock_read_python_code.call_args_list
+        == [mock.call(mcu=mock_mcu.return_value)] * 3
+    )
+
+
+@mock.patch("ubittool.cmds.write_flash_hex", autospec=True)
+def test_execute_output_text(mock_write_flash_hex, mock_mcu):
+    """Test the text written by an output command without path is returned."""
+    mock_write_flash_hex.side_effect = lambda output, **kwargs: output.write(
+        ":00000001FF\n"
+    )
+
+    result = daemon.Daemon().execute(
+        request("write_flash_hex", {"output": None, "decode_hex": True})
+    )
+
+    assert result == {"result": ":00000001FF\n"}
+    assert mock_write_flash_hex.call_args[1]["decode_hex"] is True
+
+
+@mock.patch("ubittool.cmds.read_micropython_files", autospec=True)
+def test_execute_files(mock_read_files, mock_mcu):
+    """Test the files read are returned with base64 data."""
+    mock_read_files.return_value = [
+        cmds.filesystem.MicroPythonFile("main.py", b"import data\n"),
+        cmds.filesystem.MicroPythonFile("data.bin", b"\x00\xff"),
+    ]
+    ubit_daemon = daemon.Daemon()
+
+    response = ubit_daemon.execute(request("read_micropython_files"))
+
+    assert response == {
+        "result": [["main.py", "aW1wb3J0IGRhdGEK"], ["data.bin", "AP8="]]
+    }
+    assert daemon.decode_files(json.loads(json.dumps(response["result"]))) == (
+        mock_read_files.return_value
+    )
+
+
+@mock.patch("ubittool.cmds.read_python_code", autospec=True)
+def test_execute_error_closes_connection(mock_read_python_code, mock_mcu):
+    """Test a failed command closes the connection to reconnect later."""
+    mock_read_python_code.side_effect = Exception("Board unplugged")
+    ubit_daemon = daemon.Daemon()
+
+    result = ubit_daemon.execute(request("read_python_code"))
+
+    assert result == {"error": "Board unplugged"}
+    mock_mcu.return_value.close.assert_called_once_with()
+
+
+def test_execute_invalid_request(mock_mcu):
+    """Test malformed requests and unknown commands are rejected."""
+    ubit_daemon = daemon.Daemon()
+
+    assert ubit_daemon.execute(b"not json") == {"error": "Invalid request."}
+    assert ubit_daemon.execute(b"[]") == {"error": "Invalid request."}
+    assert ubit_daemon.execute(request("batch_flash_hex")) == {
+        "error": "Unknown command 'batch_flash_hex'."
+    }
+    assert mock_mcu.call_count == 0
+
+
+@mock.patch("ubittool.cmds.read_python_code", autospec=True)
+def test_call(mock_read_python_code, running_daemon):
+    """Test a client request through the socket."""
+    mock_read_python_code.side_effect = ["code", Exception("Failed read")]
+
+    result = daemon.call(
+        "read_python_code", socket_path=running_daemon.socket_path
+    )
+    with pytest.raises(Exception, match="Failed read"):
+        daemon.call("read_python_code", socket_path=running_daemon.socket_path)
+
+    assert result == "code"
+
+
+@mock.patch("ubittool.cmds.check_flash_hex", autospec=True)
+def test_cli_run_keyword_arguments(
+    mock_check_flash_hex, running_daemon, monkeypatch
+):
+    """Test the CLI sends the options for a **kwargs parameter by name."""
+    mock_check_flash_hex.return_value = 0
+    monkeypatch.setenv(daemon.SOCKET_ENV_VAR, running_daemon.socket_path)
+
+    result = cli._run(
+        cmds.check_flash_hex, "file.hex", max_diffs=2, trim_erased=True
+    )
+
+    assert result == 0
+    mock_check_flash_hex.assert_called_once_with(
+        mcu=mock.ANY,
+        hex_file_path=os.path.abspath("file.hex"),
+        max_diffs=2,
+        trim_erased=True,
+    )
+
+
+def test_call_no_daemon(tmp_path):
+    """Test the client reports when there is no daemon running."""
+    with pytest.raises(Exception, match="Could not connect to the daemon"):
+        daemon.call("read_python_code", socket_path=str(tmp_path / "none"))
+
+
+def test_start_socket_in_use(running_daemon):
+    """Test a second daemon can not use the socket of a running daemon."""
+    with pytest.raises(Exception, match="already listening"):
+        daemon.Daemon(running_daemon.socket_path).start()
+
+
+def test_close(tmp_path, mock_mcu):
+    """Test closing the daemon removes the socket and closes the boards."""
+    socket_path = tmp_path / "ubittool.sock"
+    ubit_daemon = daemon.Daemon(str(socket_path))
+    ubit_daemon.start()
+    ubit_daemon._get_mcu(None)
+
+    ubit_daemon.close()
+
+    assert not socket_path.exists()
+    mock_mcu.return_value.close.assert_called_once_with()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for discovery.py module."""
+import socket
+import struct
+from unittest import mock
+
+import pytest
+
+from ubittool import discovery
+
+
+###############################################################################
+# Helpers
+###############################################################################
+MICROBIT_ADD = {
+    "ACTION": "add",
+    "SUBSYSTEM": "usb",
+    "DEVTYPE": "usb_device",
+    "PRODUCT": "d28/204/1000",
+}
+
+
+def kernel_uevent(properties):
+    """Create a kernel uevent message."""
+    fields = ["{}@/devices/usb1/1-1".format(properties["ACTION"])]
+    fields += ["{}={}".format(k, v) for k, v in properties.items()]
+    return "\x00".join(fields).encode("utf-8") + b"\x00"
+
+
+def udev_uevent(properties):
+    """Create a udev monitor message."""
+    fields = "".join("{}={}\x00".format(k, v) for k, v in properties.items())
+    header_size = struct.calcsize("=8sIIIIIIII")
+    header = struct.pack(
+        "=8sIIIIIIII",
+        b"libudev\x00",
+        0xFEEDCAFE,
+        header_size,
+        header_size,
+        len(fields),
+        0,
+        0,
+        0,
+        0,
+    )
+    return header + fields.encode("utf-8")
+
+
+@pytest.fixture
+def uevent_pair():
+    """Create a UeventDiscovery reading from a socket pair."""
+    receiver, sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    watcher = discovery.UeventDiscovery(receiver)
+    yield watcher, sender
+    watcher.close()
+    sender.close()
+
+
+###############################################################################
+# uevents
+###############################################################################
+def test_parse_uevent():
+    """Test the properties are read from kernel and udev messages."""
+    assert discovery.parse_uevent(kernel_uevent(MICROBIT_ADD)) == MICROBIT_ADD
+    assert discovery.parse_uevent(udev_uevent(MICROBIT_ADD)) == MICROBIT_ADD
+
+
+def test_is_microbit_uevent():
+    """Test only the events adding a micro:bit are selected."""
+    hid_bind = {"ACTION": "bind", "HID_ID": "0003:00000D28:00000204"}
+
+    assert discovery.is_microbit_uevent(MICROBIT_ADD)
+    assert discovery.is_microbit_uevent(hid_bind)
+    assert not discovery.is_microbit_uevent(
+        dict(MICROBIT_ADD, ACTION="remove")
+    )
+    assert not discovery.is_microbit_uevent(
+        dict(MICROBIT_ADD, PRODUCT="46d/c52b/1211")
+    )
+    assert not discovery.is_microbit_uevent({"ACTION": "add"})
+
+
+def test_uevent_discovery_wait(uevent_pair):
+    """Test waiting returns when a micro:bit event is received."""
+    watcher, sender = uevent_pair
+    sender.send(kernel_uevent(dict(MICROBIT_ADD, PRODUCT="46d/c52b/1211")))
+
+    assert watcher.wait(timeout=0.01) is False
+
+    sender.send(udev_uevent(MICROBIT_ADD))
+    sender.send(kernel_uevent(dict(MICROBIT_ADD, ACTION="bind")))
+
+    assert watcher.wait(timeout=0.01) is True
+    assert watcher.wait(timeout=0.01) is False
+
+
+@mock.patch("ubittool.programmer.find_microbit_ids", autospec=True)
+def test_uevent_discovery_connected_ids(mock_find_microbit_ids, uevent_pair):
+    """Test the probes are enumerated to get the connected boards."""
+    mock_find_microbit_ids.return_value = ("9900",)
+    watcher, _ = uevent_pair
+
+    assert watcher.connected_ids() == ("9900",)
+
+
+###############################################################################
+# Polling and backend selection
+###############################################################################
+@mock.patch("ubittool.programmer.find_microbit_ids", autospec=True)
+def test_polling_discovery(mock_find_microbit_ids):
+    """Test waiting returns when the next enumeration is due."""
+    mock_find_microbit_ids.return_value = ("9900", "9901")
+    watcher = discovery.PollingDiscovery(interval=0.05)
+
+    assert watcher.wait(timeout=10) is True
+    assert watcher.connected_ids() == ("9900", "9901")
+    assert watcher.wait(timeout=0) is False
+    assert watcher.wait(timeout=10) is True
+    watcher.close()
+
+
+def test_open_discovery_fallback():
+    """Test the polling backend is used if uevents can not be received."""
+    with mock.patch(
+        "ubittool.discovery.socket.socket", side_effect=OSError("No netlink")
+    ):
+        watcher = discovery.open_discovery()
+
+    assert isinstance(watcher, discovery.PollingDiscovery)
+
+
+def test_usb_hub(tmp_path):
+    """Test the hub is found from the sysfs path of the board serial."""
+    devices = {
+        "1-2": "hub",
+        "1-2.3": "9900ABCD",
+        "2-1": "9901abcd",
+        "2-1:1.0": None,
+    }
+    for device_name, serial in devices.items():
+        (tmp_path / device_name).mkdir()
+        if serial:
+            (tmp_path / device_name / "serial").write_text(serial + "\n")
+
+    assert discovery.usb_hub("9900abcd", str(tmp_path)) == "1-2"
+    assert discovery.usb_hub("9901ABCD", str(tmp_path)) == "2"
+    assert discovery.usb_hub("9902", str(tmp_path)) is None
+    assert discovery.usb_hub("9900", str(tmp_path / "missing")) is None
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for filesystem.py module."""
+import struct
+
+import pytest
+
+from ubittool import filesystem
+
+
+###############################################################################
+# Helpers
+###############################################################################
+FS_START = 0x6D000
+PAGE_SIZE = 4096
+
+
+class FakeMcu(object):
+    """Reads from a flash bytes buffer, keeping count of the bytes read."""
+
+    def __init__(self, flash):
+        """Store the flash contents."""
+        self.flash = flash
+        self.bytes_read = 0
+
+    def read_flash(self, address, count):
+        """Read a flash area."""
+        self.bytes_read += count
+        return address, bytes(self.flash[address:][:count])
+
+    def read_flash_bytes(self, addresses):
+        """Read one byte from each address."""
+        self.bytes_read += len(addresses)
+        return bytes(self.flash[address] for address in addresses)
+
+
+def region_table(regions, page_size_log2=12):
+    """Create a flash regions table, with the rows in reverse order."""
+    rows = b"".join(
+        struct.pack("<BBHI8x", region_id, 0, start_page, size)
+        for region_id, start_page, size in reversed(regions)
+    )
+    header = struct.pack(
+        "<2xHHHII",
+        len(rows),
+        1,
+        page_size_log2,
+        filesystem.REGION_TABLE_MAGIC_1,
+        filesystem.REGION_TABLE_MAGIC_2,
+    )
+    return rows + header
+
+
+def write_chunk(flash, index, marker, data, next_index=0xFF):
+    """Write a filesystem chunk into the flash buffer."""
+    address = FS_START + (index - 1) * filesystem.CHUNK_SIZE
+    chunk = bytes([marker]) + data.ljust(126, b"\xff") + bytes([next_index])
+    chunk_end = address + len(chunk)
+    flash[address:chunk_end] = chunk
+
+
+def file_start(name, end_offset, data):
+    """Create the data of the first chunk of a file."""
+    return bytes([end_offset, len(name)]) + name + data
+
+
+def fs_flash():
+    """Create a flash with a region table and a filesystem with two files."""
+    flash = bytearray(b"\xff" * 0x80000)
+    table = region_table(
+        [(1, 0, 0x1C000), (2, 0x1C, 0x50000), (3, 0x6D, 0x3000)]
+    )
+    table_start = 0x6D000 - len(table)
+    flash[table_start:0x6D000] = table
+    # A small file and a file using 3 chunks out of order
+    big_file = bytes(range(256)) + b"end"
+    write_chunk(flash, 1, 0xFE, file_start(b"main.py", 18, b"print(1)\n"))
+    write_chunk(flash, 2, 0x00, b"deleted file")
+    write_chunk(flash, 3, 0xFE, file_start(b"data.bin", 17, big_file[:116]), 7)
+    write_chunk(flash, 7, 3, big_file[116:242], 5)
+    write_chunk(flash, 5, 7, big_file[242:])
+    write_chunk(flash, 24, 0xFD, b"")
+    return flash, big_file
+
+
+###############################################################################
+# find_region_table()
+###############################################################################
+def test_find_region_table():
+    """Test the table is found at the end of a page and the rows decoded."""
+    flash, _ = fs_flash()
+    mcu = FakeMcu(flash)
+
+    regions = filesystem.find_region_table(mcu, 0, 0x80000, PAGE_SIZE)
+
+    assert regions == [
+        filesystem.FlashRegion(1, 0, 0x1C000),
+        filesystem.FlashRegion(2, 0x1C000, 0x50000),
+        filesystem.FlashRegion(3, 0x6D000, 0x3000),
+    ]
+
+
+def test_find_region_table_missing():
+    """Test None is returned if there is no table in flash."""
+    mcu = FakeMcu(b"\xff" * 0x10000)
+
+    assert filesystem.find_region_table(mcu, 0, 0x10000, 1024) is None
+
+
+def test_find_region_table_bad_size():
+    """Test an error is raised if the table size is not a row multiple."""
+    flash = bytearray(b"\xff" * 0x2000)
+    table = region_table([(3, 1, 0x1000)])
+    table_start = len(flash) - len(table)
+    flash[table_start:] = table
+    flash[len(flash) - 16 + 2] = 17
+    mcu = FakeMcu(flash)
+
+    with pytest.raises(ValueError, match="table size 17"):
+        filesystem.find_region_table(mcu, 0, 0x2000, PAGE_SIZE)
+
+
+###############################################################################
+# read_files()
+###############################################################################
+def test_read_files():
+    """Test the files are read following their chunks."""
+    flash, big_file = fs_flash()
+    mcu = FakeMcu(flash)
+
+    files = filesystem.read_files(mcu, FS_START, 0x3000)
+
+    assert files == [
+        filesystem.MicroPythonFile("main.py", b"print(1)\n"),
+        filesystem.MicroPythonFile("data.bin", big_file),
+    ]
+    # Only a byte per chunk and the 4 chunks with file data are read
+    assert mcu.bytes_read == 0x3000 // 128 + 4 * 128
+
+
+def test_read_files_bad_chunk():
+    """Test an error is raised if a chunk does not belong to the file."""
+    flash, big_file = fs_flash()
+    write_chunk(flash, 5, 3, big_file[242:])
+    mcu = FakeMcu(flash)
+
+    with pytest.raises(ValueError, match="Invalid chunk 5"):
+        filesystem.read_files(mcu, FS_START, 0x3000)
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for formats.py module."""
+import random
+import struct
+from io import StringIO
+
+import pytest
+from intelhex import IntelHex
+
+from ubittool import formats
+
+
+###############################################################################
+# Helpers
+###############################################################################
+def intelhex_str(data_offsets, byte_count=16):
+    """Encode the data into an Intel Hex string with the IntelHex library."""
+    ih = IntelHex()
+    for data, offset in data_offsets:
+        ih.frombytes(data, offset)
+    sio = StringIO()
+    ih.write_hex_file(sio, byte_count=byte_count)
+    return sio.getvalue()
+
+
+def dump_str(data_offsets, width=16):
+    """Format the data into a pretty hex string with the IntelHex library."""
+    ih = IntelHex()
+    for data, offset in data_offsets:
+        ih.frombytes(data, offset)
+    sio = StringIO()
+    ih.dump(tofile=sio, width=width)
+    return sio.getvalue()
+
+
+def random_bytes(count, seed=0):
+    """Generate a reproducible bytes sequence of random data."""
+    rand = random.Random(seed)
+    return bytes(rand.getrandbits(8) for _ in range(count))
+
+
+###############################################################################
+# Intel Hex encoder
+###############################################################################
+def test_intel_hex_lines():
+    """Test a short data area encoding."""
+    result = "".join(formats.intel_hex_lines([(bytes([1, 2, 3, 4, 5]), 0)]))
+
+    assert result == ":050000000102030405EC\n:00000001FF\n"
+
+
+def test_intel_hex_lines_empty():
+    """Test no data only produces the End Of File record."""
+    assert list(formats.intel_hex_lines([])) == [formats.INTEL_HEX_EOF]
+    assert list(formats.intel_hex_lines([(b"", 0x10)])) == [
+        formats.INTEL_HEX_EOF
+    ]
+
+
+@pytest.mark.parametrize(
+    "data_offsets",
+    [
+        [(random_bytes(1024), 0)],
+        [(random_bytes(1000), 0x3E005)],
+        [(random_bytes(0x20010), 0xFFF8)],
+        [(random_bytes(64), 0x10001000)],
+        [(random_bytes(0x12345), 0x1), (random_bytes(0x308, 1), 0x10001000)],
+        [(random_bytes(0x80, 2), 0x10001080), (random_bytes(0x20), 0x100)],
+        [(random_bytes(0x11), 0x20), (random_bytes(0x13, 3), 0x31)],
+    ],
+)
+def test_intel_hex_lines_same_as_intelhex(data_offsets):
+    """Test the output is identical to the IntelHex library output."""
+    result = "".join(formats.intel_hex_lines(data_offsets))
+
+    assert result == intelhex_str(data_offsets)
+
+
+@pytest.mark.parametrize("record_size", [1, 8, 32, 255])
+def test_intel_hex_lines_record_size(record_size):
+    """Test the record width matches the IntelHex library byte_count."""
+    data_offsets = [(random_bytes(0x1100), 0xF800)]
+
+    result = "".join(formats.intel_hex_lines(data_offsets, record_size))
+
+    assert result == intelhex_str(data_offsets, byte_count=record_size)
+
+
+def test_intel_hex_lines_bad_record_size():
+    """Test invalid record sizes raise an error."""
+    with pytest.raises(ValueError):
+        list(formats.intel_hex_lines([(b"\x00", 0)], record_size=0))
+    with pytest.raises(ValueError):
+        list(formats.intel_hex_lines([(b"\x00", 0)], record_size=256))
+
+
+def test_intel_hex_lines_overlap():
+    """Test overlapping data areas raise an error."""
+    with pytest.raises(ValueError) as exc_info:
+        list(formats.intel_hex_lines([(bytes(16), 0), (bytes(16), 8)]))
+
+    assert "Overlapping data areas" in str(exc_info.value)
+
+
+###############################################################################
+# Intel Hex streaming writer
+###############################################################################
+@pytest.mark.parametrize("chunk_size", [1, 7, 16, 100, 4096])
+def test_intel_hex_writer_chunks(chunk_size):
+    """Test writing data in chunks produces the same output as all at once."""
+    data = random_bytes(0x2345)
+    offset = 0xF003
+    sio = StringIO()
+    writer = formats.IntelHexWriter(sio)
+
+    for i in range(0, len(data), chunk_size):
+        writer.write(offset + i, data[i:][:chunk_size])
+    writer.close()
+
+    assert sio.getvalue() == intelhex_str([(data, offset)])
+
+
+def test_intel_hex_writer_areas():
+    """Test writing separate areas in order, with and without a gap."""
+    areas = [
+        (random_bytes(0x105), 0x3E000),
+        (random_bytes(0x20, 1), 0x3E105),
+        (random_bytes(0x308, 2), 0x10001000),
+    ]
+    sio = StringIO()
+    writer = formats.IntelHexWriter(sio)
+
+    for data, offset in areas:
+        writer.write(offset, data)
+    writer.close()
+
+    assert sio.getvalue() == intelhex_str(areas)
+
+
+def test_intel_hex_writer_no_linear_address():
+    """Test data in the first 64 KB can be written without address records."""
+    data = random_bytes(0x80)
+    sio = StringIO()
+    writer = formats.IntelHexWriter(sio, linear_address=False)
+
+    writer.write(0x400, data[:0x50])
+    writer.write(0x450, data[0x50:])
+    writer.close()
+
+    assert sio.getvalue() == intelhex_str([(data, 0x400)])
+    assert list(writer.encode(0, b"")) == []
+
+
+def test_intel_hex_writer_bad_record_size():
+    """Test invalid record sizes raise an error."""
+    with pytest.raises(ValueError):
+        formats.IntelHexWriter(record_size=0)
+
+
+###############################################################################
+# Pretty hex encoder
+###############################################################################
+@pytest.mark.parametrize(
+    "data_offsets",
+    [
+        [(random_bytes(1024), 0)],
+        [(random_bytes(1000), 0x3E005)],
+        [(random_bytes(7), 0x13)],
+        [(random_bytes(0x308), 0x10001000)],
+        [(random_bytes(0x11), 0x20), (random_bytes(0x13, 3), 0x31)],
+        [(bytes(range(256)) * 2, 0xFF00)],
+    ],
+)
+def test_pretty_hex_lines_same_as_intelhex(data_offsets):
+    """Test the output is identical to the IntelHex library dump()."""
+    result = "".join(formats.pretty_hex_lines(data_offsets))
+
+    assert result == dump_str(data_offsets)
+
+
+@pytest.mark.parametrize("width", [1, 8, 32])
+def test_pretty_hex_lines_width(width):
+    """Test the line width matches the IntelHex library dump() width."""
+    data_offsets = [(random_bytes(0x105), 0x3E003)]
+
+    result = "".join(formats.pretty_hex_lines(data_offsets, width=width))
+
+    assert result == dump_str(data_offsets, width=width)
+
+
+def test_pretty_hex_lines_empty():
+    """Test no data produces no lines."""
+    assert list(formats.pretty_hex_lines([])) == []
+
+
+def test_pretty_hex_lines_gap():
+    """Test lines without any data between areas are not output."""
+    areas = [(b"\x41" * 16, 0), (b"\x42" * 2, 0x41)]
+
+    result = list(formats.pretty_hex_lines(areas))
+
+    assert result == [
+        "0000  41 41 41 41 41 41 41 41 41 41 41 41 41 41 41 41  "
+        "|AAAAAAAAAAAAAAAA|\n",
+        "0040  -- 42 42 -- -- -- -- -- -- -- -- -- -- -- -- --  "
+        "| BB             |\n",
+    ]
+
+
+def test_pretty_hex_lines_collapse_erased():
+    """Test runs of erased lines are collapsed after the first one."""
+    data = b"\x00" * 16 + b"\xff" * 64 + b"\x00" * 16 + b"\xff" * 48
+
+    result = list(formats.pretty_hex_lines([(data, 0)], collapse_erased=True))
+
+    assert [line[:6] for line in result] == [
+        "0000  ",
+        "0010  ",
+        "*\n",
+        "0050  ",
+        "0060  ",
+        "*\n",
+        "0080  ",
+    ]
+    expected_lines = dump_str([(data, 0)]).splitlines(keepends=True)
+    assert result[-1] == expected_lines[-1]
+
+
+def test_pretty_hex_lines_collapse_single_line():
+    """Test a single repeated erased line is shown instead of a "*" line."""
+    data = b"\x00" * 16 + b"\xff" * 32 + b"\x00" * 16
+
+    result = "".join(
+        formats.pretty_hex_lines([(data, 0)], collapse_erased=True)
+    )
+
+    assert result == dump_str([(data, 0)])
+
+
+###############################################################################
+# Pretty hex streaming writer
+###############################################################################
+@pytest.mark.parametrize("chunk_size", [1, 7, 16, 100, 4096])
+def test_pretty_hex_writer_chunks(chunk_size):
+    """Test writing data in chunks produces the same output as all at once."""
+    data = random_bytes(0x2345)
+    offset = 0xF003
+    sio = StringIO()
+    writer = formats.PrettyHexWriter(
+        sio, formats.pretty_hex_address_digits(offset + len(data))
+    )
+
+    for i in range(0, len(data), chunk_size):
+        writer.write(offset + i, data[i:][:chunk_size])
+    writer.close()
+
+    assert sio.getvalue() == dump_str([(data, offset)])
+
+
+@pytest.mark.parametrize("chunk_size", [1, 16, 4096])
+def test_pretty_hex_writer_collapse_chunks(chunk_size):
+    """Test collapsing erased lines does not depend on the chunk size."""
+    data = (b"\x00" * 0x30 + b"\xff" * 0x1000) * 3 + b"\xff" * 5
+    expected = "".join(
+        formats.pretty_hex_lines([(data, 0)], collapse_erased=True)
+    )
+    sio = StringIO()
+    writer = formats.PrettyHexWriter(sio, collapse_erased=True)
+
+    for i in range(0, len(data), chunk_size):
+        writer.write(i, data[i:][:chunk_size])
+    writer.close()
+
+    assert sio.getvalue() == expected
+    assert sio.getvalue().count("*\n") == 3
+
+
+@pytest.mark.parametrize(
+    "end_address, digits",
+    [(0x10, 4), (0x10000, 5), (0x40000, 5), (0x1000_1308, 8), (0xFFF1, 5)],
+)
+def test_pretty_hex_address_digits(end_address, digits):
+    """Test the address digits calculation follows the IntelHex rule."""
+    assert formats.pretty_hex_address_digits(end_address) == digits
+
+
+def test_pretty_hex_writer_bad_width():
+    """Test invalid widths raise an error."""
+    with pytest.raises(ValueError):
+        formats.PrettyHexWriter(width=0)
+
+
+###############################################################################
+# Binary image formats
+###############################################################################
+def test_bin_image():
+    """Test the areas are joined and their location is in the metadata."""
+    areas = [
+        (b"\x03" * 8, 0x10001000),
+        (b"\x01" * 0x10, 0x100),
+        (b"\x02" * 0x20, 0x110),
+    ]
+
+    image, metadata = formats.bin_image(areas)
+
+    assert image == b"\x01" * 0x10 + b"\x02" * 0x20 + b"\x03" * 8
+    assert metadata == {
+        "format": "ubittool-bin",
+        "version": 1,
+        "regions": [
+            {"address": 0x100, "size": 0x30, "offset": 0},
+            {"address": 0x10001000, "size": 8, "offset": 0x30},
+        ],
+    }
+
+
+def test_uf2_blocks():
+    """Test the UF2 blocks headers, payload and alignment."""
+    data = random_bytes(0x300)
+    family_id = formats.UF2_FAMILY_NRF52833
+
+    blocks = list(formats.uf2_blocks([(data, 0x3E080)], family_id))
+
+    assert len(blocks) == 4
+    payload = b""
+    for block_no, block in enumerate(blocks):
+        header = struct.unpack("<IIIIIIII", block[:32])
+        assert len(block) == 512
+        assert header[:3] == (0x0A324655, 0x9E5D5157, 0x2000)
+        assert header[5:] == (block_no, 4, family_id)
+        assert block[-4:] == struct.pack("<I", 0x0AB16F30)
+        payload += block[32:][: header[4]]
+    assert [struct.unpack("<I", b[12:16])[0] for b in blocks] == [
+        0x3E080,
+        0x3E100,
+        0x3E200,
+        0x3E300,
+    ]
+    assert payload == data
+
+
+def test_uf2_blocks_bad_payload_size():
+    """Test invalid payload sizes raise an error."""
+    with pytest.raises(ValueError):
+        list(formats.uf2_blocks([(b"\x00", 0)], 0, payload_size=477))
+
+
+def test_elf_image():
+    """Test the ELF file has a PT_LOAD segment per continuous area."""
+    areas = [
+        (random_bytes(0x401), 0),
+        (random_bytes(0x100, 1), 0x401),
+        (random_bytes(0x308, 2), 0x10001000),
+        (random_bytes(0x40, 3), 0x20000000),
+    ]
+
+    elf = formats.elf_image(areas)
+
+    header = struct.unpack("<16sHHIIIIIHHHHHH", elf[:52])
+    assert header[0][:4] == b"\x7fELF"
+    assert header[1:3] == (2, 40)
+    assert header[5] == 52
+    assert header[10] == 3
+    segments = []
+    for i in range(header[10]):
+        phdr_offset = 52 + i * 32
+        phdr = struct.unpack("<IIIIIIII", elf[phdr_offset:][:32])
+        p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz = phdr[:6]
+        assert p_type == 1 and p_vaddr == p_paddr and p_filesz == p_memsz
+        assert p_offset % 4 == 0
+        segments.append((elf[p_offset:][:p_filesz], p_vaddr))
+    assert segments == [
+        (areas[0][0] + areas[1][0], 0),
+        areas[2],
+        areas[3],
+    ]
+
+
+###############################################################################
+# Intel Hex parser
+###############################################################################
+@pytest.mark.parametrize("record_size", [16, 32, 255])
+def test_parse_intel_hex(record_size):
+    """Test the parser gets back the data areas from any record size."""
+    areas = [
+        (random_bytes(0x12345), 0xFFF8),
+        (random_bytes(0x308, 1), 0x10001000),
+    ]
+    hex_str = "".join(formats.intel_hex_lines(areas, record_size))
+
+    assert formats.parse_intel_hex(hex_str.splitlines()) == areas
+    assert formats.parse_intel_hex(hex_str.lower().splitlines()) == areas
+
+
+def test_parse_intel_hex_intelhex_file():
+    """Test the parser reads files created with the IntelHex library."""
+    areas = [(random_bytes(0x40), 0x20), (random_bytes(0x13, 3), 0x31000)]
+
+    result = formats.parse_intel_hex(StringIO(intelhex_str(areas)))
+
+    assert result == areas
+
+
+def test_parse_intel_hex_segment_address():
+    """Test extended segment and start address records."""
+    hex_lines = [
+        ":020000021000EC",
+        ":0400100001020304E2",
+        ":0400000300003800C1",
+        "",
+        ":00000001FF",
+        ":0400000001020304F2",
+    ]
+
+    assert formats.parse_intel_hex(hex_lines) == [
+        (b"\x01\x02\x03\x04", 0x10010)
+    ]
+
+
+@pytest.mark.parametrize(
+    "line, message",
+    [
+        ("0400000001020304F2", "line 2, it does not start with ':'"),
+        (":0400000001020304F3", "line 2, the checksum is wrong"),
+        (":0500000001020304F1", "line 2, the record length is wrong"),
+        (":04000000010203G4F2", "line 2"),
+        (":00000006FA", "Unsupported Intel Hex record type 0x06 in line 2"),
+    ],
+)
+def test_parse_intel_hex_invalid(line, message):
+    """Test invalid records raise an error with the line number."""
+    with pytest.raises(ValueError) as exc_info:
+        formats.parse_intel_hex([":0000000000", line])
+
+    assert message in str(exc_info.value)
+
+
+def test_parse_universal_hex():
+    """Test the data of each Universal Hex section is kept separately."""
+    record = formats._intel_hex_record
+    hex_lines = [
+        record(0, formats.IHEX_EXT_LINEAR_ADDR, b"\x00\x00"),
+        record(0, formats.IHEX_BLOCK_START, b"\x99\x00\xc0\xde"),
+        record(0, formats.IHEX_DATA, b"\x01\x02"),
+        record(0, formats.IHEX_PADDED_DATA, b"\xff\xff"),
+        record(0, formats.IHEX_BLOCK_END, b"\xff\xff"),
+        record(0, formats.IHEX_EXT_LINEAR_ADDR, b"\x00\x00"),
+        record(0, formats.IHEX_BLOCK_START, b"\x99\x03\xc0\xde"),
+        record(0, formats.IHEX_CUSTOM_DATA, b"\x03\x04"),
+        record(2, formats.IHEX_CUSTOM_DATA, b"\x05"),
+        record(0, formats.IHEX_EXT_LINEAR_ADDR, b"\x10\x00"),
+        record(0x1000, formats.IHEX_CUSTOM_DATA, b"\x06"),
+        record(0, formats.IHEX_BLOCK_END, b""),
+        formats.INTEL_HEX_EOF,
+    ]
+
+    assert formats.parse_universal_hex(hex_lines) == {
+        "9900": [(b"\x01\x02", 0)],
+        "9903": [(b"\x03\x04\x05", 0), (b"\x06", 0x10001000)],
+    }
+    assert formats.parse_universal_hex([hex_lines[2]]) == {
+        None: [(b"\x01\x02", 0)]
+    }
+    with pytest.raises(ValueError, match="record type 0x0a in line 2"):
+        formats.parse_intel_hex(hex_lines)
@@ -168,17 +168,24 @@ def test_read_full_flash_intel(mock_read_flash_hex, gui_window):
     )
 
 
-@mock.patch("ubittool.gui.cmds.read_flash_hex", autospec=True)
-def test_read_full_flash_pretty(mock_read_flash_hex, gui_window):
+@mock.patch("ubittool.gui.cmds.write_flash_hex", autospec=True)
+def test_read_full_flash_pretty(mock_write_flash_hex, gui_window):
     """Tests the READ_FLASH_PRETTY command."""
-    flash_data = "The full flash in pretty format data"
-    mock_read_flash_hex.return_value = flash_data
+    flash_data = ["The full flash ", "in pretty format data"]
+
+    def write_flash_hex(output, decode_hex, progress):
+        for i, data in enumerate(flash_data):
+            output.write(data)
+            progress(i + 1, len(flash_data))
+
+    mock_write_flash_hex.side_effect = write_flash_hex
+    gui_window.text_viewer.replace("Previous content")
 
     gui_window.nrf_menu.invoke(1)
 
     editor_content = gui_window.text_viewer.get(1.0, "end-1c")
-    assert flash_data == editor_content
-    assert mock_read_flash_hex.call_count == 1
+    assert "".join(flash_data) == editor_content
+    assert mock_write_flash_hex.call_count == 1
     assert gui_window.cmd_title.cmd_title.get() == "Command: {}".format(
         gui_window.CMD_READ_FLASH_PRETTY
     )
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for journal.py module."""
+from contextlib import closing
+
+from ubittool import journal
+
+
+def test_hash_image():
+    """Test the hash changes with the hex file contents."""
+    image_hash = journal.hash_image(b":00000001FF\n")
+
+    assert len(image_hash) == 64
+    assert image_hash == journal.hash_image(b":00000001FF\n")
+    assert image_hash != journal.hash_image(b":0100000001FE\n:00000001FF\n")
+
+
+def test_flash_journal(tmp_path):
+    """Test the last hex file of each board is kept after reopening it."""
+    journal_path = str(tmp_path / "journal.db")
+    with closing(journal.FlashJournal(journal_path)) as flash_journal:
+        assert flash_journal.contains("9900", "a") is False
+        flash_journal.record("9900", "a")
+        flash_journal.record("9901", "a")
+        flash_journal.record("9901", "b")
+
+    with closing(journal.FlashJournal(journal_path)) as flash_journal:
+        assert flash_journal.contains("9900", "a") is True
+        assert flash_journal.contains("9901", "a") is False
+        assert flash_journal.contains("9901", "b") is True
+        assert flash_journal.contains("9902", "b") is False
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for metrics.py module."""
+import json
+from io import StringIO
+from unittest import mock
+
+import pytest
+
+from ubittool import metrics
+
+
+def test_record_jsonl():
+    """Test each attempt is written as a JSON line with all the stages."""
+    output = StringIO()
+    batch_metrics = metrics.BatchMetrics(output)
+
+    row = batch_metrics.record("9900", {"connect": 0.25, "program": 1.5})
+    batch_metrics.record("9901", {"connect": 0.5}, error="Failed")
+    batch_metrics.record("9901", {"program": 1.0})
+
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert lines[0] == row
+    assert tuple(row) == metrics.FIELDS
+    assert row["erase"] == 0
+    assert row["total"] == 1.75
+    assert [(r["board"], r["attempt"], r["result"]) for r in lines] == [
+        ("9900", 1, "ok"),
+        ("9901", 1, "failed"),
+        ("9901", 2, "ok"),
+    ]
+    assert lines[1]["error"] == "Failed"
+    assert batch_metrics.succeeded == 2
+    assert batch_metrics.failed == 1
+    assert batch_metrics.retries == 1
+
+
+def test_record_csv():
+    """Test the CSV output has a header row before the first record."""
+    output = StringIO()
+    batch_metrics = metrics.BatchMetrics(output, metrics_format="csv")
+
+    batch_metrics.record("9900", {"reset": 0.125})
+    batch_metrics.record("9901", {"reset": 0.25})
+
+    lines = output.getvalue().splitlines()
+    assert lines[0] == ",".join(metrics.FIELDS)
+    assert len(lines) == 3
+    assert lines[2].split(",")[1:4] == ["9901", "1", "ok"]
+
+
+def test_invalid_format():
+    """Test an unknown format raises an error."""
+    with pytest.raises(ValueError, match="jsonl, csv"):
+        metrics.BatchMetrics(metrics_format="xml")
+
+
+@mock.patch("ubittool.metrics.time.monotonic", autospec=True)
+def test_summary(mock_monotonic):
+    """Test the summary includes the throughput and the slowest stage."""
+    mock_monotonic.return_value = 0
+    batch_metrics = metrics.BatchMetrics()
+    batch_metrics.record("9900", {"program": 3, "erase": 1})
+    batch_metrics.record("9901", {"program": 5}, error="Failed")
+    batch_metrics.record("9902", {"program": 1})
+    mock_monotonic.return_value = 60
+
+    assert batch_metrics.summary() == (
+        "2 boards flashed, 120 boards/hour, 1 failed attempts (33.3%), "
+        "0 retries, slowest stage: program (3.00 s)"
+    )
+
+    batch_metrics.record("9903", {"compare": 1}, skipped=True)
+
+    assert batch_metrics.summary().startswith(
+        "2 boards flashed, 1 skipped, 180 boards/hour, 1 failed attempts"
+    )
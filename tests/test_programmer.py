@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """Tests for programmer.py module."""
+import zlib
+import struct
 import types
 from unittest import mock
 
@@ -29,9 +31,229 @@ def MicrobitMcu_instance(v=1):
     return mb
 
 
+def MicrobitMcu_fake_target(memory, start=0, v=1, uicr=b""):
+    """Patched version with a mock target reading from bytes buffers."""
+    areas = [(start, memory), (0x1000_1000, uicr)]
+
+    def read_bytes(address, count):
+        for area_start, area in areas:
+            if area_start <= address < area_start + len(area):
+                offset = address - area_start
+                return area[offset:][:count]
+        raise Exception("Read from unexpected address {:#x}".format(address))
+
+    def read_memory_block8(address, count):
+        return list(read_bytes(address, count))
+
+    def read_memory_block32(address, count):
+        words = read_bytes(address, count * 4)
+        return [
+            int.from_bytes(words[i:][:4], "little")
+            for i in range(0, len(words), 4)
+        ]
+
+    mb = MicrobitMcu_instance(v=v)
+    mb.target = mock.Mock()
+    mb.target.read_memory_block8.side_effect = read_memory_block8
+    mb.target.read_memory_block32.side_effect = read_memory_block32
+    mb.target.read_memory.side_effect = lambda address, transfer_size, now: (
+        lambda: read_bytes(address, 1)[0]
+    )
+    return mb
+
+
+def MicrobitMcu_sim_core(flash, v=1, uicr=b"", stop_offset=None):
+    """Patched version with a simulated core that runs the CRC32 routine.
+
+    The core checks the routine is in RAM when it is resumed, writes the
+    zlib.crc32() of each sector into the output words and stops at the
+    routine breakpoint, or at stop_offset from the routine start.
+    """
+    mb = MicrobitMcu_fake_target(flash, v=v, uicr=uicr)
+    mb._connect()
+    ram = bytearray(b"\xaa" * 0x1000)
+    registers = {
+        name: 0x100 + i
+        for i, name in enumerate(programmer.CRC32_ROUTINE_REGISTERS)
+    }
+    core = types.SimpleNamespace(ram=ram, registers=registers, halted=False)
+    read_flash8 = mb.target.read_memory_block8.side_effect
+
+    def ram_slice(address, count):
+        offset = address - mb.mem.ram_start
+        if not 0 <= offset <= offset + count <= len(ram):
+            raise Exception(
+                "Access to unexpected address {:#x}".format(address)
+            )
+        return slice(offset, offset + count)
+
+    def read_memory_block8(address, count):
+        if address >= mb.mem.ram_start:
+            return list(ram[ram_slice(address, count)])
+        return read_flash8(address, count)
+
+    def read_memory_block32(address, count):
+        data = bytes(read_memory_block8(address, count * 4))
+        return list(struct.unpack("<{}I".format(count), data))
+
+    def write_memory_block8(address, data):
+        ram[ram_slice(address, len(data))] = bytes(data)
+
+    def write_core_registers_raw(names, values):
+        registers.update(zip(names, values))
+
+    def resume():
+        assert core.halted
+        code = bytes(ram[ram_slice(registers["pc"], 0x2C)])
+        assert code == programmer.CRC32_ROUTINE
+        assert registers["xpsr"] & programmer.XPSR_THUMB
+        assert registers["primask"] == 1
+        address, size = registers["r0"], registers["r1"]
+        crcs = [
+            zlib.crc32(flash[sector:][:size])
+            for sector in range(
+                address, address + registers["r2"] * size, size
+            )
+        ]
+        write_memory_block8(
+            registers["r3"], struct.pack("<{}I".format(len(crcs)), *crcs)
+        )
+        registers["pc"] += (
+            programmer.CRC32_ROUTINE_BKPT_OFFSET
+            if stop_offset is None
+            else stop_offset
+        )
+
+    def halt():
+        core.halted = True
+
+    mb.target.read_memory_block8.side_effect = read_memory_block8
+    mb.target.read_memory_block32.side_effect = read_memory_block32
+    mb.target.write_memory_block8.side_effect = write_memory_block8
+    mb.target.read_core_registers_raw.side_effect = lambda names: [
+        registers[name] for name in names
+    ]
+    mb.target.write_core_registers_raw.side_effect = write_core_registers_raw
+    mb.target.read_core_register.side_effect = lambda name: registers[name]
+    mb.target.halt.side_effect = halt
+    mb.target.resume.side_effect = resume
+    mb.target.is_halted.side_effect = lambda: core.halted
+    return mb, core
+
+
+def mock_session(board_id="9900"):
+    """Create a mock pyOCD session for a board ID."""
+    session = mock.Mock()
+    session.board.unique_id = board_id + "0000000000000000"
+    return session
+
+
+###############################################################################
+# MicrobitMcu.connect() and MicrobitMcu.close()
+###############################################################################
+@mock.patch(
+    "ubittool.programmer.ConnectHelper.session_with_chosen_probe",
+    autospec=True,
+)
+def test_connect_close(mock_session_with_chosen_probe):
+    """Test the connection is opened once and kept until it is closed."""
+    session = mock_session("9904")
+    mock_session_with_chosen_probe.return_value = session
+    mb = programmer.MicrobitMcu()
+
+    assert mb.connect() is mb
+    assert mb.connect() is mb
+    assert mb.memory_regions() == programmer.MEM_REGIONS_MB_V2
+    assert mb.target is session.board.target
+    assert mock_session_with_chosen_probe.call_count == 1
+    assert session.open.call_count == 1
+
+    mb.close()
+    mb.close()
+
+    assert session.close.call_count == 1
+    assert mb.session is None
+
+
+@mock.patch(
+    "ubittool.programmer.ConnectHelper.session_with_chosen_probe",
+    autospec=True,
+)
+def test_connect_incompatible_board(mock_session_with_chosen_probe):
+    """Test connecting to a board that is not a micro:bit."""
+    session = mock_session("1234")
+    mock_session_with_chosen_probe.return_value = session
+
+    with pytest.raises(Exception, match="Incompatible board ID"):
+        programmer.MicrobitMcu().connect()
+    assert session.close.call_count == 1
+
+
+###############################################################################
+# _plan_transfers() and MicrobitMcu._read_memory()
+###############################################################################
+def test_plan_transfers_aligned():
+    """Test an aligned area is read only with 32-bit transfers."""
+    assert programmer._plan_transfers(0, 256 * 1024) == [(0, 256 * 1024, 32)]
+    assert programmer._plan_transfers(0x20000000, 8) == [(0x20000000, 8, 32)]
+
+
+def test_plan_transfers_unaligned():
+    """Test the unaligned head and tail are split into byte transfers."""
+    assert programmer._plan_transfers(0x1001, 0x10) == [
+        (0x1001, 3, 8),
+        (0x1004, 0xC, 32),
+        (0x1010, 1, 8),
+    ]
+    assert programmer._plan_transfers(0x1000, 7) == [
+        (0x1000, 4, 32),
+        (0x1004, 3, 8),
+    ]
+
+
+def test_plan_transfers_small():
+    """Test areas without a full aligned word only use byte transfers."""
+    assert programmer._plan_transfers(0x1001, 2) == [(0x1001, 2, 8)]
+    assert programmer._plan_transfers(0x1003, 3) == [(0x1003, 3, 8)]
+    assert programmer._plan_transfers(0x1000, 0) == []
+
+
+def test_read_memory_transfer_widths():
+    """Test _read_memory() returns the same bytes for any alignment."""
+    memory = bytes([x for x in range(256)] * 4)
+    mb = MicrobitMcu_fake_target(memory, start=0x1000)
+
+    for address, count in ((0x1000, 1024), (0x1001, 17), (0x1002, 2)):
+        data = mb._read_memory(address=address, count=count)
+        offset = address - 0x1000
+        assert isinstance(data, bytes)
+        assert data == memory[offset:][:count]
+
+    assert mb.target.read_memory_block32.call_args_list == [
+        mock.call(0x1000, 256),
+        mock.call(0x1004, 3),
+    ]
+
+
 ###############################################################################
 # MicrobitMcu.read_flash()
 ###############################################################################
+def test_read_flash_bytes():
+    """Test the byte reads are queued before getting the results."""
+    mb = MicrobitMcu_fake_target(bytes(range(256)) * 4, start=0x1000)
+
+    result = mb.read_flash_bytes([0x1000, 0x1080, 0x13FF])
+
+    assert result == b"\x00\x80\xff"
+    assert mb.target.read_memory.call_args_list == [
+        mock.call(0x1000, transfer_size=8, now=False),
+        mock.call(0x1080, transfer_size=8, now=False),
+        mock.call(0x13FF, transfer_size=8, now=False),
+    ]
+    with pytest.raises(ValueError):
+        mb.read_flash_bytes([0x40000])
+
+
 @mock.patch.object(programmer.MicrobitMcu, "_read_memory", autospec=True)
 def test_read_flash(mock_read_memory):
     """Test read_flash() with default arguments."""
@@ -124,6 +346,93 @@ def test_read_flash_bad_count(mock_read_memory):
     assert "Cannot read a flash address out of" in str(execinfo22.value)
 
 
+###############################################################################
+# MicrobitMcu.iter_flash()
+###############################################################################
+@mock.patch.object(programmer.MicrobitMcu, "_read_memory", autospec=True)
+def test_iter_flash(mock_read_memory):
+    """Test iter_flash() reads the full flash in aligned chunks."""
+    mock_read_memory.side_effect = lambda self, address, count: bytes(count)
+    mb1 = MicrobitMcu_instance(v=1)
+    mb2 = MicrobitMcu_instance(v=2)
+
+    chunks1 = list(mb1.iter_flash())
+    chunks2 = list(mb2.iter_flash(chunk_size=64 * 1024))
+
+    assert [c[0] for c in chunks1] == list(range(0, 256 * 1024, 4 * 1024))
+    assert all(len(c[1]) == 4 * 1024 for c in chunks1)
+    assert [c[0] for c in chunks2] == list(range(0, 512 * 1024, 64 * 1024))
+    assert all(len(c[1]) == 64 * 1024 for c in chunks2)
+
+
+@mock.patch.object(programmer.MicrobitMcu, "_read_memory", autospec=True)
+def test_iter_flash_unaligned(mock_read_memory):
+    """Test iter_flash() aligns the chunks after an unaligned start."""
+    mock_read_memory.side_effect = lambda self, address, count: bytes(count)
+    mb = MicrobitMcu_instance(v=1)
+
+    chunks = list(
+        mb.iter_flash(address=0x3E010, count=0x1100, chunk_size=0x800)
+    )
+
+    assert [(c[0], len(c[1])) for c in chunks] == [
+        (0x3E010, 0x7F0),
+        (0x3E800, 0x800),
+        (0x3F000, 0x110),
+    ]
+
+
+@mock.patch.object(programmer.MicrobitMcu, "_read_memory", autospec=True)
+def test_iter_flash_progress_cancel(mock_read_memory):
+    """Test the iter_flash() progress callback and its cancellation."""
+    mock_read_memory.side_effect = lambda self, address, count: bytes(count)
+    mb = MicrobitMcu_instance(v=1)
+    progress_calls = []
+
+    def progress(read_bytes, total_bytes):
+        progress_calls.append((read_bytes, total_bytes))
+        return read_bytes >= 2048
+
+    chunks = list(
+        mb.iter_flash(count=4096, chunk_size=1024, progress=progress)
+    )
+
+    assert len(chunks) == 2
+    assert progress_calls == [(1024, 4096), (2048, 4096)]
+    assert mock_read_memory.call_count == 2
+
+
+@mock.patch.object(programmer.MicrobitMcu, "_read_memory", autospec=True)
+def test_iter_flash_bad_address(mock_read_memory):
+    """Test iter_flash() with bad arguments raises before reading."""
+    mb = MicrobitMcu_instance(v=1)
+
+    with pytest.raises(ValueError) as execinfo:
+        mb.iter_flash(address=(256 * 1024) - 10, count=11)
+
+    assert "Cannot read a flash address out of" in str(execinfo.value)
+    assert mock_read_memory.call_count == 0
+
+
+@mock.patch.object(programmer.MicrobitMcu, "_read_memory", autospec=True)
+def test_iter_ram_uicr(mock_read_memory):
+    """Test iter_ram() and iter_uicr() default to the full regions."""
+    mock_read_memory.side_effect = lambda self, address, count: bytes(count)
+    mb = MicrobitMcu_instance(v=2)
+
+    ram_chunks = list(mb.iter_ram())
+    uicr_chunks = list(mb.iter_uicr(chunk_size=0x100))
+
+    assert ram_chunks[0][0] == 0x2000_0000
+    assert sum(len(c[1]) for c in ram_chunks) == 128 * 1024
+    assert [(c[0], len(c[1])) for c in uicr_chunks] == [
+        (0x1000_1000, 0x100),
+        (0x1000_1100, 0x100),
+        (0x1000_1200, 0x100),
+        (0x1000_1300, 0x8),
+    ]
+
+
 ###############################################################################
 # MicrobitMcu.read_ram()
 ###############################################################################
@@ -346,6 +655,247 @@ def test_read_uicr_customer(mock_read_memory):
     assert result_data2 == data_bytes
 
 
+###############################################################################
+# MicrobitMcu.find_used_flash_end() and MicrobitMcu.find_micropython_end()
+###############################################################################
+def test_find_used_flash_end():
+    """Test the scan finds the end of the last page with data."""
+    flash = bytearray(b"\xff" * 0x8000)
+    flash[0x10FF] = 0x00
+    mb1 = MicrobitMcu_fake_target(bytes(flash), v=1)
+    mb2 = MicrobitMcu_fake_target(bytes(flash), v=2)
+
+    assert mb1.find_used_flash_end(count=0x8000) == 0x1400
+    # Only the erased tail and the last used page are read
+    read_words = mb1.target.read_memory_block32.call_args_list
+    assert sum(c[0][1] * 4 for c in read_words) == 0x8000 - 0x1000
+    assert mb2.find_used_flash_end(count=0x8000) == 0x2000
+    assert mb1.find_used_flash_end(address=0x1001, count=0x10FF) == 0x1400
+    assert mb1.find_used_flash_end(address=0x1000, count=0x100) == 0x1100
+    assert mb1.find_used_flash_end(address=0x1100, count=0x300) == 0x1100
+
+
+def test_find_micropython_end_uicr_layout():
+    """Test the runtime end is taken from the MicroPython UICR layout."""
+    uicr = bytearray(b"\xff" * 0x100)
+    uicr[0xC0:0xD4] = struct.pack(
+        "<IIIHHI", 0x17EEB07C, 0xFFFFFFFF, 10, 0, 0x97, 0x2F000
+    )
+    mb = MicrobitMcu_fake_target(b"", v=1, uicr=bytes(uicr))
+
+    assert mb.find_micropython_end() == 0x97 * 1024
+
+
+def test_find_micropython_end_scan():
+    """Test the flash is scanned if the UICR layout is not present."""
+    flash = b"\x00" * 0x25C00 + b"\xff" * (0x40000 - 0x25C00)
+    mb = MicrobitMcu_fake_target(flash, v=1, uicr=b"\xff" * 0x100)
+
+    assert mb.find_micropython_end() == 0x25C00
+
+
+###############################################################################
+# MicrobitMcu.flash_sector_crc32()
+###############################################################################
+def test_flash_sector_crc32():
+    """Test the CRCs are calculated by the target and its state restored."""
+    flash = bytes(range(256)) * 0x400
+    mb, core = MicrobitMcu_sim_core(flash)
+    ram, registers = bytes(core.ram), dict(core.registers)
+
+    result = mb.flash_sector_crc32(address=0x1000, count=0x1000)
+
+    assert result == [
+        zlib.crc32(flash[a:][:1024]) for a in range(0x1000, 0x2000, 1024)
+    ]
+    assert mb.flash_sector_crc32(count=0x800, sector_size=0x200) == [
+        zlib.crc32(flash[a:][:0x200]) for a in range(0, 0x800, 0x200)
+    ]
+    assert len(mb.flash_sector_crc32()) == 256
+    assert core.ram == ram
+    assert core.registers == registers
+    # Only the CRC words are transferred, not the flash sectors
+    read_bytes = mb.target.read_memory_block32.call_args_list
+    assert all(c[0][0] >= 0x2000_0000 for c in read_bytes)
+
+
+def test_flash_sector_crc32_unaligned():
+    """Test the area must be aligned to the sector size."""
+    mb, _ = MicrobitMcu_sim_core(bytes(0x40000))
+
+    with pytest.raises(ValueError, match="aligned"):
+        mb.flash_sector_crc32(address=0x200, count=0x400)
+    with pytest.raises(ValueError, match="aligned"):
+        mb.flash_sector_crc32(address=0, count=0x600)
+    assert mb.flash_sector_crc32(count=0) == []
+    mb.target.resume.assert_not_called()
+
+
+def test_flash_sector_crc32_unexpected_stop():
+    """Test the state is restored if the routine stops at the wrong place."""
+    mb, core = MicrobitMcu_sim_core(bytes(0x40000), stop_offset=4)
+    ram, registers = bytes(core.ram), dict(core.registers)
+
+    with pytest.raises(Exception, match="unexpected address 0x20000004"):
+        mb.flash_sector_crc32()
+
+    assert core.ram == ram
+    assert core.registers == registers
+
+
+###############################################################################
+# MicrobitMcu.changed_flash_sectors() and MicrobitMcu.flash_hex()
+###############################################################################
+def test_changed_flash_sectors():
+    """Test the area is extended to whole sectors and erased is expected."""
+    flash = bytearray(b"\xff" * 0x40000)
+    flash[0x800:0x810] = bytes(0x10)
+    flash[0x1000] = 0
+    image = programmer.compare.SparseImage([(bytes(0x10), 0x800)])
+    mb, _ = MicrobitMcu_sim_core(bytes(flash))
+
+    assert mb.changed_flash_sectors(image) == [0x1000]
+    assert mb.changed_flash_sectors(image, address=0x900, count=0x10) == []
+    assert mb.changed_flash_sectors(image, address=0x7FF, count=2) == []
+    assert mb.changed_flash_sectors(image, address=0xFFF, count=2) == [0x1000]
+
+
+@mock.patch("ubittool.programmer.FlashEraser", autospec=True)
+@mock.patch("ubittool.programmer.FlashLoader", autospec=True)
+def test_flash_hex_incremental(mock_loader, mock_eraser, tmp_path):
+    """Test only the sectors that differ are erased or programmed."""
+    flash = bytearray(b"\xff" * 0x40000)
+    flash[0:0x800] = bytes(range(256)) * 8
+    flash[0x3E000:0x3E010] = b"MP" + bytes(14)
+    hex_data = bytearray(flash[:0x3F000])
+    hex_data[0x3E004] = 1
+    hex_data[0x400:0x800] = b"\xff" * 0x400
+    hex_path = tmp_path / "new.hex"
+    hex_path.write_text(
+        "".join(programmer.formats.intel_hex_lines([(hex_data, 0)]))
+    )
+    mb, _ = MicrobitMcu_sim_core(bytes(flash))
+
+    mb.flash_hex(str(hex_path), incremental=True)
+
+    mock_eraser.return_value.erase.assert_called_once_with([0x400])
+    mock_loader.return_value.add_data.assert_called_once_with(
+        0x3E000, bytes(hex_data[0x3E000:0x3E400])
+    )
+    assert mock_loader.return_value.commit.call_count == 1
+    mb.target.mass_erase.assert_not_called()
+    assert mb.target.reset.call_count == 1
+
+
+@mock.patch("ubittool.programmer.FlashEraser", autospec=True)
+@mock.patch("ubittool.programmer.FlashLoader", autospec=True)
+def test_flash_hex_incremental_uicr(mock_loader, mock_eraser, tmp_path):
+    """Test the full chip is erased if the UICR data differs."""
+    flash = b"\xff" * 0x40000
+    hex_path = tmp_path / "new.hex"
+    hex_path.write_text(
+        "".join(
+            programmer.formats.intel_hex_lines(
+                [(b"\x00" * 4, 0), (b"\x00" * 4, 0x1000_10C0)]
+            )
+        )
+    )
+    mb, _ = MicrobitMcu_sim_core(flash, uicr=b"\xff" * 0x100)
+
+    mb.flash_hex(str(hex_path), incremental=True)
+
+    mock_eraser.return_value.erase.assert_not_called()
+    mb.target.mass_erase.assert_called_once_with()
+    mock_loader.assert_called_once_with(mb.session)
+    assert mock_loader.return_value.add_data.call_args_list == [
+        mock.call(0, b"\x00" * 4),
+        mock.call(0x1000_10C0, b"\x00" * 4),
+    ]
+    assert mock_loader.return_value.commit.call_count == 1
+    assert mb.target.reset.call_count == 1
+
+
+@mock.patch("ubittool.programmer.FlashLoader", autospec=True)
+def test_flash_hex_sections_skip_matching(mock_loader):
+    """Test a board with the same contents is not flashed or reset."""
+    flash = b"\x00" * 4 + b"\xff" * (0x40000 - 4)
+    mb, _ = MicrobitMcu_sim_core(flash)
+    timings = {}
+
+    flashed = mb.flash_hex_sections(
+        {None: [(b"\x00" * 4, 0)]}, timings=timings, skip_matching=True
+    )
+
+    assert flashed is False
+    assert sorted(timings) == ["compare", "connect"]
+    mock_loader.assert_not_called()
+    mb.target.mass_erase.assert_not_called()
+    mb.target.reset.assert_not_called()
+
+    flashed = mb.flash_hex_sections(
+        {None: [(b"\x01" * 4, 0)]}, timings=timings, skip_matching=True
+    )
+
+    assert flashed is True
+    mb.target.mass_erase.assert_called_once_with()
+    mock_loader.return_value.add_data.assert_called_once_with(0, b"\x01" * 4)
+    assert mb.target.reset.call_count == 1
+
+
+@mock.patch("ubittool.programmer.FlashLoader", autospec=True)
+def test_flash_hex_sections_timings(mock_loader):
+    """Test the time taken by each stage is recorded."""
+    mb, _ = MicrobitMcu_sim_core(b"\xff" * 0x40000)
+    timings = {"queue": 1.0}
+
+    mb.flash_hex_sections({None: [(b"\x00" * 4, 0)]}, timings=timings)
+
+    assert sorted(timings) == ["connect", "erase", "program", "queue", "reset"]
+    assert timings["queue"] == 1.0
+    mock_loader.return_value.add_data.assert_called_once_with(0, b"\x00" * 4)
+
+
+def test_timed_stage_timings():
+    """Test the stage running is kept as the current one of StageTimings."""
+    timings = programmer.StageTimings()
+
+    with programmer._timed(timings, "erase"):
+        assert timings.current == "erase"
+        with programmer._timed(timings, "program"):
+            assert timings.current == "program"
+        assert timings.current == "erase"
+
+    assert timings.current is None
+    assert sorted(timings) == ["erase", "program"]
+
+
+def test_hex_image():
+    """Test the Universal Hex section for the board memory layout is used."""
+    sections = {
+        None: [(b"\x01", 0x10)],
+        "9900": [(b"\x02", 0x20)],
+        "9903": [(b"\x03", 0x30)],
+    }
+
+    assert programmer.hex_image(sections, "9901").areas == [
+        (b"\x01", 0x10),
+        (b"\x02", 0x20),
+    ]
+    assert programmer.hex_image(sections, "9903").areas == [
+        (b"\x01", 0x10),
+        (b"\x03", 0x30),
+    ]
+    assert programmer.hex_image(sections, "9906").areas == [
+        (b"\x01", 0x10),
+        (b"\x03", 0x30),
+    ]
+    assert programmer.hex_image({None: [(b"\x01", 0)]}, "9903").areas == [
+        (b"\x01", 0)
+    ]
+    with pytest.raises(ValueError, match="board ID 9906"):
+        programmer.hex_image({"9900": [(b"\x02", 0x20)]}, "9906")
+
+
 ###############################################################################
 # find_microbit_ids()
 ###############################################################################
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for scheduler.py module."""
+from ubittool import scheduler
+
+
+def test_start_ready_limits():
+    """Test the boards started are limited in total and per hub."""
+    hubs = {"a": "1-1", "b": "1-1", "c": "1-2", "d": None, "e": "1-2"}
+    batch_scheduler = scheduler.BatchScheduler(
+        3, max_per_hub=1, hub_of=hubs.get
+    )
+    for board_id in hubs:
+        assert batch_scheduler.add(board_id, now=0) is True
+    assert batch_scheduler.add("a", now=0) is False
+
+    assert batch_scheduler.start_ready(hubs, now=2) == [
+        ("a", 2),
+        ("c", 2),
+        ("d", 2),
+    ]
+    assert batch_scheduler.start_ready(hubs, now=3) == []
+
+    batch_scheduler.finish("a", now=3)
+    assert batch_scheduler.start_ready(hubs, now=3) == [("b", 3)]
+
+
+def test_start_ready_connected():
+    """Test the boards not connected are not started."""
+    batch_scheduler = scheduler.BatchScheduler(4)
+    batch_scheduler.add("a", now=0)
+    batch_scheduler.add("b", now=0)
+
+    assert batch_scheduler.start_ready(["b"], now=0) == [("b", 0)]
+    assert batch_scheduler.boards["a"].state == scheduler.STATE_PENDING
+    assert batch_scheduler.boards["b"].state == scheduler.STATE_ACTIVE
+
+
+def test_finish_retry_backoff():
+    """Test the retries are delayed exponentially until the attempts cap."""
+    batch_scheduler = scheduler.BatchScheduler(
+        1, max_attempts=4, retry_delay=1, max_retry_delay=3
+    )
+    batch_scheduler.add("a", now=0)
+    now = 0
+    delays = []
+    for _ in range(3):
+        assert batch_scheduler.start_ready(["a"], now=now) == [("a", 0)]
+        board = batch_scheduler.finish("a", error="Failed", now=now)
+        assert board.state == scheduler.STATE_RETRY
+        delays.append(board.backoff)
+        assert batch_scheduler.next_retry(["a"], now=now) == board.backoff
+        assert batch_scheduler.start_ready(["a"], now=now) == []
+        now = board.ready_at
+
+    assert delays == [1, 2, 3]
+    batch_scheduler.start_ready(["a"], now=now)
+    board = batch_scheduler.finish("a", error="Failed again", now=now)
+    assert board.state == scheduler.STATE_GAVE_UP
+    assert board.attempts == 4
+    assert batch_scheduler.next_retry(["a"], now=now) is None
+    assert batch_scheduler.start_ready(["a"], now=now + 100) == []
+
+
+def test_next_retry_no_free_slot():
+    """Test the retries that cannot start are not reported as due."""
+    batch_scheduler = scheduler.BatchScheduler(2)
+    for board_id in "abc":
+        batch_scheduler.add(board_id, now=0)
+    batch_scheduler.start_ready("abc", now=0)
+    batch_scheduler.finish("a", error="Failed", now=0)
+    assert batch_scheduler.start_ready("abc", now=0) == [("c", 0)]
+
+    assert batch_scheduler.start_ready("abc", now=5) == []
+    assert batch_scheduler.next_retry("abc", now=5) is None
+
+    batch_scheduler.finish("b", now=5)
+    assert batch_scheduler.next_retry("abc", now=5) == 0
+    assert batch_scheduler.next_retry("bc", now=5) is None
+
+
+def test_next_retry_hub_full():
+    """Test the retries of a hub at its limit are not reported as due."""
+    hubs = {"a": "1-1", "b": "1-1", "c": "1-2"}
+    batch_scheduler = scheduler.BatchScheduler(
+        3, max_per_hub=1, hub_of=hubs.get
+    )
+    for board_id in hubs:
+        batch_scheduler.add(board_id, now=0)
+    batch_scheduler.start_ready(hubs, now=0)
+    batch_scheduler.finish("a", error="Failed", now=0)
+    batch_scheduler.start_ready(hubs, now=0)
+
+    assert batch_scheduler.start_ready(hubs, now=5) == []
+    assert batch_scheduler.next_retry(hubs, now=5) is None
+
+
+def test_attempt_disconnected():
+    """Test a retry due for a board not connected counts as an attempt."""
+    batch_scheduler = scheduler.BatchScheduler(1, max_attempts=2)
+    batch_scheduler.add("a", now=0)
+    batch_scheduler.start_ready(["a"], now=0)
+    batch_scheduler.finish("a", error="Failed", now=0)
+
+    assert batch_scheduler.next_retry([], now=0) is None
+    assert batch_scheduler.attempt_disconnected([], now=0.5) == []
+    assert batch_scheduler.attempt_disconnected(["a"], now=1) == []
+    assert batch_scheduler.attempt_disconnected([], now=1) == ["a"]
+    assert batch_scheduler.boards["a"].attempts == 2
+
+    board = batch_scheduler.finish(
+        "a", error=scheduler.NOT_CONNECTED_ERROR, now=1
+    )
+
+    assert board.state == scheduler.STATE_GAVE_UP
+    assert batch_scheduler.attempt_disconnected([], now=100) == []
+
+
+def test_outcome_table():
+    """Test the table has a line per board with its final result."""
+    batch_scheduler = scheduler.BatchScheduler(
+        2, max_attempts=1, hub_of={"a": "1-2"}.get
+    )
+    batch_scheduler.add("a", now=0)
+    batch_scheduler.add("b", now=0)
+    batch_scheduler.start_ready(["a", "b"], now=0)
+    batch_scheduler.finish("a", now=1)
+    batch_scheduler.finish("b", error="No board", now=1)
+
+    lines = batch_scheduler.outcome_table().splitlines()
+
+    assert lines[0].split() == ["Board", "Hub", "Attempts", "Result"]
+    assert lines[1].split() == ["a", "1-2", "1", "ok"]
+    assert lines[2].split() == ["b", "-", "1", "gave", "up", "(No", "board)"]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for watchdog.py module."""
+import multiprocessing
+
+import pytest
+
+from ubittool import watchdog
+
+
+def create_watchdog(**kwargs):
+    """Create a BatchWatchdog watching a board from time 0."""
+    slots = watchdog.HeartbeatSlots(multiprocessing.get_context(), 2)
+    batch_watchdog = watchdog.BatchWatchdog(slots, **kwargs)
+    slot, task_id = batch_watchdog.start("9900", now=0)
+    return slots, batch_watchdog, slot, task_id
+
+
+def test_heartbeat_slots():
+    """Test each slot keeps the last heartbeat written in it."""
+    slots = watchdog.HeartbeatSlots(multiprocessing.get_context(), 2)
+
+    slots.write(1, 7, 1234, "program", {"queue": 0.5, "connect": 2})
+    slots.write(1, 7, 1234, None, {"queue": 0.5, "program": 3})
+
+    assert slots.read(0) == watchdog.Heartbeat(0, 0, 0, None, {})
+    assert slots.read(1) == watchdog.Heartbeat(
+        7, 1234, 2, None, {"queue": 0.5, "program": 3}
+    )
+    slots.clear(1)
+    assert slots.read(1)[:3] == (0, 0, 2)
+    slots.assign(1, 8)
+    assert slots.read(1)[:3] == (8, 0, 2)
+
+
+def test_start_slots():
+    """Test each board being watched gets a different slot and task ID."""
+    _, batch_watchdog, slot, task_id = create_watchdog()
+
+    assert batch_watchdog.start("9901") == (1, 2)
+    with pytest.raises(Exception, match="no free heartbeat slots"):
+        batch_watchdog.start("9902")
+    batch_watchdog.forget("9900")
+    assert batch_watchdog.start("9902") == (0, 3)
+
+
+def test_stage_timeout():
+    """Test a board times out when a stage takes longer than its timeout."""
+    slots, batch_watchdog, slot, task_id = create_watchdog(
+        stage_timeouts={"program": 20}
+    )
+    slots.write(slot, task_id, 1234, "connect", {"queue": 0.5})
+    batch_watchdog.receive(now=1)
+    slots.write(slot, task_id, 1234, "program", {"queue": 0.5, "connect": 2})
+    batch_watchdog.receive(now=3)
+
+    for now in range(4, 24):
+        slots.write(slot, task_id, 1234, "program", {"queue": 0.5})
+        batch_watchdog.receive(now=now)
+        assert batch_watchdog.expired(now=now) == []
+
+    assert batch_watchdog.stage_timeouts["reset"] == 10
+    expired = batch_watchdog.expired(now=24)
+    assert expired == [
+        watchdog.Expired(
+            "9900",
+            1234,
+            {"queue": 0.5, "program": 21},
+            "Timed out in the program stage after 21 s",
+            slot,
+            task_id,
+        )
+    ]
+    assert batch_watchdog.is_running(expired[0])
+    slots.clear(slot)
+    assert not batch_watchdog.is_running(expired[0])
+
+
+def test_heartbeat_timeout():
+    """Test a board times out when its worker stops writing heartbeats."""
+    slots, batch_watchdog, slot, task_id = create_watchdog(heartbeat_timeout=5)
+    slots.write(slot, task_id, 1234, None, {"queue": 0.5, "connect": 2})
+    batch_watchdog.receive(now=2)
+    # The same heartbeat read again is not a new one
+    batch_watchdog.receive(now=6)
+
+    assert batch_watchdog.expired(now=7) == []
+    assert batch_watchdog.expired(now=8) == [
+        watchdog.Expired(
+            "9900",
+            1234,
+            {"queue": 0.5, "connect": 2},
+            "No heartbeat from the worker for 6 s",
+            slot,
+            task_id,
+        )
+    ]
+
+
+def test_waiting_for_worker():
+    """Test a board without heartbeats does not time out."""
+    slots, batch_watchdog, slot, task_id = create_watchdog(heartbeat_timeout=5)
+
+    # The slot assigned to the board is not a heartbeat
+    assert slots.read(slot)[:2] == (task_id, 0)
+    batch_watchdog.receive(now=1)
+    assert batch_watchdog.expired(now=100) == []
+
+    slots.write(slot, task_id, 1234, "connect", {"queue": 99})
+    batch_watchdog.receive(now=100)
+    assert batch_watchdog.expired(now=105) == []
+    assert [e.pid for e in batch_watchdog.expired(now=106)] == [1234]
+
+
+def test_other_task_heartbeats():
+    """Test the heartbeats written by a different task are ignored."""
+    slots, batch_watchdog, slot, task_id = create_watchdog(heartbeat_timeout=5)
+    slots.write(slot, task_id, 1234, "connect", {})
+    batch_watchdog.receive(now=1)
+    slots.write(slot, task_id + 1, 1235, "connect", {})
+    batch_watchdog.receive(now=2)
+
+    expired = batch_watchdog.expired(now=7)
+
+    assert [(e.board_id, e.pid) for e in expired] == [("9900", 1234)]
+    assert not batch_watchdog.is_running(expired[0])
+
+
+def test_forget():
+    """Test the boards with a result are not watched."""
+    slots, batch_watchdog, slot, task_id = create_watchdog(heartbeat_timeout=5)
+    slots.write(slot, task_id, 1234, "connect", {})
+    batch_watchdog.receive(now=1)
+
+    batch_watchdog.forget("9900")
+    batch_watchdog.forget("9901")
+
+    assert batch_watchdog.expired(now=100) == []
+    # A task of the board still waiting for a worker finds its slot cleared
+    assert slots.read(slot).task_id == 0
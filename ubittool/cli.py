@@ -3,27 +3,34 @@
 """CLI and GUI utility to read content from the micro:bit."""
 import os
 import sys
+import inspect
+from importlib.util import find_spec
 
 import click
 
 from ubittool import __version__
-from ubittool.cmds import (
-    read_flash_hex,
-    read_flash_uicr_hex,
-    read_python_code,
-    flash_drag_n_drop,
-    batch_flash_hex,
-    compare_full_flash_hex,
+from ubittool.formats import IMAGE_FORMATS
+from ubittool.metrics import METRICS_FORMATS
+from ubittool.scheduler import MAX_ATTEMPTS
+from ubittool.watchdog import (
+    HEARTBEAT_INTERVAL,
+    HEARTBEAT_TIMEOUT,
+    STAGE_TIMEOUTS,
+)
+from ubittool.daemon import (
+    SOCKET_ENV_VAR,
+    DEFAULT_SOCKET_PATH,
+    FILES_COMMANDS,
+    Daemon,
+    call as daemon_call,
+    decode_files,
 )
 
 # GUI depends on tkinter, which could be packaged separately from Python or
-# excluded from CLI-only packing, but the other CLI commands should still work
-try:
-    from ubittool.gui import open_gui
-
-    GUI_AVAILABLE = True
-except ImportError:  # pragma: no cover
-    GUI_AVAILABLE = False
+# excluded from CLI-only packing, but the other CLI commands should still work.
+# The modules are only imported by the commands using them, as pyOCD and
+# tkinter take most of the start up time, even for the --help output.
+GUI_AVAILABLE = all(find_spec(name) for name in ("tkinter", "_tkinter"))
 
 
 @click.group(help="uBitTool v{}.\n\n{}".format(__version__, __doc__))
@@ -32,6 +39,59 @@ def cli():
     pass
 
 
+class _EchoStream(object):
+    """Writable text stream that prints to the console with click."""
+
+    def write(self, text):
+        """Print the text without adding a new line."""
+        click.echo(text, nl=False)
+
+
+# Arguments of the cmds functions with file paths, which are converted to
+# absolute paths when they are sent to the daemon
+_PATH_ARGUMENTS = ("output", "file_path", "hex_file_path", "path_to_hex")
+
+
+def _run(function, *args, **kwargs):
+    """Run a cmds function, in the daemon if its socket path is configured.
+
+    When the SOCKET_ENV_VAR environmental variable is set the function is run
+    by the daemon, and if the output argument is a stream the text returned
+    by the daemon is written into it. The files returned by the daemon are
+    decoded into the same result as the function.
+
+    :param function: The cmds function to run, its positional arguments are
+        sent by their parameter names.
+    :param args: Positional arguments for the function.
+    :param kwargs: Keyword arguments for the function.
+    :return: The result from the function.
+    """
+    socket_path = os.environ.get(SOCKET_ENV_VAR)
+    if not socket_path:
+        return function(*args, **kwargs)
+    # The keyword arguments are sent as they are, as binding them would nest
+    # the ones for a **kwargs parameter under its name
+    arguments = dict(
+        inspect.signature(function).bind_partial(*args).arguments, **kwargs
+    )
+    stream = None
+    for name in _PATH_ARGUMENTS:
+        value = arguments.get(name)
+        if isinstance(value, str):
+            arguments[name] = os.path.abspath(value)
+        elif name == "output" and value is not None:
+            stream, arguments[name] = value, None
+    result = daemon_call(
+        function.__name__, socket_path=socket_path, **arguments
+    )
+    if stream is not None:
+        stream.write(result)
+        return None
+    if function.__name__ in FILES_COMMANDS:
+        return decode_files(result)
+    return result
+
+
 def _file_checker(subject, file_path):
     """Check if a file exists and informs user about content output.
 
@@ -53,6 +113,89 @@ def _file_checker(subject, file_path):
         click.echo("{} will be output to console.".format(subject))
 
 
+def _format_checker(
+    image_format, file_path, hex_options=None, binary_options=None
+):
+    """Check the output options can be used with the output format.
+
+    :param image_format: String with the output format selected.
+    :param file_path: Path to the output file, or None for the console.
+    :param hex_options: Dictionary with the names and values of the options
+        only valid for the hex format.
+    :param binary_options: Dictionary with the names and values of the
+        options only valid for the binary formats.
+    """
+    if image_format == "hex":
+        invalid_options, valid_formats = binary_options or {}, "binary formats"
+    else:
+        invalid_options, valid_formats = hex_options or {}, "hex format"
+    errors = [
+        "The {} option can only be used with the {}.".format(
+            name, valid_formats
+        )
+        for name, value in sorted(invalid_options.items())
+        if value
+    ]
+    if image_format != "hex" and not file_path:
+        errors.insert(
+            0,
+            "The {} format can only be written to a file.".format(
+                image_format
+            ),
+        )
+    if errors:
+        click.echo(
+            click.style("Abort: {}", fg="red").format(errors[0]), err=True
+        )
+        sys.exit(1)
+
+
+def _format_option(function):
+    """Add the output format option to a click command.
+
+    :param function: The click command function to decorate.
+    :return: The decorated function.
+    """
+    return click.option(
+        "--format",
+        "image_format",
+        type=click.Choice(("hex",) + IMAGE_FORMATS),
+        default="hex",
+        show_default=True,
+        help="Output format, the binary formats need a file path.",
+    )(function)
+
+
+def _parse_stage_timeouts(ctx, param, values):
+    """Convert the STAGE=SECONDS values of a click option into a dictionary.
+
+    :param ctx: The click context.
+    :param param: The click option.
+    :param values: Tuple with the strings given to the option.
+    :return: Dictionary with the seconds of each stage, or None if empty.
+    """
+    stage_timeouts = {}
+    for value in values:
+        stage, _, seconds = value.partition("=")
+        if stage not in STAGE_TIMEOUTS:
+            raise click.BadParameter(
+                "Unknown stage '{}', it must be one of: {}".format(
+                    stage, ", ".join(STAGE_TIMEOUTS)
+                )
+            )
+        try:
+            stage_timeouts[stage] = float(seconds)
+        except ValueError:
+            raise click.BadParameter(
+                "Invalid number of seconds in '{}'".format(value)
+            )
+        if stage_timeouts[stage] <= 0:
+            raise click.BadParameter(
+                "The timeout in '{}' must be positive".format(value)
+            )
+    return stage_timeouts or None
+
+
 @cli.command()
 @click.option(
     "-f",
@@ -63,12 +206,14 @@ def _file_checker(subject, file_path):
 )
 def read_code(file_path=None):
     """Extract the MicroPython code to a file or print it."""
+    from ubittool import cmds
+
     click.echo("Executing: {}\n".format(read_code.__doc__))
     _file_checker("MicroPython code", file_path)
 
     click.echo("Reading the micro:bit flash contents...")
     try:
-        python_code = read_python_code()
+        python_code = _run(cmds.read_python_code)
     except Exception as e:
         click.echo(click.style("Error: {}", fg="red").format(e), err=True)
         sys.exit(1)
@@ -86,6 +231,94 @@ def read_code(file_path=None):
     click.echo("\nFinished successfully!")
 
 
+@cli.command()
+@click.option(
+    "-d",
+    "--dir_path",
+    "dir_path",
+    type=click.Path(file_okay=False),
+    help="Path to the output directory to write the MicroPython files.",
+)
+def read_files(dir_path=None):
+    """Extract the files from the MicroPython V2 filesystem."""
+    from ubittool import cmds
+
+    click.echo("Executing: {}\n".format(read_files.__doc__))
+    if dir_path:
+        click.echo("MicroPython files will be written to: {}".format(dir_path))
+    else:
+        click.echo("MicroPython files will be output to console.")
+
+    click.echo("Reading the micro:bit filesystem...")
+    try:
+        files = _run(cmds.read_micropython_files)
+    except Exception as e:
+        click.echo(click.style("Error: {}", fg="red").format(e), err=True)
+        sys.exit(1)
+    click.echo("Found {} files.".format(len(files)))
+
+    if dir_path:
+        file_paths = [
+            os.path.join(dir_path, os.path.basename(f.name)) for f in files
+        ]
+        for file_path in file_paths:
+            if os.path.exists(file_path):
+                click.echo(
+                    click.style(
+                        "Abort: The {} file already exists.", fg="red"
+                    ).format(file_path),
+                    err=True,
+                )
+                sys.exit(1)
+        os.makedirs(dir_path, exist_ok=True)
+        for file_path, mpy_file in zip(file_paths, files):
+            click.echo("Saving {}...".format(file_path))
+            with open(file_path, "wb") as output_file:
+                output_file.write(mpy_file.data)
+    else:
+        for mpy_file in files:
+            click.echo(
+                "---------------- {} ----------------".format(mpy_file.name)
+            )
+            click.echo(mpy_file.data.decode("utf-8", errors="replace"))
+        click.echo("----------------------------------------")
+
+    click.echo("\nFinished successfully!")
+
+
+@cli.command()
+@click.option(
+    "-f",
+    "--file_path",
+    "file_path",
+    type=click.Path(),
+    required=True,
+    help="Path to the MicroPython script to write into the micro:bit.",
+)
+def write_code(file_path):
+    """Write a MicroPython script into a micro:bit with MicroPython."""
+    from ubittool import cmds
+
+    click.echo("Executing: {}\n".format(write_code.__doc__))
+    if not os.path.isfile(file_path):
+        click.echo(
+            click.style("Abort: File does not exists", fg="red"), err=True
+        )
+        sys.exit(1)
+
+    with open(file_path, encoding="utf-8") as python_file:
+        python_code = python_file.read()
+    click.echo("Writing the MicroPython code into the micro:bit flash...")
+    try:
+        sectors = _run(cmds.flash_python_code, python_code)
+    except Exception as e:
+        click.echo(click.style("Error: {}", fg="red").format(e), err=True)
+        sys.exit(1)
+    click.echo("Programmed {} flash pages.".format(sectors))
+
+    click.echo("\nFinished successfully!")
+
+
 @cli.command(
     short_help="Read the micro:bit flash contents into a hex file or console."
 )
@@ -96,28 +329,71 @@ def read_code(file_path=None):
     type=click.Path(),
     help="Path to the output file to write micro:bit flash content.",
 )
-def read_flash(file_path=None):
+@click.option(
+    "-p",
+    "--pretty",
+    "pretty",
+    is_flag=True,
+    help="Output a hex dump with an ASCII column instead of Intel Hex.",
+)
+@click.option(
+    "--collapse-erased",
+    "collapse_erased",
+    is_flag=True,
+    help="In the hex dump, replace repeated erased lines with a '*' line.",
+)
+@click.option(
+    "--trim-erased",
+    "trim_erased",
+    is_flag=True,
+    help="Leave out the flash pages that are erased.",
+)
+@_format_option
+def read_flash(
+    file_path=None,
+    pretty=False,
+    collapse_erased=False,
+    trim_erased=False,
+    image_format="hex",
+):
     """Read the micro:bit flash contents into a hex file or console."""
+    from ubittool import cmds
+
     click.echo("Executing: {}\n".format(read_flash.__doc__))
-    _file_checker("micro:bit flash hex", file_path)
+    _format_checker(
+        image_format,
+        file_path,
+        hex_options={"--pretty": pretty, "--collapse-erased": collapse_erased},
+    )
+    _file_checker("micro:bit flash {}".format(image_format), file_path)
 
     click.echo("Reading the micro:bit flash contents...")
+    hex_format = {
+        "decode_hex": pretty,
+        "collapse_erased": collapse_erased,
+        "trim_erased": trim_erased,
+    }
     try:
-        flash_data = read_flash_hex()
+        if image_format != "hex":
+            click.echo("Saving the flash contents...")
+            _run(
+                cmds.write_memory_image,
+                file_path,
+                image_format,
+                trim_erased=trim_erased,
+            )
+        elif file_path:
+            click.echo("Saving the flash contents...")
+            _run(cmds.write_flash_hex, file_path, **hex_format)
+        else:
+            click.echo("Printing the flash contents")
+            click.echo("----------------------------------------")
+            _run(cmds.write_flash_hex, _EchoStream(), **hex_format)
+            click.echo("----------------------------------------")
     except Exception as e:
         click.echo(click.style("Error: {}", fg="red").format(e), err=True)
         sys.exit(1)
 
-    if file_path:
-        click.echo("Saving the flash contents...")
-        with open(file_path, "w") as hex_file:
-            hex_file.write(flash_data)
-    else:
-        click.echo("Printing the flash contents")
-        click.echo("----------------------------------------")
-        click.echo(flash_data)
-        click.echo("----------------------------------------")
-
     click.echo("\nFinished successfully!")
 
 
@@ -131,28 +407,59 @@ def read_flash(file_path=None):
     type=click.Path(),
     help="Path to the output file to write micro:bit flash content.",
 )
-def read_flash_uicr(file_path=None):
+@click.option(
+    "--trim-erased",
+    "trim_erased",
+    is_flag=True,
+    help="Leave out the flash pages that are erased.",
+)
+@click.option(
+    "--ram",
+    "ram",
+    is_flag=True,
+    help="Include the RAM contents, only for the binary formats.",
+)
+@_format_option
+def read_flash_uicr(
+    file_path=None, trim_erased=False, ram=False, image_format="hex"
+):
     """Read the micro:bit flash and UICR into a hex file or console."""
+    from ubittool import cmds
+
     click.echo("Executing: {}\n".format(read_flash_uicr.__doc__))
-    _file_checker("micro:bit flash and UICR hex", file_path)
+    _format_checker(image_format, file_path, binary_options={"--ram": ram})
+    _file_checker(
+        "micro:bit flash and UICR {}".format(image_format), file_path
+    )
 
     click.echo("Reading the micro:bit flash and UICR contents...")
     try:
-        flash_data = read_flash_uicr_hex()
+        if image_format != "hex":
+            click.echo("Saving the flash and UICR contents...")
+            _run(
+                cmds.write_memory_image,
+                file_path,
+                image_format,
+                uicr=True,
+                ram=ram,
+                trim_erased=trim_erased,
+            )
+        elif file_path:
+            click.echo("Saving the flash and UICR contents...")
+            _run(cmds.write_flash_uicr_hex, file_path, trim_erased=trim_erased)
+        else:
+            click.echo("Printing the flash and UICR contents")
+            click.echo("----------------------------------------")
+            _run(
+                cmds.write_flash_uicr_hex,
+                _EchoStream(),
+                trim_erased=trim_erased,
+            )
+            click.echo("----------------------------------------")
     except Exception as e:
         click.echo(click.style("Error: {}", fg="red").format(e), err=True)
         sys.exit(1)
 
-    if file_path:
-        click.echo("Saving the flash and UICR contents...")
-        with open(file_path, "w") as hex_file:
-            hex_file.write(flash_data)
-    else:
-        click.echo("Printing the flash and UICR contents")
-        click.echo("----------------------------------------")
-        click.echo(flash_data)
-        click.echo("----------------------------------------")
-
     click.echo("\nFinished successfully!")
 
 
@@ -165,12 +472,28 @@ def read_flash_uicr(file_path=None):
     required=True,
     help="Path to the hex file to compare against the micro:bit.",
 )
-def compare(file_path):
+@click.option(
+    "--max-diffs",
+    "max_diffs",
+    type=click.IntRange(min=1),
+    help="Stop reading the flash after this many differences are found, "
+    "without generating a report.",
+)
+@click.option(
+    "--crc",
+    is_flag=True,
+    help="Calculate the CRC32 of each flash page in the micro:bit and only "
+    "read the pages that differ.",
+)
+def compare(file_path, max_diffs=None, crc=False):
     """Compare the micro:bit flash contents with a hex file.
 
     Opens the default browser to display an HTML page with the comparison
-    output.
+    output, unless a maximum number of differences is given, in which case
+    only the result of the check is shown.
     """
+    from ubittool import cmds
+
     click.echo("Executing: Compare the micro:bit flash with a hex file.\n")
     if not file_path or not os.path.isfile(file_path):
         click.echo(
@@ -180,11 +503,17 @@ def compare(file_path):
 
     click.echo("Reading the micro:bit flash contents...")
     try:
-        exit_code = compare_full_flash_hex(file_path)
+        if max_diffs:
+            exit_code = _run(
+                cmds.check_flash_hex, file_path, max_diffs=max_diffs, crc=crc
+            )
+        else:
+            exit_code = cmds.compare_full_flash_hex(file_path, crc=crc)
     except Exception as e:
         click.echo(click.style("Error: {}", fg="red").format(e), err=True)
         sys.exit(1)
-    click.echo("Diff output loaded in the default browser.")
+    if not max_diffs:
+        click.echo("Diff output loaded in the default browser.")
 
     if exit_code:
         click.echo("\nThere are some differences in the micro:bit flash!")
@@ -220,6 +549,8 @@ def flash_compare(compare_file_path, input_file_path):
     Opens the default browser to display an HTML page with the comparison
     output.
     """
+    from ubittool import cmds
+
     click.echo("Executing: Compare the micro:bit flash with a hex file.\n")
     abort = "Abort: File '{}' does not exists"
     if not input_file_path or not os.path.isfile(input_file_path):
@@ -237,9 +568,9 @@ def flash_compare(compare_file_path, input_file_path):
         click.echo(
             "Copying '{}' file to MICROBIT drive...".format(input_file_path)
         )
-        flash_drag_n_drop(input_file_path)
+        cmds.flash_drag_n_drop(input_file_path)
         click.echo("Reading the micro:bit flash contents...")
-        compare_full_flash_hex(compare_file_path)
+        cmds.compare_full_flash_hex(compare_file_path)
     except Exception as e:
         click.echo(click.style("Error: {}", fg="red").format(e), err=True)
         sys.exit(1)
@@ -257,8 +588,95 @@ def flash_compare(compare_file_path, input_file_path):
     required=True,
     help="Path to the hex file to flash into all micro:bits.",
 )
-def batch_flash(file_path):
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only erase and program the flash pages that differ from the hex "
+    "file, instead of erasing the full chip.",
+)
+@click.option(
+    "--workers",
+    "workers",
+    type=click.IntRange(min=1),
+    help="Number of micro:bits to flash at the same time.  [default: 8]",
+)
+@click.option(
+    "--metrics-file",
+    "metrics_path",
+    type=click.Path(),
+    help="Path to the output file to write the timing of each flash stage.",
+)
+@click.option(
+    "--metrics-format",
+    "metrics_format",
+    type=click.Choice(METRICS_FORMATS),
+    default="jsonl",
+    show_default=True,
+    help="Format of the metrics file, JSON lines or CSV.",
+)
+@click.option(
+    "--max-per-hub",
+    "max_per_hub",
+    type=click.IntRange(min=1),
+    help="Number of micro:bits to flash at the same time in each USB hub, "
+    "only in Linux.",
+)
+@click.option(
+    "--max-attempts",
+    "max_attempts",
+    type=click.IntRange(min=1),
+    default=MAX_ATTEMPTS,
+    show_default=True,
+    help="Number of times a micro:bit is flashed before giving up.",
+)
+@click.option(
+    "--stage-timeout",
+    "stage_timeouts",
+    multiple=True,
+    metavar="STAGE=SECONDS",
+    callback=_parse_stage_timeouts,
+    help="Maximum seconds a flashing stage can take, it can be used several "
+    "times. Stages: {}.".format(", ".join(STAGE_TIMEOUTS)),
+)
+@click.option(
+    "--heartbeat-timeout",
+    "heartbeat_timeout",
+    # Some heartbeats can be delayed while the worker is busy
+    type=click.FloatRange(min=2 * HEARTBEAT_INTERVAL),
+    default=HEARTBEAT_TIMEOUT,
+    show_default=True,
+    help="Seconds without a heartbeat from the worker flashing a micro:bit "
+    "before it is terminated.",
+)
+@click.option(
+    "--skip-matching",
+    is_flag=True,
+    help="Compare each micro:bit with the hex file first, and do not flash "
+    "it if they match.",
+)
+@click.option(
+    "--journal",
+    "journal_path",
+    type=click.Path(dir_okay=False),
+    help="SQLite file to remember the micro:bits flashed, the ones flashed "
+    "with the same hex file are only flashed if they do not match it.",
+)
+def batch_flash(
+    file_path,
+    incremental=False,
+    workers=None,
+    metrics_path=None,
+    metrics_format="jsonl",
+    max_per_hub=None,
+    max_attempts=MAX_ATTEMPTS,
+    stage_timeouts=None,
+    heartbeat_timeout=HEARTBEAT_TIMEOUT,
+    skip_matching=False,
+    journal_path=None,
+):
     """Flash any micro:bit connected until Ctrl+C is pressed."""
+    from ubittool import cmds
+
     click.echo("Executing: Batch flash of hex files")
     if not file_path or not os.path.isfile(file_path):
         click.echo(
@@ -270,10 +688,57 @@ def batch_flash(file_path):
         f"Any micro:bit connected via USB will be flashed with {file_path}"
     )
     try:
-        batch_flash_hex(file_path)
+        cmds.batch_flash_hex(
+            file_path,
+            incremental=incremental,
+            workers=workers,
+            metrics_output=metrics_path,
+            metrics_format=metrics_format,
+            max_per_hub=max_per_hub,
+            max_attempts=max_attempts,
+            stage_timeouts=stage_timeouts,
+            heartbeat_timeout=heartbeat_timeout,
+            skip_matching=skip_matching,
+            journal_path=journal_path,
+        )
     except KeyboardInterrupt:
         click.echo(click.style("Aborted by user.", fg="red"), err=True)
         sys.exit(0)
+    except Exception as e:
+        click.echo(click.style("Error: {}", fg="red").format(e), err=True)
+        sys.exit(1)
+
+
+@cli.command()
+@click.option(
+    "-s",
+    "--socket",
+    "socket_path",
+    type=click.Path(),
+    envvar=SOCKET_ENV_VAR,
+    default=DEFAULT_SOCKET_PATH,
+    show_default=True,
+    help="Path to the Unix socket to listen on.",
+)
+def daemon(socket_path):
+    """Keep the micro:bit connections open until Ctrl+C is pressed.
+
+    The read, write-code and compare commands are sent to the daemon when
+    the UBITTOOL_DAEMON_SOCKET environmental variable has its socket path.
+    """
+    click.echo("Executing: Run the uBitTool daemon\n")
+    ubit_daemon = Daemon(socket_path)
+    try:
+        ubit_daemon.start()
+        click.echo("Listening on {}".format(socket_path))
+        ubit_daemon.serve_forever()
+    except KeyboardInterrupt:
+        click.echo(click.style("Stopped by user.", fg="red"), err=True)
+    except Exception as e:
+        click.echo(click.style("Error: {}", fg="red").format(e), err=True)
+        sys.exit(1)
+    finally:
+        ubit_daemon.close()
 
 
 if GUI_AVAILABLE:
@@ -281,6 +746,8 @@ if GUI_AVAILABLE:
     @cli.command()
     def gui():
         """Launch the GUI version of this app (has more options)."""
+        from ubittool.gui import open_gui
+
         open_gui()
 
 
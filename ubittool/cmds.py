@@ -9,46 +9,131 @@ via PyOCD, which uses the CMSIS interface provided by DAPLink.
 The exposed function for the command line and GUI interfaces can safely read
 areas of Flash (full flash, MicroPython, Python code) and UICR (to read the
 customer data), and format the output into Intel Hex, a nicely decoded string
-format, or human readable text (for the Python code).
+format, binary image formats (raw binary, UF2 and ELF), or human readable text
+(for the Python code).
 """
 import os
 import sys
+import html
+import json
 import time
+import signal
+import struct
 import tempfile
+import itertools
 import webbrowser
 import multiprocessing
 from io import StringIO
-from threading import Timer
+from threading import Event, Thread, Timer
 from collections import namedtuple
-from difflib import HtmlDiff, unified_diff
+from contextlib import ExitStack, closing, contextmanager
+from difflib import HtmlDiff
 from traceback import format_exc
 
 import uflash
-from intelhex import IntelHex
 
-from ubittool import programmer
+from ubittool import (
+    compare,
+    discovery,
+    filesystem,
+    formats,
+    journal,
+    metrics,
+    programmer,
+    scheduler,
+    watchdog,
+)
 
 
+# The data is a bytes-like object (bytes, bytearray or memoryview)
 DataAndOffset = namedtuple("DataAndOffset", ["data", "offset"])
 
+# Board sent to the batch flash pool, with the seconds taken to discover it
+# for the first attempt
+BatchFlash = namedtuple(
+    "BatchFlash", ["result", "microbit_id", "discovery_time"]
+)
+
+# Binary formats for the memory images
+IMAGE_FORMATS = formats.IMAGE_FORMATS
+
+# Seconds between the checks of the batch flash results
+BATCH_CHECK_INTERVAL = 0.5
+# Number of worker processes flashing boards at the same time
+BATCH_WORKERS = 8
+
+# UF2 family ID of the micro:bit microcontroller for each memory layout
+UF2_FAMILY_IDS = {
+    programmer.MEM_REGIONS_MB_V1: formats.UF2_FAMILY_NRF51,
+    programmer.MEM_REGIONS_MB_V2: formats.UF2_FAMILY_NRF52833,
+}
+
 
 #
 # Data format conversions
 #
+def _as_bytes(data):
+    """Get a bytes-like view of the data without copying it if possible.
+
+    Compatibility shim for callers still providing a list of integers, which
+    is converted into a bytes instance.
+
+    :param data: Bytes-like object or iterable of integers, each representing
+        a single byte.
+    :return: A memoryview of the data.
+    """
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data)
+    return memoryview(data).cast("B")
+
+
+def _trim_erased(data_offsets, page_size):
+    """Remove the erased flash pages from data areas.
+
+    A page is erased if all its bytes are 0xFF. Pages only partially included
+    at the edges of an area are checked with the bytes available.
+
+    :param data_offsets: Iterable of DataAndOffset with the data and its start
+        address.
+    :param page_size: Integer with the size of the flash pages.
+    :return: Generator of DataAndOffset with the data left after removing the
+        erased pages.
+    """
+    erased_page = b"\xff" * page_size
+    for data, offset in data_offsets:
+        data = _as_bytes(data)
+        run_start = None
+        position = 0
+        while position < len(data):
+            page_offset = (offset + position) % page_size
+            page_end = min(position + page_size - page_offset, len(data))
+            page_len = page_end - position
+            if data[position:page_end] == erased_page[:page_len]:
+                if run_start is not None:
+                    yield DataAndOffset(
+                        data[run_start:position], offset + run_start
+                    )
+                    run_start = None
+            elif run_start is None:
+                run_start = position
+            position = page_end
+        if run_start is not None:
+            yield DataAndOffset(data[run_start:], offset + run_start)
+
+
 def _bytes_to_intel_hex(data_offsets):
-    """Take a list of bytes and return a string in the Intel Hex format.
+    """Take data and offsets and return a string in the Intel Hex format.
 
-    :param data: List of integers, each representing a single byte.
-    :param offset: Start address offset.
+    :param data_offsets: List of DataAndOffset with the data and its start
+        address.
     :return: A string with the Intel Hex encoded data.
     """
-    i_hex = IntelHex()
-    for do in data_offsets:
-        i_hex.frombytes(do.data, do.offset)
-
     fake_file = StringIO()
     try:
-        i_hex.tofile(fake_file, format="hex", byte_count=16)
+        for line in formats.intel_hex_lines(
+            DataAndOffset(_as_bytes(do.data), do.offset) for do in data_offsets
+        ):
+            fake_file.write(line)
     except IOError as e:
         sys.stderr.write("ERROR: File write: {}\n{}".format(fake_file, str(e)))
         return
@@ -58,20 +143,24 @@ def _bytes_to_intel_hex(data_offsets):
     return intel_hex_str
 
 
-def _bytes_to_pretty_hex(data_offsets):
-    """Convert a list of bytes to a nicely formatted ASCII decoded hex string.
+def _bytes_to_pretty_hex(data_offsets, collapse_erased=False):
+    """Convert data to a nicely formatted ASCII decoded hex string.
 
-    :param data: List of integers, each representing a single byte.
-    :param offset: Start address offset.
+    :param data_offsets: List of DataAndOffset with the data and its start
+        address.
+    :param collapse_erased: Boolean, collapse consecutive erased flash lines.
     :return: A string with the formatted hex data.
     """
-    i_hex = IntelHex()
-    for do in data_offsets:
-        i_hex.frombytes(do.data, do.offset)
-
     fake_file = StringIO()
     try:
-        i_hex.dump(tofile=fake_file, width=16, withpadding=False)
+        for line in formats.pretty_hex_lines(
+            (
+                DataAndOffset(_as_bytes(do.data), do.offset)
+                for do in data_offsets
+            ),
+            collapse_erased=collapse_erased,
+        ):
+            fake_file.write(line)
     except IOError as e:
         sys.stderr.write("ERROR: File write: {}\n{}".format(fake_file, str(e)))
         return
@@ -81,10 +170,119 @@ def _bytes_to_pretty_hex(data_offsets):
     return pretty_hex_str
 
 
+class _LazyFile(object):
+    """Text file only created when the first data is written to it.
+
+    Avoids leaving an empty file behind if the micro:bit cannot be read.
+    """
+
+    def __init__(self, file_path):
+        """Store the path of the file to create."""
+        self.file_path = file_path
+        self.file = None
+
+    def write(self, text):
+        """Write text to the file, creating it on the first call."""
+        if self.file is None:
+            self.file = open(self.file_path, "w")
+        self.file.write(text)
+
+    def close(self):
+        """Close the file if it has been created."""
+        if self.file is not None:
+            self.file.close()
+
+
+@contextmanager
+def _open_output(output):
+    """Get a writable text stream from a stream or a file path.
+
+    :param output: Writable text stream, or path to a file to create.
+    :return: Context manager with a writable text stream. Files are closed on
+        exit, streams are left open.
+    """
+    if hasattr(output, "write"):
+        yield output
+    else:
+        lazy_file = _LazyFile(output)
+        try:
+            yield lazy_file
+        finally:
+            lazy_file.close()
+
+
+def _write_hex(
+    output, chunks, end_address, decode_hex=False, collapse_erased=False
+):
+    """Format data chunks as hex and write them as they arrive.
+
+    :param output: Writable text stream, or path to a file to create.
+    :param chunks: Iterable of DataAndOffset, in increasing address order.
+    :param end_address: Integer, address after the last byte to be written,
+        the Intel Hex address records and pretty hex address width depend on
+        it.
+    :param decode_hex: True selects nice decoded format, False selects Intel
+            Hex format.
+    :param collapse_erased: Boolean, collapse consecutive erased flash lines
+            in the nice decoded format.
+    """
+    with _open_output(output) as stream:
+        if decode_hex:
+            writer = formats.PrettyHexWriter(
+                stream,
+                address_digits=formats.pretty_hex_address_digits(end_address),
+                collapse_erased=collapse_erased,
+            )
+        else:
+            writer = formats.IntelHexWriter(
+                stream, linear_address=end_address > 0x10000
+            )
+        for chunk in chunks:
+            writer.write(chunk.offset, _as_bytes(chunk.data))
+        writer.close()
+
+
+def _flash_read_end(address=None, count=None, **kwargs):
+    """Get the end address of a flash read before connecting to the board.
+
+    Flash starts at address 0 on all boards, so if a count is not given the
+    read ends at the end of flash, where the largest flash size is used. This
+    is only valid to decide the output format details that are the same for
+    all board flash sizes.
+
+    :param address: Integer indicating the start address to read.
+    :param count: Integer indicating how many bytes to read.
+    :return: Integer with the address after the last byte read.
+    """
+    if count is None:
+        return max(
+            mem.flash_start + mem.flash_size
+            for mem in programmer.MICROBIT_MEM_REGIONS.values()
+        )
+    return (address or 0) + count
+
+
+@contextmanager
+def _microbit(mcu=None, unique_id=None):
+    """Use a connected micro:bit or open a new connection for a command.
+
+    :param mcu: Optional programmer.MicrobitMcu instance to use, its
+            connection is left open.
+    :param unique_id: Optional USB Serial number of the micro:bit to connect
+            to if an instance is not provided.
+    :return: Context manager with the programmer.MicrobitMcu to use.
+    """
+    if mcu is not None:
+        yield mcu
+    else:
+        with programmer.MicrobitMcu(unique_id=unique_id) as mb:
+            yield mb
+
+
 #
 # Reading data commands
 #
-def read_flash_hex(decode_hex=False, **kwargs):
+def read_flash_hex(decode_hex=False, trim_erased=False, mcu=None, **kwargs):
     """Read data from the flash memory and return as a hex string.
 
     Read as a number of bytes of the micro:bit flash from the given address.
@@ -95,15 +293,22 @@ def read_flash_hex(decode_hex=False, **kwargs):
     :param count: Integer indicating hoy many bytes to read.
     :param decode_hex: True selects nice decoded format, False selects Intel
             Hex format.
+    :param trim_erased: Boolean, leave the erased flash pages out.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
     :return: String with the hex formatted as indicated.
     """
-    with programmer.MicrobitMcu() as mb:
+    with _microbit(mcu) as mb:
         start_address, flash_data = mb.read_flash(**kwargs)
+        flash = [DataAndOffset(flash_data, start_address)]
+        if trim_erased:
+            flash = list(_trim_erased(flash, mb.mem.flash_page_size))
     to_hex = _bytes_to_pretty_hex if decode_hex else _bytes_to_intel_hex
-    return to_hex([DataAndOffset(flash_data, start_address)])
+    return to_hex(flash)
 
 
-def read_flash_uicr_hex(decode_hex=False, **kwargs):
+def read_flash_uicr_hex(
+    decode_hex=False, trim_erased=False, mcu=None, **kwargs
+):
     """Read data from the flash memory and the UICR and return as a hex string.
 
     Read as a number of bytes of the micro:bit flash from the given address.
@@ -114,21 +319,21 @@ def read_flash_uicr_hex(decode_hex=False, **kwargs):
     :param count: Integer indicating hoy many bytes to read.
     :param decode_hex: True selects nice decoded format, False selects Intel
             Hex format.
+    :param trim_erased: Boolean, leave the erased flash pages out.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
     :return: String with the hex formatted as indicated.
     """
-    with programmer.MicrobitMcu() as mb:
+    with _microbit(mcu) as mb:
         flash_start, flash_data = mb.read_flash(**kwargs)
         uicr_start, uicr_data = mb.read_uicr()
+        flash = [DataAndOffset(flash_data, flash_start)]
+        if trim_erased:
+            flash = list(_trim_erased(flash, mb.mem.flash_page_size))
     to_hex = _bytes_to_pretty_hex if decode_hex else _bytes_to_intel_hex
-    return to_hex(
-        [
-            DataAndOffset(flash_data, flash_start),
-            DataAndOffset(uicr_data, uicr_start),
-        ]
-    )
+    return to_hex(flash + [DataAndOffset(uicr_data, uicr_start)])
 
 
-def read_ram_hex(decode_hex=False, **kwargs):
+def read_ram_hex(decode_hex=False, mcu=None, **kwargs):
     """Read data from RAM and return as a hex string.
 
     Read as a number of bytes of the micro:bit RAM from the given address.
@@ -139,70 +344,354 @@ def read_ram_hex(decode_hex=False, **kwargs):
     :param count: Integer indicating hoy many bytes to read.
     :param decode_hex: True selects nice decoded format, False selects Intel
             Hex format.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
     :return: String with the hex formatted as indicated.
     """
-    with programmer.MicrobitMcu() as mb:
+    with _microbit(mcu) as mb:
         start_address, ram_data = mb.read_ram(**kwargs)
     to_hex = _bytes_to_pretty_hex if decode_hex else _bytes_to_intel_hex
     return to_hex([DataAndOffset(ram_data, start_address)])
 
 
-def read_uicr_hex(decode_hex=False):
+def read_uicr_hex(decode_hex=False, mcu=None):
     """Read the full UICR data.
 
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
     :return: String with the nicely decoded UICR area data.
     """
-    with programmer.MicrobitMcu() as mb:
+    with _microbit(mcu) as mb:
         start_address, uicr_data = mb.read_uicr()
     to_hex = _bytes_to_pretty_hex if decode_hex else _bytes_to_intel_hex
     return to_hex([DataAndOffset(uicr_data, start_address)])
 
 
-def read_uicr_customer_hex(decode_hex=False):
+def read_uicr_customer_hex(decode_hex=False, mcu=None):
     """Read the UICR Customer data.
 
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
     :return: String with the nicely decoded UICR Customer area data.
     """
-    with programmer.MicrobitMcu() as mb:
+    with _microbit(mcu) as mb:
         start_address, uicr_data = mb.read_uicr_customer()
     to_hex = _bytes_to_pretty_hex if decode_hex else _bytes_to_intel_hex
     return to_hex([DataAndOffset(uicr_data, start_address)])
 
 
-def read_micropython():
+def read_flash_chunks(trim_erased=False, mcu=None, **kwargs):
+    """Read the micro:bit flash in chunks, yielding them as they are read.
+
+    The connection to the micro:bit is kept open until the generator is
+    exhausted or closed.
+
+    :param trim_erased: Boolean, leave the erased flash pages out, which can
+            split a chunk into several ones or skip it completely.
+    :param address: Integer indicating the start address to read.
+    :param count: Integer indicating how many bytes to read.
+    :param chunk_size: Integer, maximum number of bytes per chunk.
+    :param progress: Optional callable invoked after each chunk with the number
+            of bytes read and the total, returning True cancels the read.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    :return: Generator of DataAndOffset instances, one per chunk.
+    """
+    with _microbit(mcu) as mb:
+        chunks = (
+            DataAndOffset(data, address)
+            for address, data in mb.iter_flash(**kwargs)
+        )
+        if trim_erased:
+            chunks = _trim_erased(chunks, mb.mem.flash_page_size)
+        yield from chunks
+
+
+def _read_changed_sectors(mb, expected_image, address=None, count=None):
+    """Read only the micro:bit flash sectors that differ from a memory image.
+
+    The micro:bit calculates the CRC32 of each flash sector and only the
+    sectors with a CRC different than the image sector, with the addresses
+    without data expected to be erased, are transferred.
+
+    :param mb: programmer.MicrobitMcu instance to read from.
+    :param expected_image: compare.SparseImage with the expected contents.
+    :param address: Integer indicating the start address to check, aligned
+            to the flash page size.
+    :param count: Integer indicating how many bytes to check, a multiple of
+            the flash page size.
+    :return: Generator of DataAndOffset instances, one per differing sector.
+    """
+    flash_crcs = mb.flash_sector_crc32(address=address, count=count)
+    sector_size = mb.mem.flash_page_size
+    if address is None:
+        address = mb.mem.flash_start
+    expected_crcs = expected_image.sector_crc32(
+        address, len(flash_crcs) * sector_size, sector_size
+    )
+    for i, (expected, actual) in enumerate(zip(expected_crcs, flash_crcs)):
+        if expected != actual:
+            sector_start, data = mb.read_flash(
+                address=address + i * sector_size, count=sector_size
+            )
+            yield DataAndOffset(data, sector_start)
+
+
+def read_ram_chunks(mcu=None, **kwargs):
+    """Read the micro:bit RAM in chunks, yielding them as they are read.
+
+    :param address: Integer indicating the start address to read.
+    :param count: Integer indicating how many bytes to read.
+    :param chunk_size: Integer, maximum number of bytes per chunk.
+    :param progress: Optional callable invoked after each chunk with the number
+            of bytes read and the total, returning True cancels the read.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    :return: Generator of DataAndOffset instances, one per chunk.
+    """
+    with _microbit(mcu) as mb:
+        for address, data in mb.iter_ram(**kwargs):
+            yield DataAndOffset(data, address)
+
+
+def read_uicr_chunks(mcu=None, **kwargs):
+    """Read the micro:bit UICR in chunks, yielding them as they are read.
+
+    :param address: Integer indicating the start address to read.
+    :param count: Integer indicating how many bytes to read.
+    :param chunk_size: Integer, maximum number of bytes per chunk.
+    :param progress: Optional callable invoked after each chunk with the number
+            of bytes read and the total, returning True cancels the read.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    :return: Generator of DataAndOffset instances, one per chunk.
+    """
+    with _microbit(mcu) as mb:
+        for address, data in mb.iter_uicr(**kwargs):
+            yield DataAndOffset(data, address)
+
+
+def write_flash_hex(
+    output,
+    decode_hex=False,
+    collapse_erased=False,
+    trim_erased=False,
+    mcu=None,
+    **kwargs
+):
+    """Read the flash memory and write it as hex while it is read.
+
+    Each chunk read from the micro:bit is formatted and written before reading
+    the next one, so memory usage does not depend on the size of the read.
+    The output is the same as read_flash_hex().
+
+    :param output: Writable text stream, or path to a file to create.
+    :param decode_hex: True selects nice decoded format, False selects Intel
+            Hex format.
+    :param collapse_erased: Boolean, collapse consecutive erased flash lines
+            in the nice decoded format.
+    :param trim_erased: Boolean, leave the erased flash pages out.
+    :param address: Integer indicating the start address to read.
+    :param count: Integer indicating how many bytes to read.
+    :param chunk_size: Integer, maximum number of bytes per chunk.
+    :param progress: Optional callable invoked after each chunk with the number
+            of bytes read and the total, returning True cancels the read.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    """
+    _write_hex(
+        output,
+        read_flash_chunks(trim_erased=trim_erased, mcu=mcu, **kwargs),
+        _flash_read_end(**kwargs),
+        decode_hex=decode_hex,
+        collapse_erased=collapse_erased,
+    )
+
+
+def write_flash_uicr_hex(
+    output,
+    decode_hex=False,
+    collapse_erased=False,
+    trim_erased=False,
+    mcu=None,
+    **kwargs
+):
+    """Read the flash and UICR and write them as hex while they are read.
+
+    :param output: Writable text stream, or path to a file to create.
+    :param decode_hex: True selects nice decoded format, False selects Intel
+            Hex format.
+    :param collapse_erased: Boolean, collapse consecutive erased flash lines
+            in the nice decoded format.
+    :param trim_erased: Boolean, leave the erased flash pages out.
+    :param address: Integer indicating the flash start address to read.
+    :param count: Integer indicating how many bytes of flash to read.
+    :param chunk_size: Integer, maximum number of bytes per flash chunk.
+    :param progress: Optional callable invoked after each flash chunk with the
+            number of bytes read and the total, returning True cancels it.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    """
+    uicr_end = max(
+        mem.uicr_start + mem.uicr_size
+        for mem in programmer.MICROBIT_MEM_REGIONS.values()
+    )
+    with _microbit(mcu) as mb:
+        flash = (
+            DataAndOffset(data, address)
+            for address, data in mb.iter_flash(**kwargs)
+        )
+        if trim_erased:
+            flash = _trim_erased(flash, mb.mem.flash_page_size)
+        uicr = (
+            DataAndOffset(data, address) for address, data in mb.iter_uicr()
+        )
+        _write_hex(
+            output,
+            itertools.chain(flash, uicr),
+            uicr_end,
+            decode_hex=decode_hex,
+            collapse_erased=collapse_erased,
+        )
+
+
+def write_memory_image(
+    file_path,
+    image_format,
+    uicr=False,
+    ram=False,
+    trim_erased=False,
+    mcu=None,
+    **kwargs
+):
+    """Read the micro:bit memory and save it into a binary image file.
+
+    The flash is always included, and the UICR and RAM can be added to the
+    same image. The raw binary format joins all the data areas back to back,
+    so their addresses are saved in a JSON file with the same path as the
+    image plus a ".json" extension.
+
+    :param file_path: Path to the image file to create.
+    :param image_format: String with one of the IMAGE_FORMATS.
+    :param uicr: Boolean, include the full UICR.
+    :param ram: Boolean, include the full RAM.
+    :param trim_erased: Boolean, leave the erased flash pages out.
+    :param address: Integer indicating the flash start address to read.
+    :param count: Integer indicating how many bytes of flash to read.
+    :param chunk_size: Integer, maximum number of bytes per flash chunk.
+    :param progress: Optional callable invoked after each flash chunk with the
+            number of bytes read and the total, returning True cancels it.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(
+            "Unknown image format '{}', it must be one of: {}".format(
+                image_format, ", ".join(IMAGE_FORMATS)
+            )
+        )
+    with _microbit(mcu) as mb:
+        areas = [
+            DataAndOffset(data, address)
+            for address, data in mb.iter_flash(**kwargs)
+        ]
+        if trim_erased:
+            areas = list(_trim_erased(areas, mb.mem.flash_page_size))
+        if uicr:
+            uicr_start, uicr_data = mb.read_uicr()
+            areas.append(DataAndOffset(uicr_data, uicr_start))
+        if ram:
+            ram_start, ram_data = mb.read_ram()
+            areas.append(DataAndOffset(ram_data, ram_start))
+        board_id = mb.board_id
+        uf2_family_id = UF2_FAMILY_IDS[mb.mem]
+
+    if image_format == "bin":
+        image, metadata = formats.bin_image(areas)
+        metadata["board_id"] = board_id
+        with open(file_path + ".json", "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=2)
+    elif image_format == "uf2":
+        image = b"".join(formats.uf2_blocks(areas, uf2_family_id))
+    else:
+        image = formats.elf_image(areas)
+    with open(file_path, "wb") as image_file:
+        image_file.write(image)
+
+
+def read_micropython(mcu=None):
     """Read the MicroPython runtime from the micro:bit flash.
 
+    The read stops at the end of the runtime, instead of including all the
+    empty flash up to the start of the Python code.
+
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
     :return: String with Intel Hex format for the MicroPython runtime.
     """
-    with programmer.MicrobitMcu() as mb:
+    with _microbit(mcu) as mb:
+        runtime_end = mb.find_micropython_end()
         start_address, flash_data = mb.read_flash(
             address=programmer.MICROPYTHON_START,
-            count=programmer.MICROPYTHON_END - programmer.MICROPYTHON_START,
+            count=runtime_end - programmer.MICROPYTHON_START,
         )
     return _bytes_to_intel_hex([DataAndOffset(flash_data, start_address)])
 
 
-def read_python_code():
+def read_python_code(mcu=None):
     """Read the MicroPython user code from the micro:bit flash.
 
-    :return: String with the MicroPython code.
+    Only the code header and the number of bytes it indicates are read.
+
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    :return: String with the MicroPython code, empty if the flash does not
+            contain a code header.
     """
-    with programmer.MicrobitMcu() as mb:
-        start_address, flash_data = mb.read_flash(
-            address=programmer.PYTHON_CODE_START,
-            count=(programmer.PYTHON_CODE_END - programmer.PYTHON_CODE_START),
+    header_size = struct.calcsize(programmer.PYTHON_CODE_HEADER_FORMAT)
+    code_start = programmer.PYTHON_CODE_START + header_size
+    with _microbit(mcu) as mb:
+        _, header = mb.read_flash(
+            address=programmer.PYTHON_CODE_START, count=header_size
         )
-    py_code_hex = _bytes_to_intel_hex(
-        [DataAndOffset(flash_data, start_address)]
-    )
+        magic, code_size = struct.unpack(
+            programmer.PYTHON_CODE_HEADER_FORMAT, header
+        )
+        if magic != programmer.PYTHON_CODE_MAGIC:
+            return ""
+        if code_size > programmer.PYTHON_CODE_END - code_start:
+            raise Exception(
+                "Could not decode the MicroPython code from flash, "
+                "invalid code length {}".format(code_size)
+            )
+        _, code = mb.read_flash(address=code_start, count=code_size)
     try:
-        python_code = uflash.extract_script(py_code_hex)
-    except Exception:
+        python_code = code.decode("utf-8")
+    except UnicodeDecodeError:
         sys.stderr.write(format_exc() + "\n" + "-" * 70 + "\n")
         raise Exception("Could not decode the MicroPython code from flash")
     return python_code
 
 
+def read_micropython_files(mcu=None):
+    """Read the files from the MicroPython V2 filesystem in flash.
+
+    The filesystem location is taken from the MicroPython flash regions
+    table, and only the filesystem chunk markers and the chunks with file
+    data are read.
+
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    :return: A list of filesystem.MicroPythonFile, with the file name and
+            data bytes.
+    """
+    with _microbit(mcu) as mb:
+        mem = mb.memory_regions()
+        regions = filesystem.find_region_table(
+            mb, mem.flash_start, mem.flash_size, mem.flash_page_size
+        )
+        fs_regions = [
+            region
+            for region in regions or []
+            if region.region_id == filesystem.REGION_ID_FILESYSTEM
+        ]
+        if not fs_regions:
+            raise Exception(
+                "Could not find the MicroPython filesystem in flash."
+            )
+        return filesystem.read_files(
+            mb, fs_regions[0].start, fs_regions[0].size
+        )
+
+
 #
 # Flashing commands
 #
@@ -225,53 +714,508 @@ def flash_drag_n_drop(hex_path):
     time.sleep(1)
 
 
-def flash_pyocd(path_to_hex, unique_id=None):
+def flash_pyocd(path_to_hex, unique_id=None, incremental=False, mcu=None):
     """Flash the micro:bit with the given hex file using PyOCD.
 
     :param path_to_hex: Path to the hex file to flash to the micro:bit.
     :param unique_id: Optional USB Serial number of a micro:bit to flash.
+    :param incremental: Boolean, only program the flash sectors that differ
+            from the hex file.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
     """
-    with programmer.MicrobitMcu(unique_id=unique_id) as mb:
-        mb.flash_hex(path_to_hex)
+    with _microbit(mcu, unique_id) as mb:
+        mb.flash_hex(path_to_hex, incremental=incremental)
 
 
-def batch_flash_hex(hex_path):
+def flash_python_code(python_code, mcu=None):
+    """Write a MicroPython script into a micro:bit running MicroPython.
+
+    Checks the micro:bit contains the same MicroPython runtime included in
+    uflash, and if it does, only the flash sectors of the script area that
+    change are erased and programmed, instead of flashing the full hex file.
+
+    :param python_code: String with the MicroPython code.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    :return: Integer with the number of flash sectors programmed.
+    """
+    runtime_image = compare.SparseImage(
+        formats.parse_intel_hex(uflash._RUNTIME.splitlines())
+    )
+    script_hex = uflash.hexlify(python_code.encode("utf-8"))
+    script_image = compare.SparseImage(
+        formats.parse_intel_hex(script_hex.splitlines())
+    )
+    runtime_end = max(
+        offset + len(data)
+        for data, offset in runtime_image.areas
+        if offset < programmer.MICROPYTHON_END
+    )
+    with _microbit(mcu) as mb:
+        if mb.changed_flash_sectors(
+            runtime_image,
+            address=programmer.MICROPYTHON_START,
+            count=runtime_end - programmer.MICROPYTHON_START,
+        ):
+            raise Exception(
+                "The micro:bit does not contain the MicroPython {} runtime, "
+                "flash the full hex file instead.".format(
+                    uflash.MICROPYTHON_VERSION
+                )
+            )
+        sectors = mb.changed_flash_sectors(
+            script_image,
+            address=programmer.PYTHON_CODE_START,
+            count=programmer.PYTHON_CODE_END - programmer.PYTHON_CODE_START,
+        )
+        mb.program_flash_sectors(script_image, sectors)
+        mb.reset()
+    return len(sectors)
+
+
+# The parsed hex file and the heartbeat slots in each batch flash worker
+_batch_hex_sections = None
+_batch_heartbeat_slots = None
+
+
+def _init_batch_worker(hex_sections, heartbeat_slots):
+    """Prepare a batch flash worker process.
+
+    The worker process imports this module, and with it pyOCD, when it
+    starts, so the boards are flashed without waiting for the imports. Ctrl+C
+    is ignored, as the main process terminates the workers.
+
+    :param hex_sections: Dictionary with the data areas of each board ID,
+            from formats.parse_universal_hex(), to flash all the boards.
+    :param heartbeat_slots: watchdog.HeartbeatSlots to write the heartbeats
+            for the main process.
+    """
+    global _batch_hex_sections, _batch_heartbeat_slots
+    _batch_hex_sections = hex_sections
+    _batch_heartbeat_slots = heartbeat_slots
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _send_batch_heartbeats(slot, task_id, timings, stop):
+    """Write a heartbeat periodically until the stop event is set.
+
+    :param slot: Index of the heartbeat slot assigned to the board.
+    :param task_id: Task ID assigned to the board.
+    :param timings: programmer.StageTimings of the board being flashed.
+    :param stop: threading.Event set when the board has been flashed.
+    """
+    while True:
+        if _batch_heartbeat_slots.read(slot).task_id != task_id:
+            # The main process is no longer watching the board
+            return
+        _batch_heartbeat_slots.write(
+            slot, task_id, os.getpid(), timings.current, dict(timings)
+        )
+        if stop.wait(watchdog.HEARTBEAT_INTERVAL):
+            return
+
+
+def _flash_batch_microbit(
+    unique_id,
+    incremental,
+    queued_at,
+    skip_matching=False,
+    slot=None,
+    task_id=None,
+):
+    """Flash a micro:bit with the hex file parsed for the batch worker.
+
+    :param unique_id: USB Serial number of the micro:bit to flash.
+    :param incremental: Boolean, only program the flash sectors that differ
+            from the hex file.
+    :param queued_at: Timestamp from time.time() when the board was sent to
+            the pool.
+    :param skip_matching: Boolean, do not flash the micro:bit if its flash
+            CRC32 already matches the hex file.
+    :param slot: Optional index of the heartbeat slot assigned to the board,
+            no heartbeats are written without it.
+    :param task_id: Task ID assigned to the board, the board is not flashed
+            if the slot has been assigned to a different task.
+    :return: Tuple with a dictionary with the seconds taken by each stage,
+            the error message or None if it was flashed successfully, and a
+            boolean indicating if it was skipped.
+    """
+    timings = programmer.StageTimings(queue=time.time() - queued_at)
+    if (
+        slot is not None
+        and _batch_heartbeat_slots.read(slot).task_id != task_id
+    ):
+        # The main process gave up on this task while it was in the pool
+        return dict(timings), "Cancelled before reaching a worker", False
+    stop_heartbeats = Event()
+    heartbeats = Thread(
+        target=_send_batch_heartbeats,
+        args=(slot, task_id, timings, stop_heartbeats),
+        daemon=True,
+    )
+    if slot is not None:
+        heartbeats.start()
+    try:
+        with _microbit(unique_id=unique_id) as mb:
+            flashed = mb.flash_hex_sections(
+                _batch_hex_sections,
+                incremental=incremental,
+                timings=timings,
+                skip_matching=skip_matching,
+            )
+    except Exception as e:
+        return dict(timings), str(e), False
+    finally:
+        if slot is not None:
+            stop_heartbeats.set()
+            heartbeats.join()
+            # Before returning, so the main process does not terminate this
+            # worker once it could be flashing a different board
+            if _batch_heartbeat_slots.read(slot).task_id == task_id:
+                _batch_heartbeat_slots.clear(slot)
+    return dict(timings), None, not flashed
+
+
+def _terminate_batch_worker(batch_flash, timed_out, batch_watchdog):
+    """Terminate the batch flash worker stuck with a micro:bit.
+
+    Where possible the worker is paused first, so it cannot finish the
+    board and start a different one while it is checked that it is still
+    flashing the board. The pool starts a new worker to replace it.
+
+    :param batch_flash: BatchFlash of the board.
+    :param timed_out: watchdog.Expired of the board.
+    :param batch_watchdog: watchdog.BatchWatchdog with the heartbeats.
+    :return: Boolean, True if the board can be recorded as failed, or False
+            if the worker has just finished it.
+    """
+    pause = hasattr(signal, "SIGSTOP")
+    try:
+        if pause:
+            os.kill(timed_out.pid, signal.SIGSTOP)
+        if batch_flash.result.ready() or not batch_watchdog.is_running(
+            timed_out
+        ):
+            if pause:
+                os.kill(timed_out.pid, signal.SIGCONT)
+            return False
+        # A paused process only handles SIGKILL
+        os.kill(timed_out.pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+    except OSError:
+        # The worker has already exited
+        pass
+    return True
+
+
+def batch_flash_hex(
+    hex_path,
+    incremental=False,
+    watcher=None,
+    workers=None,
+    metrics_output=None,
+    metrics_format="jsonl",
+    max_per_hub=None,
+    max_attempts=scheduler.MAX_ATTEMPTS,
+    stage_timeouts=None,
+    heartbeat_timeout=watchdog.HEARTBEAT_TIMEOUT,
+    skip_matching=False,
+    journal_path=None,
+):
     """Flash the micro:bit with the given hex file using multiprocessing.
 
+    The hex file is parsed once, and a pool of worker processes is started
+    with its contents before any board is found, so each new board sent to
+    the pool is flashed without reading the file again. The connected boards
+    are only enumerated when the watcher reports they might have changed.
+
+    The boards are sent to the pool when there is a free worker and, if
+    there is a limit, a free slot in their USB hub. The failed boards are
+    retried after a delay that doubles with each attempt. The outcome of
+    each board is printed at the end.
+
+    The workers send heartbeats while they flash a board, if a stage takes
+    longer than its timeout, or the heartbeats stop, the worker is
+    terminated and the board is retried.
+
+    The boards can be compared with the hex file before flashing them, using
+    the CRC32 of the flash sectors, and skipped if they match. With a
+    journal, the boards flashed are saved with the hash of the hex file, and
+    only the boards saved with the same hash are compared, as they are
+    expected to match when the batch is restarted or they are plugged again.
+
+    The time taken by each stage of every flash attempt is recorded, and the
+    station throughput is printed after each one.
+
     :param hex_path: Path to the hex file to flash to the micro:bit.
+    :param incremental: Boolean, only program the flash sectors that differ
+            from the hex file.
+    :param watcher: Optional discovery backend, by default the one from
+            discovery.open_discovery().
+    :param workers: Optional number of boards to flash at the same time, by
+            default BATCH_WORKERS.
+    :param metrics_output: Optional writable text stream, or path to a file
+            to create, to write the timings of each flash attempt.
+    :param metrics_format: String with one of the metrics.METRICS_FORMATS.
+    :param max_per_hub: Optional number of boards to flash at the same time
+            in each USB hub, only for the hubs found in the Linux sysfs.
+    :param max_attempts: Number of times a board is flashed before giving
+            up.
+    :param stage_timeouts: Optional dictionary with the maximum seconds of
+            some flashing stages, replacing the watchdog.STAGE_TIMEOUTS.
+    :param heartbeat_timeout: Seconds without a heartbeat from the worker
+            flashing a board before it is terminated.
+    :param skip_matching: Boolean, compare every board with the hex file
+            and skip it if it matches.
+    :param journal_path: Optional path to the SQLite journal of the boards
+            flashed, created if it does not exist.
+    """
+    workers = workers or BATCH_WORKERS
+    batch_flashes = []
+    batch_metrics = metrics.BatchMetrics(metrics_format=metrics_format)
+    batch_scheduler = scheduler.BatchScheduler(
+        workers,
+        max_per_hub=max_per_hub,
+        max_attempts=max_attempts,
+        hub_of=discovery.usb_hub,
+    )
+    discovery_times = {}
+    connected_ids = ()
+
+    with open(hex_path, "rb") as hex_file:
+        hex_data = hex_file.read()
+    image_hash = journal.hash_image(hex_data)
+    hex_sections = formats.parse_universal_hex(
+        hex_data.decode("utf-8").splitlines()
+    )
+    if watcher is None:
+        watcher = discovery.open_discovery()
+    context = multiprocessing.get_context("spawn")
+    heartbeat_slots = watchdog.HeartbeatSlots(context, workers)
+    batch_watchdog = watchdog.BatchWatchdog(
+        heartbeat_slots, stage_timeouts, heartbeat_timeout
+    )
+    pool = context.Pool(
+        workers, _init_batch_worker, (hex_sections, heartbeat_slots)
+    )
+    with ExitStack() as stack:
+        stack.enter_context(closing(watcher))
+        stack.enter_context(pool)
+        flash_journal = None
+        if journal_path is not None:
+            flash_journal = stack.enter_context(
+                closing(journal.FlashJournal(journal_path))
+            )
+        if metrics_output is not None:
+            batch_metrics.output = stack.enter_context(
+                _open_output(metrics_output)
+            )
+        stack.callback(
+            lambda: print("\n" + batch_scheduler.outcome_table(), end="")
+        )
+        rescan = True
+        while True:
+            if rescan:
+                start = time.monotonic()
+                connected_ids = watcher.connected_ids()
+                discovery_time = time.monotonic() - start
+                for microbit_id in connected_ids:
+                    if batch_scheduler.add(microbit_id):
+                        print(f"\nNew micro:bit found: {microbit_id}")
+                        discovery_times[microbit_id] = discovery_time
+            for microbit_id in batch_scheduler.attempt_disconnected(
+                connected_ids
+            ):
+                _record_batch_result(
+                    batch_scheduler,
+                    batch_metrics,
+                    flash_journal,
+                    image_hash,
+                    microbit_id,
+                    {},
+                    scheduler.NOT_CONNECTED_ERROR,
+                )
+            _start_batch_flashes(
+                pool,
+                batch_scheduler.start_ready(connected_ids),
+                discovery_times,
+                batch_flashes,
+                batch_watchdog,
+                incremental,
+                skip_matching,
+                flash_journal,
+                image_hash,
+            )
+            _check_batch_flashes(
+                batch_scheduler,
+                batch_flashes,
+                batch_metrics,
+                batch_watchdog,
+                flash_journal,
+                image_hash,
+            )
+            timeout = BATCH_CHECK_INTERVAL
+            next_retry = batch_scheduler.next_retry(connected_ids)
+            if next_retry is not None:
+                timeout = min(timeout, next_retry)
+            rescan = watcher.wait(timeout=timeout)
+
+
+def _start_batch_flashes(
+    pool,
+    ready_microbits,
+    discovery_times,
+    batch_flashes,
+    batch_watchdog,
+    incremental,
+    skip_matching,
+    flash_journal,
+    image_hash,
+):
+    """Send the micro:bits selected by the scheduler to be flashed.
+
+    :param pool: multiprocessing.Pool with the worker processes.
+    :param ready_microbits: List of (USB ID, seconds waited) tuples from
+            scheduler.BatchScheduler.start_ready().
+    :param discovery_times: Dictionary with the seconds taken to discover
+            each board, removed when the board is sent for the first time.
+    :param batch_flashes: List of BatchFlash, updated with the new boards.
+    :param batch_watchdog: watchdog.BatchWatchdog to watch the new boards.
+    :param incremental: Boolean, only program the flash sectors that differ
+            from the hex file.
+    :param skip_matching: Boolean, skip all the boards matching the hex
+            file.
+    :param flash_journal: Optional journal.FlashJournal, the boards saved in
+            it with the image hash are skipped if they match the hex file.
+    :param image_hash: String with the journal.hash_image() of the hex file.
     """
-    found_microbits = set()
-    flash_processes = []
+    for microbit_id, waited in ready_microbits:
+        slot, task_id = batch_watchdog.start(microbit_id)
+        check_first = skip_matching or (
+            flash_journal is not None
+            and flash_journal.contains(microbit_id, image_hash)
+        )
+        flash_result = pool.apply_async(
+            _flash_batch_microbit,
+            (
+                microbit_id,
+                incremental,
+                time.time() - waited,
+                check_first,
+                slot,
+                task_id,
+            ),
+        )
+        batch_flashes.append(
+            BatchFlash(
+                flash_result,
+                microbit_id,
+                discovery_times.pop(microbit_id, 0.0),
+            )
+        )
 
-    multiprocessing.set_start_method("spawn")
 
-    while True:
-        time.sleep(1)
-        connected_microbit_ids = programmer.find_microbit_ids()
-        if not connected_microbit_ids:
+def _check_batch_flashes(
+    batch_scheduler,
+    batch_flashes,
+    batch_metrics,
+    batch_watchdog,
+    flash_journal,
+    image_hash,
+):
+    """Check and record the results of the boards sent to the pool.
+
+    Removes the boards that finished or timed out from the list, and reports
+    their result to the scheduler. The workers of the boards that timed out
+    are terminated.
+
+    :param batch_scheduler: scheduler.BatchScheduler deciding the retries.
+    :param batch_flashes: List of BatchFlash.
+    :param batch_metrics: metrics.BatchMetrics to record the results.
+    :param batch_watchdog: watchdog.BatchWatchdog with the heartbeats.
+    :param flash_journal: Optional journal.FlashJournal to save the boards
+            that contain the hex file.
+    :param image_hash: String with the journal.hash_image() of the hex file.
+    """
+    batch_watchdog.receive()
+    expired = {e.board_id: e for e in batch_watchdog.expired()}
+    for batch_flash in list(batch_flashes):
+        microbit_id = batch_flash.microbit_id
+        if batch_flash.result.ready():
+            try:
+                timings, error, skipped = batch_flash.result.get()
+            except Exception as e:
+                timings, error, skipped = {}, str(e), False
+        elif microbit_id in expired:
+            timed_out = expired[microbit_id]
+            if not _terminate_batch_worker(
+                batch_flash, timed_out, batch_watchdog
+            ):
+                continue
+            timings, error = timed_out.timings, timed_out.error
+            skipped = False
+        else:
             continue
+        batch_watchdog.forget(microbit_id)
+        batch_flashes.remove(batch_flash)
+        _record_batch_result(
+            batch_scheduler,
+            batch_metrics,
+            flash_journal,
+            image_hash,
+            microbit_id,
+            dict(timings, discovery=batch_flash.discovery_time),
+            error,
+            skipped,
+        )
 
-        for microbit_id in connected_microbit_ids:
-            if microbit_id not in found_microbits:
-                print(f"\nNew micro:bit found: {microbit_id}")
-                found_microbits.add(microbit_id)
-                flash_process = multiprocessing.Process(
-                    target=flash_pyocd, args=(hex_path, microbit_id),
-                )
-                flash_processes.append((flash_process, microbit_id))
-                flash_process.start()
-
-        # Check exit code for all processes
-        # Remove the ones that finished and retry the ones that failed
-        for flash_process_tuple in list(flash_processes):
-            flash_process, microbit_id = flash_process_tuple
-            if flash_process.exitcode is not None:
-                flash_processes.remove(flash_process_tuple)
-                if flash_process.exitcode != 0:
-                    print(f"\nFlashing of {microbit_id} failed, retrying...")
-                    found_microbits.remove(microbit_id)
-                else:
-                    print(f"\nFlashing of {microbit_id} finished successfully")
+
+def _record_batch_result(
+    batch_scheduler,
+    batch_metrics,
+    flash_journal,
+    image_hash,
+    microbit_id,
+    timings,
+    error,
+    skipped=False,
+):
+    """Record the result of a flash attempt and print it.
+
+    :param batch_scheduler: scheduler.BatchScheduler deciding the retries.
+    :param batch_metrics: metrics.BatchMetrics to record the results.
+    :param flash_journal: Optional journal.FlashJournal to save the boards
+            that contain the hex file.
+    :param image_hash: String with the journal.hash_image() of the hex file.
+    :param microbit_id: USB Serial number of the micro:bit.
+    :param timings: Dictionary with the seconds taken by each stage.
+    :param error: String with the error message, or None if it succeeded.
+    :param skipped: Boolean, True if the board already contained the hex
+            file and it was not flashed.
+    """
+    row = batch_metrics.record(microbit_id, timings, error, skipped)
+    board = batch_scheduler.finish(microbit_id, error, skipped=skipped)
+    if flash_journal is not None and error is None:
+        flash_journal.record(microbit_id, image_hash)
+    if board.state == scheduler.STATE_RETRY:
+        print(
+            f"\nFlashing of {microbit_id} failed ({error}), "
+            f"retrying in {board.backoff:.0f} s..."
+        )
+    elif board.state == scheduler.STATE_GAVE_UP:
+        print(
+            f"\nFlashing of {microbit_id} failed ({error}), "
+            f"giving up after {board.attempts} attempts"
+        )
+    elif board.state == scheduler.STATE_SKIPPED:
+        print(
+            f"\nFlashing of {microbit_id} skipped, it already contains "
+            f"the hex file (checked in {row['total']:.1f} s)"
+        )
+    else:
+        print(
+            f"\nFlashing of {microbit_id} finished successfully "
+            f"in {row['total']:.1f} s"
+        )
+    print(batch_metrics.summary())
 
 
 #
@@ -350,38 +1294,170 @@ def _gen_diff_html(from_title, from_lines, to_title, to_lines):
     return filled_template
 
 
-def compare_full_flash_hex(hex_file_path):
+def _gen_ranges_html(from_title, to_title, diff_lines, summary):
+    """Create an HTML page with the memory lines that contain differences.
+
+    :param from_title: Title of the left content compared.
+    :param to_title: Title of the right content compared.
+    :param diff_lines: Iterable of tuples with the line address and the left
+        and right bytes of the line.
+    :param summary: String with a text summary of the differences.
+    :return: String of HTML code with the comparison output.
+    """
+    html_template = """<!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <title>Diff {from_title} vs. {to_title}</title>
+        <style type="text/css">
+            table {{font-family:Courier; border:medium}}
+            th {{background-color:#e0e0e0; padding:0px 10px}}
+            td {{padding:0px 10px; white-space:pre}}
+            .diff_chg {{background-color:#ffff77}}
+        </style>
+    </head>
+    <body>
+        <pre>{summary}</pre>
+        <table>
+            <tr><th>Address</th><th>{from_title}</th><th>{to_title}</th></tr>
+            {rows}
+        </table>
+    </body>
+    </html>"""
+
+    def hex_cells(line, other_line):
+        return " ".join(
+            "{:02X}".format(x)
+            if x == y
+            else '<span class="diff_chg">{:02X}</span>'.format(x)
+            for x, y in zip(line, other_line)
+        )
+
+    rows = "\n".join(
+        "<tr><td>{:08X}</td><td>{}</td><td>{}</td></tr>".format(
+            address,
+            hex_cells(from_line, to_line),
+            hex_cells(to_line, from_line),
+        )
+        for address, from_line, to_line in diff_lines
+    )
+    return html_template.format(
+        from_title=html.escape(from_title),
+        to_title=html.escape(to_title),
+        summary=html.escape(summary),
+        rows=rows,
+    )
+
+
+def compare_full_flash_hex(hex_file_path, crc=False, mcu=None):
     """Compare the micro:bit flash contents with a hex file.
 
-    Opens the default browser to display an HTML page with the comparison
-    output.
+    The hex file is parsed into a memory image and compared with the flash
+    byte by byte, so the hex record sizes do not matter. Flash not included in
+    the hex file is expected to be erased. Prints a summary of the differences
+    and opens the default browser to display an HTML page with the memory
+    lines that differ.
 
     :param hex_file_path: File path to the hex file to compare against.
+    :param crc: Boolean, only read the flash sectors with a CRC32 different
+            than the hex file, as calculated by the micro:bit.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    :return: Integer, 0 if there are no differences, 1 otherwise.
     """
     with open(hex_file_path, encoding="utf-8") as f:
-        file_hex_lines = f.read().splitlines()
-    flash_hex_lines = read_flash_hex(decode_hex=False).splitlines()
+        file_image = compare.SparseImage(formats.parse_intel_hex(f))
+    with _microbit(mcu) as mb:
+        if crc:
+            flash_areas = list(_read_changed_sectors(mb, file_image))
+            flash_start, flash_size = mb.mem.flash_start, mb.mem.flash_size
+        else:
+            flash_start, flash_data = mb.read_flash()
+            flash_areas = [(flash_data, flash_start)]
+            flash_size = len(flash_data)
+    flash_image = compare.SparseImage(flash_areas)
+
+    diff_ranges = compare.diff_images(file_image, flash_image)
+    summary = compare.ranges_report(diff_ranges)
+    outside = len(file_image) - file_image.count_inside(
+        flash_start, flash_size
+    )
+    if outside:
+        summary += "{} bytes from the hex file are not in flash.\n".format(
+            outside
+        )
+    print(summary, end="")
 
-    html_code = _gen_diff_html(
-        "micro:bit", flash_hex_lines, "Hex file", file_hex_lines,
+    html_code = _gen_ranges_html(
+        "Hex file",
+        "micro:bit",
+        compare.diff_lines(file_image, flash_image, diff_ranges),
+        summary,
     )
     _open_temp_html(html_code)
 
-    diffs = list(unified_diff(flash_hex_lines, file_hex_lines))
-    return 1 if len(diffs) else 0
+    return 1 if diff_ranges else 0
+
+
+def check_flash_hex(hex_file_path, max_diffs=1, crc=False, mcu=None, **kwargs):
+    """Check if the micro:bit flash matches a hex file, stopping early.
+
+    The flash is read in chunks and each one is compared with the hex file
+    as it arrives, so the read stops as soon as enough differences are found
+    and no report is generated.
+
+    :param hex_file_path: File path to the hex file to compare against.
+    :param max_diffs: Integer, number of differing ranges after which the
+            read is stopped.
+    :param crc: Boolean, only read the flash sectors with a CRC32 different
+            than the hex file, as calculated by the micro:bit. The chunk_size
+            and progress arguments are not used in this mode.
+    :param address: Integer indicating the flash start address to read.
+    :param count: Integer indicating how many bytes of flash to read.
+    :param chunk_size: Integer, maximum number of bytes per chunk.
+    :param progress: Optional callable invoked after each chunk with the number
+            of bytes read and the total, returning True cancels the read.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
+    :return: Integer, 0 if there are no differences, 1 otherwise.
+    """
+    if max_diffs < 1:
+        raise ValueError("The maximum number of differences must be positive.")
+    with open(hex_file_path, encoding="utf-8") as f:
+        file_image = compare.SparseImage(formats.parse_intel_hex(f))
+
+    diff_ranges = []
+    with _microbit(mcu) as mb:
+        if crc:
+            chunks = _read_changed_sectors(
+                mb, file_image, kwargs.get("address"), kwargs.get("count")
+            )
+        else:
+            chunks = read_flash_chunks(mcu=mb, **kwargs)
+        with closing(chunks):
+            for data, offset in chunks:
+                compare.diff_buffers(
+                    offset,
+                    file_image.read(offset, len(data)),
+                    data,
+                    diff_ranges,
+                    max_ranges=max_diffs,
+                )
+                if len(diff_ranges) >= max_diffs:
+                    break
+    return 1 if diff_ranges else 0
 
 
-def compare_uicr_customer(hex_file_path):
+def compare_uicr_customer(hex_file_path, mcu=None):
     """Compare the micro:bit User UICR contents with a hex file.
 
     Opens the default browser to display an HTML page with the comparison
     output.
 
     :param hex_file_path: File path to the hex file to compare against.
+    :param mcu: Optional connected programmer.MicrobitMcu to use.
     """
     with open(hex_file_path, encoding="utf-8") as f:
         file_hex_str = f.readlines()
-    flash_hex_str = read_uicr_customer_hex(decode_hex=False)
+    flash_hex_str = read_uicr_customer_hex(decode_hex=False, mcu=mcu)
 
     html_code = _gen_diff_html(
         "micro:bit", flash_hex_str.splitlines(), "Hex file", file_hex_str
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compare memory images by address and report the ranges that differ.
+
+The images are sparse, only the memory areas with data are stored, and the
+comparison works directly on the bytes, so it takes linear time and does not
+depend on how the images were encoded in a file.
+"""
+import zlib
+from bisect import bisect_right
+from collections import namedtuple
+
+from ubittool import formats
+
+# Half-open range of addresses, the end address is not included
+DiffRange = namedtuple("DiffRange", ["start", "end"])
+
+# Number of bytes compared at once before looking for the differing bytes
+COMPARE_BLOCK_SIZE = 256
+
+
+class SparseImage(object):
+    """Memory image containing only the areas with data."""
+
+    def __init__(self, data_offsets):
+        """Store the data areas, joining the ones that are contiguous.
+
+        :param data_offsets: Iterable of (data, offset) tuples, the data
+            areas must not overlap.
+        """
+        # List of (data, offset) tuples sorted by address
+        self.areas = formats.join_areas(data_offsets)
+        self._starts = [offset for _, offset in self.areas]
+
+    def __len__(self):
+        """Get the number of bytes with data in the image."""
+        return sum(len(data) for data, _ in self.areas)
+
+    def _overlaps(self, address, end):
+        """Find the data areas that overlap with an address range.
+
+        :param address: Integer with the first address of the range.
+        :param end: Integer with the address after the last one of the range.
+        :return: Generator of tuples with the start and end addresses of each
+            overlap, and the offset and data of its area.
+        """
+        index = max(bisect_right(self._starts, address) - 1, 0)
+        for data, offset in self.areas[index:]:
+            if offset >= end:
+                break
+            start = max(offset, address)
+            stop = min(offset + len(data), end)
+            if start < stop:
+                yield start, stop, offset, data
+
+    def read(self, address, count, fill=0xFF):
+        """Read a memory area, filling the addresses without data.
+
+        :param address: Integer indicating the start address to read.
+        :param count: Integer, how many bytes to read.
+        :param fill: Integer, value for the bytes without data.
+        :return: A bytes instance with the data.
+        """
+        result = bytearray([fill]) * count
+        for start, stop, offset, data in self._overlaps(
+            address, address + count
+        ):
+            result_start, result_stop = start - address, stop - address
+            data_start, data_stop = start - offset, stop - offset
+            result[result_start:result_stop] = data[data_start:data_stop]
+        return bytes(result)
+
+    def count_inside(self, address, count):
+        """Count the bytes with data in an address range.
+
+        :param address: Integer with the first address of the range.
+        :param count: Integer, number of bytes in the range.
+        :return: Integer with the number of bytes.
+        """
+        return sum(
+            stop - start
+            for start, stop, _, _ in self._overlaps(address, address + count)
+        )
+
+    def count_outside(self, image):
+        """Count the bytes with data in addresses without data in an image.
+
+        :param image: SparseImage to check against.
+        :return: Integer with the number of bytes.
+        """
+        inside = sum(
+            self.count_inside(offset, len(data))
+            for data, offset in image.areas
+        )
+        return len(self) - inside
+
+    def sector_crc32(self, address, count, sector_size, fill=0xFF):
+        """Calculate the CRC32 of each sector in an address range.
+
+        :param address: Integer with the first address of the range.
+        :param count: Integer, number of bytes in the range, a multiple of
+            the sector size.
+        :param sector_size: Integer with the number of bytes per sector.
+        :param fill: Integer, value for the bytes without data.
+        :return: A list with the zlib.crc32() integer of each sector.
+        """
+        return [
+            zlib.crc32(self.read(sector, sector_size, fill))
+            for sector in range(address, address + count, sector_size)
+        ]
+
+
+def diff_buffers(address, expected, actual, ranges=None, max_ranges=None):
+    """Find the ranges of bytes that differ between two buffers.
+
+    :param address: Integer with the address of the first byte.
+    :param expected: Bytes-like object with the expected data.
+    :param actual: Bytes-like object with the actual data, same length as the
+        expected data.
+    :param ranges: Optional list of DiffRange to extend with the results.
+    :param max_ranges: Optional integer, stop comparing when a range would be
+        added to a list with this many ranges.
+    :return: The list of DiffRange, in increasing address order.
+    """
+    if len(expected) != len(actual):
+        raise ValueError("The buffers to compare have different lengths.")
+    if ranges is None:
+        ranges = []
+    expected = memoryview(expected).cast("B")
+    actual = memoryview(actual).cast("B")
+    for block_start in range(0, len(actual), COMPARE_BLOCK_SIZE):
+        block_end = min(block_start + COMPARE_BLOCK_SIZE, len(actual))
+        if expected[block_start:block_end] == actual[block_start:block_end]:
+            continue
+        for i in range(block_start, block_end):
+            if expected[i] != actual[i]:
+                byte_address = address + i
+                if ranges and ranges[-1].end == byte_address:
+                    ranges[-1] = DiffRange(ranges[-1].start, byte_address + 1)
+                elif max_ranges is not None and len(ranges) >= max_ranges:
+                    return ranges
+                else:
+                    ranges.append(DiffRange(byte_address, byte_address + 1))
+    return ranges
+
+
+def diff_images(expected, actual, fill=0xFF):
+    """Find the ranges of bytes that differ between two memory images.
+
+    Only the areas with data in the actual image are compared, and the
+    addresses without data in the expected image are expected to contain the
+    fill value, as flash not programmed by a hex file stays erased.
+
+    :param expected: SparseImage with the expected contents.
+    :param actual: SparseImage with the contents to check.
+    :param fill: Integer, expected value of the bytes without data.
+    :return: A list of DiffRange, in increasing address order.
+    """
+    ranges = []
+    for data, offset in actual.areas:
+        diff_buffers(
+            offset, expected.read(offset, len(data), fill), data, ranges
+        )
+    return ranges
+
+
+def diff_lines(expected, actual, ranges, width=16, fill=0xFF):
+    """Get the lines of memory that contain the differing ranges.
+
+    :param expected: SparseImage with the expected contents.
+    :param actual: SparseImage with the contents checked.
+    :param ranges: List of DiffRange, in increasing address order.
+    :param width: Integer, number of bytes per line.
+    :param fill: Integer, value for the bytes without data.
+    :return: Generator of tuples with the line address, the expected bytes
+        and the actual bytes.
+    """
+    next_line = None
+    for diff_range in ranges:
+        line_address = diff_range.start - (diff_range.start % width)
+        if next_line is not None:
+            line_address = max(line_address, next_line)
+        while line_address < diff_range.end:
+            yield (
+                line_address,
+                expected.read(line_address, width, fill),
+                actual.read(line_address, width, fill),
+            )
+            line_address += width
+        next_line = line_address
+
+
+def ranges_report(ranges):
+    """Create a text summary of the differing ranges.
+
+    :param ranges: List of DiffRange.
+    :return: String with one line per range.
+    """
+    if not ranges:
+        return "No differences found.\n"
+    lines = [
+        "Found {} bytes different in {} ranges:".format(
+            sum(r.end - r.start for r in ranges), len(ranges)
+        )
+    ]
+    lines.extend(
+        "  {:#010x} - {:#010x} ({} bytes)".format(
+            r.start, r.end - 1, r.end - r.start
+        )
+        for r in ranges
+    )
+    return "\n".join(lines) + "\n"
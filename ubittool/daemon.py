@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Background process keeping the micro:bit connections open.
+
+The daemon listens on a Unix domain socket for requests to run the commands
+from the cmds module, each one a line with a JSON object containing the
+command name, its arguments and optionally the USB ID of the micro:bit. The
+connection to each micro:bit is opened on its first request and kept open
+for the following ones, so they only take the time needed for the transfers.
+The response is also a line with a JSON object, with a "result" or an
+"error" string.
+
+The cmds and programmer modules are only imported to run the commands, so
+the CLI can import this module without the start up time of pyOCD.
+"""
+import os
+import json
+import base64
+import socket
+import tempfile
+import threading
+import socketserver
+from io import StringIO
+
+from ubittool.filesystem import MicroPythonFile
+
+# Environmental variable with the socket path, when set the CLI commands are
+# sent to the daemon instead of connecting to the micro:bit
+SOCKET_ENV_VAR = "UBITTOOL_DAEMON_SOCKET"
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), "ubittool.sock")
+
+# The cmds functions that can be requested, their results must be JSON
+# serialisable and they must accept the mcu argument
+COMMANDS = (
+    "read_flash_hex",
+    "read_flash_uicr_hex",
+    "read_ram_hex",
+    "read_uicr_hex",
+    "read_uicr_customer_hex",
+    "read_micropython",
+    "read_python_code",
+    "read_micropython_files",
+    "write_flash_hex",
+    "write_flash_uicr_hex",
+    "write_memory_image",
+    "check_flash_hex",
+    "flash_pyocd",
+    "flash_python_code",
+)
+# Commands writing into an output, if the request does not include a file
+# path the text written is returned as the result
+OUTPUT_COMMANDS = ("write_flash_hex", "write_flash_uicr_hex")
+# Commands returning a list of filesystem.MicroPythonFile, which are sent as
+# a list of [name, base64 data] pairs and rebuilt with decode_files()
+FILES_COMMANDS = ("read_micropython_files",)
+
+
+def _run_command(command, mcu, args):
+    """Run a cmds function with a connected micro:bit.
+
+    :param command: String with one of the COMMANDS.
+    :param mcu: Connected programmer.MicrobitMcu instance.
+    :param args: Dictionary with the function arguments.
+    :return: The function result.
+    """
+    from ubittool import cmds
+
+    function = getattr(cmds, command)
+    if command in OUTPUT_COMMANDS and args.get("output") is None:
+        args = {k: v for k, v in args.items() if k != "output"}
+        output = StringIO()
+        function(output=output, mcu=mcu, **args)
+        return output.getvalue()
+    if command in FILES_COMMANDS:
+        return [
+            [f.name, base64.b64encode(f.data).decode("ascii")]
+            for f in function(mcu=mcu, **args)
+        ]
+    return function(mcu=mcu, **args)
+
+
+def decode_files(result):
+    """Rebuild the files returned by the daemon for the FILES_COMMANDS.
+
+    :param result: List of [name, base64 data] pairs.
+    :return: A list of filesystem.MicroPythonFile.
+    """
+    return [
+        MicroPythonFile(name, base64.b64decode(data)) for name, data in result
+    ]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Reply to each request line received from a client."""
+
+    def handle(self):
+        """Process the requests until the client closes the connection."""
+        for line in self.rfile:
+            response = self.server.daemon.execute(line)
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class Daemon(object):
+    """Serve the micro:bit commands requested through a Unix socket."""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH):
+        """Declare all instance variables.
+
+        :param socket_path: Path to the Unix socket to create.
+        """
+        self.socket_path = socket_path
+        self.server = None
+        # USB ID to tuple with the MicrobitMcu and the lock for its requests
+        self._mcus = {}
+        self._mcus_lock = threading.Lock()
+
+    def _get_mcu(self, unique_id):
+        """Get the MicrobitMcu and its lock for a micro:bit USB ID.
+
+        :param unique_id: String with the USB ID, or None for the only
+            micro:bit connected.
+        :return: Tuple with the MicrobitMcu and the lock to use it.
+        """
+        from ubittool import programmer
+
+        with self._mcus_lock:
+            if unique_id not in self._mcus:
+                self._mcus[unique_id] = (
+                    programmer.MicrobitMcu(unique_id=unique_id),
+                    threading.Lock(),
+                )
+            return self._mcus[unique_id]
+
+    def execute(self, request_line):
+        """Run the command from a request line.
+
+        If the command fails the micro:bit connection is closed, so it is
+        opened again on the next request in case the board was unplugged.
+
+        :param request_line: Bytes with the JSON request.
+        :return: Dictionary with the "result" or the "error" message.
+        """
+        try:
+            request = json.loads(request_line.decode("utf-8"))
+            command = request["command"]
+            args = request.get("args", {})
+            unique_id = request.get("unique_id")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return {"error": "Invalid request."}
+        if command not in COMMANDS:
+            return {"error": "Unknown command '{}'.".format(command)}
+
+        mcu, mcu_lock = self._get_mcu(unique_id)
+        with mcu_lock:
+            try:
+                return {"result": _run_command(command, mcu.connect(), args)}
+            except Exception as e:
+                mcu.close()
+                return {"error": str(e)}
+
+    def _remove_stale_socket(self):
+        """Remove the socket file if there is no daemon listening to it."""
+        if not os.path.exists(self.socket_path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                os.remove(self.socket_path)
+                return
+        raise Exception(
+            "A daemon is already listening on {}".format(self.socket_path)
+        )
+
+    def start(self):
+        """Create the socket and start listening for connections."""
+        if not hasattr(socket, "AF_UNIX"):
+            raise Exception("The daemon needs Unix domain sockets support.")
+        self._remove_stale_socket()
+        self.server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, _RequestHandler
+        )
+        self.server.daemon_threads = True
+        self.server.daemon = self
+
+    def serve_forever(self):
+        """Process the requests until shutdown() is called from a thread."""
+        if self.server is None:
+            self.start()
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stop serving requests, called from a different thread."""
+        self.server.shutdown()
+
+    def close(self):
+        """Close the socket and all the micro:bit connections."""
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        with self._mcus_lock:
+            for mcu, mcu_lock in self._mcus.values():
+                with mcu_lock:
+                    mcu.close()
+            self._mcus = {}
+
+
+def call(command, socket_path=None, unique_id=None, **kwargs):
+    """Run a cmds function in the daemon and return its result.
+
+    :param command: String with the name of one of the COMMANDS.
+    :param socket_path: Path to the daemon socket, by default the path from
+        the SOCKET_ENV_VAR environmental variable or DEFAULT_SOCKET_PATH.
+    :param unique_id: Optional USB ID of the micro:bit to use.
+    :param kwargs: Arguments for the function, the file paths must be
+        absolute as they are used by the daemon process.
+    :return: The result from the function.
+    """
+    if socket_path is None:
+        socket_path = os.environ.get(SOCKET_ENV_VAR, DEFAULT_SOCKET_PATH)
+    request = {"command": command, "args": kwargs, "unique_id": unique_id}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError as e:
+            raise Exception(
+                "Could not connect to the daemon at {}: {}".format(
+                    socket_path, e
+                )
+            )
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as sock_file:
+            response_line = sock_file.readline()
+    if not response_line:
+        raise Exception("The daemon closed the connection without a reply.")
+    response = json.loads(response_line.decode("utf-8"))
+    if "error" in response:
+        raise Exception(response["error"])
+    return response["result"]
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Detect when micro:bit boards are connected.
+
+Enumerating the debug probes takes time and USB bandwidth, so on Linux the
+kernel hotplug events (uevents) are used to know when a micro:bit has been
+plugged in, and the probes are only enumerated then. On other platforms, or
+if the uevent socket cannot be opened, the probes are enumerated
+periodically.
+
+All the backends have the same interface, connected_ids() returns the USB
+IDs of the boards connected, and wait() blocks until they might have changed.
+"""
+import os
+import time
+import select
+import socket
+import struct
+
+from ubittool import programmer
+
+# Netlink protocol for the kernel uevents, not defined in the socket module
+NETLINK_KOBJECT_UEVENT = 15
+# Multicast groups with the events sent by the kernel and by udev, the udev
+# events are sent after its rules are applied, like the device permissions
+UEVENT_GROUP_KERNEL = 1
+UEVENT_GROUP_UDEV = 2
+UEVENT_BUFFER_SIZE = 64 * 1024
+# The udev messages start with this prefix, followed by a header with a magic
+# number, the header size and the offset and length of the properties
+UDEV_MONITOR_PREFIX = b"libudev\x00"
+UDEV_MONITOR_HEADER_FORMAT = "=8s4xIII"
+
+# USB vendor and product IDs of the micro:bit interface chip, as they are
+# shown in the uevents of the USB device and interfaces, and of the HID device
+UEVENT_USB_PRODUCT_PREFIX = "d28/204/"
+UEVENT_HID_ID_SUFFIX = "00000D28:00000204"
+# A new device triggers several events, wait until there are no more events
+# for this many seconds before reporting the change
+UEVENT_SETTLE_TIME = 0.1
+
+POLL_INTERVAL = 1.0
+
+# Linux sysfs directory with the USB devices, named by bus and port numbers
+# like "1-2.3", the device in port 3 of the hub in port 2 of the bus 1
+SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+
+
+def parse_uevent(message):
+    """Get the properties of a uevent from the kernel or udev.
+
+    :param message: Bytes with the netlink message.
+    :return: Dictionary with the event property names and values.
+    """
+    if message.startswith(UDEV_MONITOR_PREFIX):
+        header_size = struct.calcsize(UDEV_MONITOR_HEADER_FORMAT)
+        _, _, properties_start, properties_size = struct.unpack(
+            UDEV_MONITOR_HEADER_FORMAT, message[:header_size]
+        )
+        properties_end = properties_start + properties_size
+        fields = message[properties_start:properties_end].split(b"\x00")
+    else:
+        # The kernel messages start with "action@devpath"
+        fields = message.split(b"\x00")[1:]
+    properties = {}
+    for field in fields:
+        name, separator, value = field.decode("utf-8", "replace").partition(
+            "="
+        )
+        if separator:
+            properties[name] = value
+    return properties
+
+
+def is_microbit_uevent(properties):
+    """Check if a uevent adds a micro:bit USB device or its interfaces.
+
+    :param properties: Dictionary with the uevent properties.
+    :return: Boolean, True for a micro:bit event.
+    """
+    return properties.get("ACTION") in ("add", "bind") and (
+        properties.get("PRODUCT", "").startswith(UEVENT_USB_PRODUCT_PREFIX)
+        or properties.get("HID_ID", "").endswith(UEVENT_HID_ID_SUFFIX)
+    )
+
+
+class PollingDiscovery(object):
+    """Enumerate the connected micro:bit boards periodically."""
+
+    def __init__(self, interval=POLL_INTERVAL):
+        """Declare all instance variables.
+
+        :param interval: Seconds between the probe enumerations.
+        """
+        self.interval = interval
+        self._next_poll = time.monotonic()
+
+    def connected_ids(self):
+        """Get the USB IDs of the connected micro:bit boards.
+
+        :return: A tuple of strings with the USB IDs.
+        """
+        self._next_poll = time.monotonic() + self.interval
+        return programmer.find_microbit_ids()
+
+    def wait(self, timeout=None):
+        """Wait until it is time to enumerate the probes again.
+
+        :param timeout: Optional maximum number of seconds to wait.
+        :return: Boolean, True if the connected boards might have changed.
+        """
+        delay = self._next_poll - time.monotonic()
+        if timeout is not None and timeout < delay:
+            time.sleep(timeout)
+            return False
+        time.sleep(max(delay, 0))
+        return True
+
+    def close(self):
+        """Nothing to release."""
+        pass
+
+
+class UeventDiscovery(object):
+    """Enumerate the micro:bit boards when the kernel reports a new one."""
+
+    def __init__(self, sock=None):
+        """Open the uevent netlink socket.
+
+        :param sock: Optional socket receiving the uevent messages, by
+            default a netlink socket is opened.
+        """
+        if sock is None:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+            )
+            try:
+                sock.bind((0, UEVENT_GROUP_KERNEL | UEVENT_GROUP_UDEV))
+            except OSError:
+                sock.close()
+                raise
+        self.sock = sock
+
+    def connected_ids(self):
+        """Get the USB IDs of the connected micro:bit boards.
+
+        :return: A tuple of strings with the USB IDs.
+        """
+        return programmer.find_microbit_ids()
+
+    def wait(self, timeout=None):
+        """Wait until a micro:bit is connected.
+
+        :param timeout: Optional maximum number of seconds to wait.
+        :return: Boolean, True if the connected boards might have changed.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        found = False
+        while True:
+            remaining = None if end is None else max(end - time.monotonic(), 0)
+            if not select.select([self.sock], [], [], remaining)[0]:
+                return found
+            message = self.sock.recv(UEVENT_BUFFER_SIZE)
+            found = found or is_microbit_uevent(parse_uevent(message))
+            if found:
+                # Collect the rest of the events from the same device
+                end = time.monotonic() + UEVENT_SETTLE_TIME
+
+    def close(self):
+        """Close the netlink socket."""
+        self.sock.close()
+
+
+def usb_hub(unique_id, sysfs_path=SYSFS_USB_DEVICES):
+    """Find the USB hub a micro:bit is connected to, from the Linux sysfs.
+
+    :param unique_id: String with the USB ID of the micro:bit, which is the
+        USB serial number.
+    :param sysfs_path: Directory with the USB devices.
+    :return: String with the sysfs name of the hub, like "1-2", or the bus
+        number for the boards connected to the root hub, or None if the
+        board is not found.
+    """
+    try:
+        device_names = os.listdir(sysfs_path)
+    except OSError:
+        return None
+    for device_name in device_names:
+        try:
+            with open(os.path.join(sysfs_path, device_name, "serial")) as f:
+                serial = f.read().strip()
+        except OSError:
+            continue
+        if serial.lower() == unique_id.lower():
+            hub, _, _ = device_name.rpartition(".")
+            return hub or device_name.partition("-")[0]
+    return None
+
+
+def open_discovery():
+    """Open the fastest discovery backend available.
+
+    :return: A UeventDiscovery instance, or a PollingDiscovery instance if
+        the uevents are not available.
+    """
+    if hasattr(socket, "AF_NETLINK"):
+        try:
+            return UeventDiscovery()
+        except OSError:
+            pass
+    return PollingDiscovery()
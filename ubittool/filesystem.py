@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Read the files stored in the MicroPython V2 filesystem.
+
+MicroPython for the micro:bit V2 adds a flash regions table at the end of a
+flash page, indicating where the runtime and the filesystem are located. The
+filesystem is divided in chunks, the first byte of each chunk is a marker and
+the last byte is the index of the next chunk of the same file, so the files
+can be found by reading only the chunk markers and then their chunks.
+"""
+import struct
+from collections import namedtuple
+
+# The table header is located at the end of a flash page and the table rows
+# are placed right before it, the last row describing the first region
+REGION_TABLE_MAGIC_1 = 0x597F30FE
+REGION_TABLE_MAGIC_2 = 0xC1B1D79D
+REGION_TABLE_HEADER_FORMAT = "<2xHHHII"
+REGION_TABLE_ROW_FORMAT = "<BBHI8x"
+REGION_ID_FILESYSTEM = 3
+
+# Chunk indexes start at 1 and the values from 0xFD are used as markers
+CHUNK_SIZE = 128
+CHUNK_MAX_COUNT = 252
+CHUNK_UNUSED = 0xFF
+CHUNK_FILE_START = 0xFE
+CHUNK_PERSISTENT_DATA = 0xFD
+CHUNK_FREED = 0x00
+# The first chunk of a file has the offset where the file ends in the last
+# chunk, and the length of the file name followed by the name
+CHUNK_FILE_HEADER_FORMAT = "<BBB"
+
+FlashRegion = namedtuple("FlashRegion", ["region_id", "start", "size"])
+MicroPythonFile = namedtuple("MicroPythonFile", ["name", "data"])
+
+
+def find_region_table(mcu, flash_start, flash_size, page_size):
+    """Find the MicroPython flash regions table.
+
+    Checks the end of each flash page for the table header, from the end of
+    flash backwards.
+
+    :param mcu: programmer.MicrobitMcu instance to read from.
+    :param flash_start: Integer with the flash start address.
+    :param flash_size: Integer with the flash size in bytes.
+    :param page_size: Integer with the flash page size in bytes.
+    :return: A list of FlashRegion, or None if the table is not found.
+    """
+    header_size = struct.calcsize(REGION_TABLE_HEADER_FORMAT)
+    row_size = struct.calcsize(REGION_TABLE_ROW_FORMAT)
+    for page_end in range(flash_start + flash_size, flash_start, -page_size):
+        header_start = page_end - header_size
+        _, header = mcu.read_flash(address=header_start, count=header_size)
+        table_size, _, page_size_log2, magic_1, magic_2 = struct.unpack(
+            REGION_TABLE_HEADER_FORMAT, header
+        )
+        if (magic_1, magic_2) != (REGION_TABLE_MAGIC_1, REGION_TABLE_MAGIC_2):
+            continue
+        if table_size % row_size or table_size > page_size - header_size:
+            raise ValueError(
+                "Invalid MicroPython flash regions table size {}.".format(
+                    table_size
+                )
+            )
+        _, rows = mcu.read_flash(
+            address=header_start - table_size, count=table_size
+        )
+        regions = []
+        for row_start in range(table_size - row_size, -1, -row_size):
+            region_id, _, start_page, size = struct.unpack(
+                REGION_TABLE_ROW_FORMAT, rows[row_start:][:row_size]
+            )
+            regions.append(
+                FlashRegion(region_id, start_page << page_size_log2, size)
+            )
+        return regions
+    return None
+
+
+def _chunk_address(fs_start, index):
+    """Get the address of a filesystem chunk from its 1-based index."""
+    return fs_start + (index - 1) * CHUNK_SIZE
+
+
+def _read_file(mcu, fs_start, markers, start_index):
+    """Read a file from its first chunk, following the chunk indexes.
+
+    :param mcu: programmer.MicrobitMcu instance to read from.
+    :param fs_start: Integer with the filesystem start address.
+    :param markers: Bytes with the marker of each chunk.
+    :param start_index: Integer, index of the first chunk of the file.
+    :return: A MicroPythonFile instance.
+    """
+    _, chunk = mcu.read_flash(
+        address=_chunk_address(fs_start, start_index), count=CHUNK_SIZE
+    )
+    _, end_offset, name_size = struct.unpack(
+        CHUNK_FILE_HEADER_FORMAT, chunk[:3]
+    )
+    name = chunk[3:][:name_size].decode("utf-8")
+    data_start = 3 + name_size
+    data = []
+    index = start_index
+    visited = {index}
+    while chunk[-1] != CHUNK_UNUSED:
+        next_index = chunk[-1]
+        if (
+            not 0 < next_index <= len(markers)
+            or next_index in visited
+            or markers[next_index - 1] != index
+        ):
+            raise ValueError(
+                "Invalid chunk {} in the MicroPython file {}.".format(
+                    next_index, name
+                )
+            )
+        data.append(chunk[data_start:-1])
+        _, chunk = mcu.read_flash(
+            address=_chunk_address(fs_start, next_index), count=CHUNK_SIZE
+        )
+        index = next_index
+        visited.add(index)
+        data_start = 1
+    data_end = 1 + end_offset
+    data.append(chunk[data_start:data_end])
+    return MicroPythonFile(name, b"".join(data))
+
+
+def read_files(mcu, fs_start, fs_size):
+    """Read all the files from a MicroPython filesystem.
+
+    Only one byte per chunk is read to find where each file starts, and then
+    only the chunks with file data are read.
+
+    :param mcu: programmer.MicrobitMcu instance to read from.
+    :param fs_start: Integer with the filesystem start address.
+    :param fs_size: Integer with the filesystem size in bytes.
+    :return: A list of MicroPythonFile, in the order of their first chunk.
+    """
+    chunk_count = min(fs_size // CHUNK_SIZE, CHUNK_MAX_COUNT)
+    markers = mcu.read_flash_bytes(
+        [_chunk_address(fs_start, i) for i in range(1, chunk_count + 1)]
+    )
+    return [
+        _read_file(mcu, fs_start, markers, index)
+        for index, marker in enumerate(markers, start=1)
+        if marker == CHUNK_FILE_START
+    ]
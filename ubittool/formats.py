@@ -0,0 +1,689 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Encoders and parsers for the file formats used for the micro:bit memory.
+
+The data is provided as an iterable of (data, offset) tuples, where the data is
+a bytes-like object and the offset its start address, so that large memory
+areas can be encoded directly from the buffers read from the micro:bit.
+"""
+import struct
+from binascii import hexlify
+
+# Intel Hex record types
+IHEX_DATA = 0x00
+IHEX_EOF = 0x01
+IHEX_EXT_SEGMENT_ADDR = 0x02
+IHEX_START_SEGMENT_ADDR = 0x03
+IHEX_EXT_LINEAR_ADDR = 0x04
+IHEX_START_LINEAR_ADDR = 0x05
+# Universal Hex record types, from the specification in
+# https://tech.microbit.org/software/spec-universal-hex/
+# Each section or block starts with the board ID, and the data of the
+# sections for the micro:bit V2 is in custom data records
+IHEX_BLOCK_START = 0x0A
+IHEX_BLOCK_END = 0x0B
+IHEX_PADDED_DATA = 0x0C
+IHEX_CUSTOM_DATA = 0x0D
+IHEX_OTHER_DATA = 0x0E
+
+INTEL_HEX_EOF = ":00000001FF\n"
+
+# UF2 block layout, from https://github.com/microsoft/uf2
+UF2_MAGIC_START0 = 0x0A324655
+UF2_MAGIC_START1 = 0x9E5D5157
+UF2_MAGIC_END = 0x0AB16F30
+UF2_FLAG_FAMILY_ID = 0x00002000
+UF2_BLOCK_SIZE = 512
+UF2_HEADER_FORMAT = "<IIIIIIII"
+UF2_DATA_SIZE = 476
+UF2_FAMILY_NRF51 = 0x1B57745F
+UF2_FAMILY_NRF52833 = 0x621E937A
+
+# ELF32 little endian ARM executable with only program headers
+ELF_IDENT = b"\x7fELF\x01\x01\x01" + bytes(9)
+ELF_HEADER_FORMAT = "<16sHHIIIIIHHHHHH"
+ELF_PHDR_FORMAT = "<IIIIIIII"
+ELF_ET_EXEC = 2
+ELF_EM_ARM = 40
+ELF_EV_CURRENT = 1
+ELF_EF_ARM_EABI_VER5 = 0x05000000
+ELF_PT_LOAD = 1
+ELF_PF_RWX = 0x7
+ELF_SEGMENT_ALIGN = 4
+
+# Identifies the raw binary sidecar metadata, version for format changes
+BIN_METADATA_FORMAT = "ubittool-bin"
+BIN_METADATA_VERSION = 1
+
+# Binary formats for the memory images
+IMAGE_FORMATS = ("bin", "uf2", "elf")
+
+
+def _sort_areas(data_offsets):
+    """Sort the data areas by address and check they do not overlap.
+
+    :param data_offsets: Iterable of (data, offset) tuples.
+    :return: A list of (offset, data) tuples, sorted by address, without empty
+        areas, where each data is a memoryview.
+    """
+    areas = sorted(
+        (
+            (offset, memoryview(data).cast("B"))
+            for data, offset in data_offsets
+            if len(data)
+        ),
+        key=lambda area: area[0],
+    )
+    for (offset, data), (next_offset, _) in zip(areas, areas[1:]):
+        if next_offset < offset + len(data):
+            raise ValueError(
+                "Overlapping data areas at address {:#x}.".format(next_offset)
+            )
+    return areas
+
+
+def join_areas(data_offsets):
+    """Sort the data areas and join the ones that are contiguous.
+
+    The data areas must not overlap.
+
+    :param data_offsets: Iterable of (data, offset) tuples.
+    :return: A list of (data, offset) tuples, sorted by address, where each
+        data is a bytes instance and there is a gap between areas.
+    """
+    joined = []
+    for offset, data in _sort_areas(data_offsets):
+        if joined and joined[-1][0] + joined[-1][1] == offset:
+            joined[-1][1] += len(data)
+            joined[-1][2].append(data)
+        else:
+            joined.append([offset, len(data), [data]])
+    return [(b"".join(chunks), offset) for offset, _, chunks in joined]
+
+
+def _to_hex(data):
+    """Convert data into a string of upper case hex digits."""
+    return hexlify(data).decode("ascii").upper()
+
+
+def _intel_hex_record(address, record_type, data=b""):
+    """Encode a single Intel Hex record.
+
+    :param address: Integer with the lower 16 bits of the record address.
+    :param record_type: Integer with the Intel Hex record type.
+    :param data: Bytes-like object with the record data.
+    :return: String with the record line, including the line ending.
+    """
+    record = bytes(
+        (len(data), (address >> 8) & 0xFF, address & 0xFF, record_type)
+    ) + bytes(data)
+    return ":{}{:02X}\n".format(_to_hex(record), -sum(record) & 0xFF)
+
+
+class IntelHexWriter(object):
+    """Encode data into Intel Hex records as it becomes available.
+
+    The data has to be provided in increasing address order, and contiguous
+    data provided in separate calls is encoded as if it had been provided all
+    at once, so the output is the same as the one produced by the IntelHex
+    library for the whole data.
+    """
+
+    def __init__(self, stream=None, linear_address=True, record_size=16):
+        """Configure the writer.
+
+        :param stream: Writable text stream for the write() and close()
+            methods, not needed when using encode() and finish() directly.
+        :param linear_address: Boolean, precede the data records with Extended
+            Linear Address records. IntelHex only does this if any data is
+            placed above the first 64 KB.
+        :param record_size: Integer, maximum number of data bytes per record.
+        """
+        if not 1 <= record_size <= 255:
+            raise ValueError("Wrong record size value: {}".format(record_size))
+        self.stream = stream
+        self.linear_address = linear_address
+        self.record_size = record_size
+        self._upper_address = None
+        self._pending_address = None
+        self._pending = b""
+
+    def _address_record(self, address):
+        """Encode an Extended Linear Address record if the address needs it.
+
+        :param address: Integer with the address of the next data record.
+        :return: String with the Intel Hex line, or empty if not needed.
+        """
+        if self.linear_address and address >> 16 != self._upper_address:
+            self._upper_address = address >> 16
+            return _intel_hex_record(
+                0, IHEX_EXT_LINEAR_ADDR, self._upper_address.to_bytes(2, "big")
+            )
+        return ""
+
+    def _flush_pending(self):
+        """Encode the data held back from an incomplete record."""
+        if self._pending:
+            yield self._address_record(self._pending_address) + (
+                _intel_hex_record(
+                    self._pending_address & 0xFFFF, IHEX_DATA, self._pending
+                )
+            )
+            self._pending = b""
+
+    def encode(self, address, data):
+        """Encode a data area into Intel Hex lines.
+
+        Records are limited by the record size and the 64 KB boundaries, and
+        the last record is held back if it is not full, as the next data area
+        could continue it.
+
+        :param address: Integer with the start address of the data.
+        :param data: Bytes-like object with the data.
+        :return: Generator of strings, each an Intel Hex line.
+        """
+        data = memoryview(data).cast("B")
+        size = len(data)
+        position = 0
+        if self._pending:
+            pending_end = self._pending_address + len(self._pending)
+            if address == pending_end:
+                record_end = min(
+                    self._pending_address + self.record_size,
+                    (self._pending_address | 0xFFFF) + 1,
+                )
+                position = min(record_end - pending_end, size)
+                self._pending += bytes(data[:position])
+                if pending_end + position < record_end:
+                    return
+            yield from self._flush_pending()
+
+        # Converting all the data at once is faster than record by record
+        hex_data = _to_hex(data[position:])
+        hex_offset = position
+        record_size = self.record_size
+        while position < size:
+            record_address = address + position
+            low_address = record_address & 0xFFFF
+            end = position + min(record_size, 0x10000 - low_address)
+            if end > size:
+                self._pending_address = record_address
+                self._pending = bytes(data[position:])
+                return
+            hex_start = (position - hex_offset) * 2
+            hex_end = (end - hex_offset) * 2
+            checksum = (
+                end - position + (low_address >> 8) + (low_address & 0xFF)
+            )
+            checksum += sum(data[position:end])
+            yield "{}:{:02X}{:04X}{:02X}{}{:02X}\n".format(
+                self._address_record(record_address),
+                end - position,
+                low_address,
+                IHEX_DATA,
+                hex_data[hex_start:hex_end],
+                -checksum & 0xFF,
+            )
+            position = end
+
+    def finish(self):
+        """Encode any held back data and the End Of File record.
+
+        :return: Generator of strings, each an Intel Hex line.
+        """
+        yield from self._flush_pending()
+        yield INTEL_HEX_EOF
+
+    def write(self, address, data):
+        """Encode a data area and write the lines to the stream.
+
+        :param address: Integer with the start address of the data.
+        :param data: Bytes-like object with the data.
+        """
+        self.stream.write("".join(self.encode(address, data)))
+
+    def close(self):
+        """Write the last lines to the stream, which is left open."""
+        self.stream.write("".join(self.finish()))
+
+
+def intel_hex_lines(data_offsets, record_size=16):
+    """Encode data into Intel Hex records, yielding one line at a time.
+
+    The output is the same as the one produced by the IntelHex library, data
+    records are split at 64 KB boundaries, and if any data is placed above the
+    first 64 KB all data is preceded by Extended Linear Address records.
+
+    :param data_offsets: Iterable of (data, offset) tuples, the data areas
+        must not overlap.
+    :param record_size: Integer, maximum number of data bytes per record.
+    :return: Generator of strings, each an Intel Hex line ending in a newline.
+    """
+    writer = IntelHexWriter(record_size=record_size)
+    areas = _sort_areas(data_offsets)
+    writer.linear_address = (
+        bool(areas) and areas[-1][0] + len(areas[-1][1]) > 0x10000
+    )
+    for offset, data in areas:
+        yield from writer.encode(offset, data)
+    yield from writer.finish()
+
+
+# Translation table to show the printable ASCII characters in a pretty hex
+_PRINTABLE_ASCII = bytes(x if 32 <= x < 127 else ord(".") for x in range(256))
+
+
+def _parse_hex_sections(lines, universal):
+    """Parse Intel Hex records into the data areas of each board ID.
+
+    :param lines: Iterable of strings, each an Intel Hex record line.
+    :param universal: Boolean, accept the Universal Hex record types.
+    :return: A dictionary with the board ID string of each Universal Hex
+        section, or None for the data outside of the sections, and a list of
+        (data, offset) tuples sorted by address.
+    """
+    sections = {}
+    # Last area of each board and the address after its end
+    last_areas = {}
+    board_id = None
+    address_base = 0
+    data_types = (IHEX_DATA, IHEX_CUSTOM_DATA) if universal else (IHEX_DATA,)
+    ignored_types = (IHEX_START_SEGMENT_ADDR, IHEX_START_LINEAR_ADDR)
+    if universal:
+        ignored_types += (IHEX_BLOCK_END, IHEX_PADDED_DATA, IHEX_OTHER_DATA)
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if not line.startswith(":"):
+                raise ValueError("it does not start with ':'")
+            record = bytes.fromhex(line[1:])
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise ValueError("the record length is wrong")
+            if sum(record) & 0xFF:
+                raise ValueError("the checksum is wrong")
+        except ValueError as e:
+            raise ValueError(
+                "Invalid Intel Hex record in line {}, {}.".format(
+                    line_number, e
+                )
+            )
+        record_type = record[3]
+        data = record[4:-1]
+        if record_type in data_types:
+            address = address_base + (record[1] << 8) + record[2]
+            area, area_end = last_areas.get(board_id, (None, None))
+            if area is not None and address == area_end:
+                area += data
+            else:
+                area = bytearray(data)
+                sections.setdefault(board_id, []).append((area, address))
+            last_areas[board_id] = (area, address + len(data))
+        elif record_type == IHEX_EOF:
+            break
+        elif record_type == IHEX_EXT_SEGMENT_ADDR:
+            address_base = int.from_bytes(data, "big") << 4
+        elif record_type == IHEX_EXT_LINEAR_ADDR:
+            address_base = int.from_bytes(data, "big") << 16
+        elif universal and record_type == IHEX_BLOCK_START:
+            board_id = "{:04X}".format(int.from_bytes(data[:2], "big"))
+        elif record_type not in ignored_types:
+            raise ValueError(
+                "Unsupported Intel Hex record type {:#04x} in line {}.".format(
+                    record_type, line_number
+                )
+            )
+    return {board: join_areas(areas) for board, areas in sections.items()}
+
+
+def parse_intel_hex(lines):
+    """Parse Intel Hex records into data areas.
+
+    Record sizes and letter case do not matter, and the start address records
+    are ignored.
+
+    :param lines: Iterable of strings, each an Intel Hex record line.
+    :return: A list of (data, offset) tuples, sorted by address, where each
+        data is a bytes instance and there is a gap between areas.
+    """
+    return _parse_hex_sections(lines, universal=False).get(None, [])
+
+
+def parse_universal_hex(lines):
+    """Parse a Universal Hex, or an Intel Hex, into the data of each board.
+
+    The data records before the first section are not assigned to any board,
+    as in a normal Intel Hex file.
+
+    :param lines: Iterable of strings, each an Intel Hex record line.
+    :return: A dictionary with the board ID string of each section (like
+        "9900"), or None for the data outside of the sections, and a list of
+        (data, offset) tuples sorted by address.
+    """
+    return _parse_hex_sections(lines, universal=True)
+
+
+def pretty_hex_address_digits(end_address, width=16):
+    """Calculate the number of digits to show the addresses in a pretty hex.
+
+    Follows the same rule as the IntelHex dump() method.
+
+    :param end_address: Integer with the address after the last data byte.
+    :param width: Integer, number of bytes per line.
+    :return: Integer with the number of hex digits for the addresses.
+    """
+    line_end = (((end_address - 1) // width) + 1) * width
+    return max(len("{:X}".format(line_end)), 4)
+
+
+class PrettyHexWriter(object):
+    """Format data into lines of hex columns and an ASCII gutter.
+
+    The data has to be provided in increasing address order and is formatted
+    lazily, so it can be rendered as it becomes available. For a single data
+    area the output is the same as the one produced by the IntelHex library
+    dump() method, lines without any data are not output.
+    """
+
+    def __init__(
+        self, stream=None, address_digits=4, width=16, collapse_erased=False
+    ):
+        """Configure the writer.
+
+        :param stream: Writable text stream for the write() and close()
+            methods, not needed when using encode() and finish() directly.
+        :param address_digits: Integer, minimum number of hex digits for the
+            addresses, see pretty_hex_address_digits().
+        :param width: Integer, number of bytes per line.
+        :param collapse_erased: Boolean, replace consecutive lines of erased
+            flash (all bytes 0xFF) after the first one with a "*" line.
+        """
+        if not isinstance(width, int) or width < 1:
+            raise ValueError("The width must be a positive integer.")
+        self.stream = stream
+        self.width = width
+        self.collapse_erased = collapse_erased
+        self._address_template = "{{:0{}X}} ".format(address_digits)
+        self._erased_line = b"\xff" * width
+        self._last_erased_address = None
+        self._collapsed_lines = 0
+        self._line_address = None
+        self._line = None
+
+    def _format_line(self, address, line):
+        """Format a line, collapsing it if it continues an erased run.
+
+        :param address: Integer with the address of the first line byte.
+        :param line: Bytes-like object, or list of integers and None values.
+        :return: List of strings with the formatted lines, each including the
+            line ending, empty if the line has been collapsed.
+        """
+        lines = []
+        if self.collapse_erased:
+            erased = line == self._erased_line
+            if erased and self._last_erased_address == address - self.width:
+                self._last_erased_address = address
+                self._collapsed_lines += 1
+                return lines
+            lines = self._end_collapsed_run(show_last=False)
+            self._last_erased_address = address if erased else None
+        lines.append(self._render_line(address, line))
+        return lines
+
+    def _end_collapsed_run(self, show_last):
+        """Format the end of a run of collapsed erased lines, if any.
+
+        :param show_last: Boolean, always show the last collapsed line, as
+            otherwise it is only shown if it is the only line in the run.
+        :return: List of strings with the "*" line and/or the last collapsed
+            line.
+        """
+        collapsed_lines, self._collapsed_lines = self._collapsed_lines, 0
+        lines = ["*\n"] if collapsed_lines > 1 else []
+        if collapsed_lines == 1 or (collapsed_lines and show_last):
+            lines.append(
+                self._render_line(self._last_erased_address, self._erased_line)
+            )
+        return lines
+
+    def _render_line(self, address, line):
+        """Render a line of data, where None values are missing bytes.
+
+        :param address: Integer with the address of the first line byte.
+        :param line: Bytes-like object, or list of integers and None values.
+        :return: String with the formatted line, including the line ending.
+        """
+        if isinstance(line, list):
+            hex_columns = "".join(
+                " --" if x is None else " {:02X}".format(x) for x in line
+            )
+            ascii_gutter = "".join(
+                " " if x is None else chr(_PRINTABLE_ASCII[x]) for x in line
+            )
+        else:
+            hex_columns = (" %02X" * len(line)) % tuple(line)
+            ascii_gutter = bytes(line).translate(_PRINTABLE_ASCII).decode()
+        return "{}{}  |{}|\n".format(
+            self._address_template.format(address), hex_columns, ascii_gutter
+        )
+
+    def _flush_line(self):
+        """Format the line held back waiting for more data, if any."""
+        if self._line_address is not None:
+            line_address, line = self._line_address, self._line
+            if None not in line:
+                line = bytes(line)
+            self._line_address = None
+            yield from self._format_line(line_address, line)
+
+    def encode(self, address, data):
+        """Format a data area into lines.
+
+        A line is held back if it is not complete, as the next data area
+        could continue it.
+
+        :param address: Integer with the start address of the data.
+        :param data: Bytes-like object with the data.
+        :return: Generator of strings with the formatted lines.
+        """
+        data = memoryview(data).cast("B")
+        width = self.width
+        position = 0
+        while position < len(data):
+            byte_address = address + position
+            line_address = byte_address - (byte_address % width)
+            if self._line_address not in (None, line_address):
+                yield from self._flush_line()
+            if (
+                self._line_address is None
+                and byte_address == line_address
+                and len(data) - position >= width
+            ):
+                line_end = position + width
+                yield from self._format_line(
+                    line_address, data[position:line_end]
+                )
+                position = line_end
+                continue
+            if self._line_address is None:
+                self._line_address = line_address
+                self._line = [None] * width
+            line_position = byte_address - line_address
+            count = min(width - line_position, len(data) - position)
+            line_end, data_end = line_position + count, position + count
+            self._line[line_position:line_end] = data[position:data_end]
+            position = data_end
+            if line_end == width:
+                yield from self._flush_line()
+
+    def finish(self):
+        """Format the line held back and the end of a collapsed region.
+
+        :return: Generator of strings with the formatted lines.
+        """
+        yield from self._flush_line()
+        # Show the last line to indicate where the erased region ends
+        yield from self._end_collapsed_run(show_last=True)
+
+    def write(self, address, data):
+        """Format a data area and write the lines to the stream.
+
+        :param address: Integer with the start address of the data.
+        :param data: Bytes-like object with the data.
+        """
+        self.stream.write("".join(self.encode(address, data)))
+
+    def close(self):
+        """Write the last lines to the stream, which is left open."""
+        self.stream.write("".join(self.finish()))
+
+
+def pretty_hex_lines(data_offsets, width=16, collapse_erased=False):
+    """Format data into pretty hex lines, yielding one line at a time.
+
+    :param data_offsets: Iterable of (data, offset) tuples, the data areas
+        must not overlap.
+    :param width: Integer, number of bytes per line.
+    :param collapse_erased: Boolean, collapse consecutive erased lines.
+    :return: Generator of strings, each a line ending in a newline.
+    """
+    areas = _sort_areas(data_offsets)
+    if not areas:
+        return
+    writer = PrettyHexWriter(
+        address_digits=pretty_hex_address_digits(
+            areas[-1][0] + len(areas[-1][1]), width
+        ),
+        width=width,
+        collapse_erased=collapse_erased,
+    )
+    for offset, data in areas:
+        yield from writer.encode(offset, data)
+    yield from writer.finish()
+
+
+def bin_image(data_offsets):
+    """Convert data areas into a raw binary image and its metadata.
+
+    The areas are joined back to back without padding, so the metadata is
+    needed to know the address of each byte. Each region in the metadata has
+    its start address, its size and its offset in the binary image.
+
+    :param data_offsets: Iterable of (data, offset) tuples.
+    :return: A tuple with the bytes of the binary image and a dictionary with
+        the metadata, which can be serialised as JSON.
+    """
+    regions = []
+    image = []
+    image_offset = 0
+    for data, address in join_areas(data_offsets):
+        regions.append(
+            {"address": address, "size": len(data), "offset": image_offset}
+        )
+        image.append(data)
+        image_offset += len(data)
+    metadata = {
+        "format": BIN_METADATA_FORMAT,
+        "version": BIN_METADATA_VERSION,
+        "regions": regions,
+    }
+    return b"".join(image), metadata
+
+
+def uf2_blocks(data_offsets, family_id, payload_size=256):
+    """Convert data areas into UF2 blocks.
+
+    The payload of each block is aligned to its size, so blocks at the edges
+    of the areas can contain less data.
+
+    :param data_offsets: Iterable of (data, offset) tuples.
+    :param family_id: Integer with the UF2 family ID of the microcontroller.
+    :param payload_size: Integer, maximum number of data bytes per block.
+    :return: Generator of bytes instances, one per 512 bytes block.
+    """
+    if not 0 < payload_size <= UF2_DATA_SIZE:
+        raise ValueError(
+            "The UF2 payload size must be between 1 and {}.".format(
+                UF2_DATA_SIZE
+            )
+        )
+    payloads = []
+    for offset, data in _sort_areas(data_offsets):
+        position = 0
+        while position < len(data):
+            address = offset + position
+            end = min(
+                position + payload_size - address % payload_size, len(data)
+            )
+            payloads.append((address, data[position:end]))
+            position = end
+    for block_no, (address, payload) in enumerate(payloads):
+        header = struct.pack(
+            UF2_HEADER_FORMAT,
+            UF2_MAGIC_START0,
+            UF2_MAGIC_START1,
+            UF2_FLAG_FAMILY_ID,
+            address,
+            len(payload),
+            block_no,
+            len(payloads),
+            family_id,
+        )
+        padding = bytes(UF2_DATA_SIZE - len(payload))
+        yield b"".join(
+            (header, payload, padding, struct.pack("<I", UF2_MAGIC_END))
+        )
+
+
+def elf_image(data_offsets):
+    """Convert data areas into a minimal ELF file.
+
+    Each continuous area is a PT_LOAD segment, and as there are no sections
+    the file only contains the ELF header, the program headers and the data.
+
+    :param data_offsets: Iterable of (data, offset) tuples.
+    :return: A bytes instance with the ELF file contents.
+    """
+    areas = join_areas(data_offsets)
+    header_size = struct.calcsize(ELF_HEADER_FORMAT)
+    phdr_size = struct.calcsize(ELF_PHDR_FORMAT)
+    header = struct.pack(
+        ELF_HEADER_FORMAT,
+        ELF_IDENT,
+        ELF_ET_EXEC,
+        ELF_EM_ARM,
+        ELF_EV_CURRENT,
+        0,
+        header_size if areas else 0,
+        0,
+        ELF_EF_ARM_EABI_VER5,
+        header_size,
+        phdr_size,
+        len(areas),
+        0,
+        0,
+        0,
+    )
+    phdrs = []
+    segments = []
+    file_offset = header_size + phdr_size * len(areas)
+    for data, address in areas:
+        padding = -file_offset % ELF_SEGMENT_ALIGN
+        file_offset += padding
+        segments.append(bytes(padding) + data)
+        phdrs.append(
+            struct.pack(
+                ELF_PHDR_FORMAT,
+                ELF_PT_LOAD,
+                file_offset,
+                address,
+                address,
+                len(data),
+                len(data),
+                ELF_PF_RWX,
+                ELF_SEGMENT_ALIGN,
+            )
+        )
+        file_offset += len(data)
+    return b"".join([header] + phdrs + segments)
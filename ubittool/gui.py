@@ -228,6 +228,19 @@ class UBitToolWindow(tk.Tk):
             output_str = cmd_function(*args, **kwargs)
             self.text_viewer.replace(output_str)
 
+        # Helper function to execute commands that write their output as it
+        # is generated, keeping the window responsive during long reads
+        def execute_stream_cmd(cmd_str, cmd_function, *args, **kwargs):
+            self.set_next_cmd(cmd_str)
+            self.text_viewer.clear()
+            self.update()
+            cmd_function(
+                StdoutRedirector(self.text_viewer),
+                *args,
+                progress=lambda read, total: self.update(),
+                **kwargs,
+            )
+
         # Menu item micro:bit
         self.ubit_menu = tk.Menu(menu, tearoff=0)
         self.ubit_menu.add_command(
@@ -253,8 +266,10 @@ class UBitToolWindow(tk.Tk):
         )
         self.nrf_menu.add_command(
             label=self.CMD_READ_FLASH_PRETTY,
-            command=lambda: execute_cmd(
-                self.CMD_READ_FLASH_PRETTY, cmds.read_flash_hex, True
+            command=lambda: execute_stream_cmd(
+                self.CMD_READ_FLASH_PRETTY,
+                cmds.write_flash_hex,
+                decode_hex=True,
             ),
         )
         self.nrf_menu.add_command(
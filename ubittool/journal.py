@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Remember the micro:bit boards flashed by the batch flash.
+
+The USB ID of each board flashed is saved in an SQLite database with the
+hash of the hex file, so when the batch is restarted, or a board is plugged
+in again, the boards that should already contain the hex file are only
+compared with it, and not flashed again if they match.
+"""
+import time
+import sqlite3
+import hashlib
+
+
+def hash_image(hex_data):
+    """Calculate the hash identifying a hex file in the journal.
+
+    :param hex_data: Bytes with the contents of the hex file.
+    :return: String with the SHA-256 hex digest.
+    """
+    return hashlib.sha256(hex_data).hexdigest()
+
+
+class FlashJournal(object):
+    """SQLite database with the hex file last flashed to each board."""
+
+    def __init__(self, path):
+        """Open the database, creating it if it does not exist.
+
+        :param path: Path to the SQLite database file.
+        """
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS flashed ("
+                "board_id TEXT PRIMARY KEY, "
+                "image_hash TEXT NOT NULL, "
+                "flashed_at REAL NOT NULL)"
+            )
+
+    def contains(self, board_id, image_hash):
+        """Check if a board was last flashed with a hex file.
+
+        :param board_id: String with the USB ID of the micro:bit.
+        :param image_hash: String with the hash_image() of the hex file.
+        :return: Boolean, True if it is the last hex file of the board.
+        """
+        row = self.connection.execute(
+            "SELECT image_hash FROM flashed WHERE board_id = ?", (board_id,)
+        ).fetchone()
+        return row is not None and row[0] == image_hash
+
+    def record(self, board_id, image_hash, now=None):
+        """Save the hex file a board contains.
+
+        :param board_id: String with the USB ID of the micro:bit.
+        :param image_hash: String with the hash_image() of the hex file.
+        :param now: Optional time.time() value for the current time.
+        """
+        now = time.time() if now is None else now
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO flashed VALUES (?, ?, ?)",
+                (board_id, image_hash, now),
+            )
+
+    def close(self):
+        """Close the database."""
+        self.connection.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Record how long each stage takes when flashing a batch of micro:bits.
+
+Each flash attempt is recorded with the seconds taken by each stage, and
+written as a JSON line or a CSV row, so the stage limiting the throughput of
+a flashing station can be found. The totals are kept to summarise the
+station throughput while the batch is running.
+"""
+import csv
+import json
+import time
+
+# Stages timed for each board, in the order they happen: the enumeration that
+# found the board, the wait for a free worker, and the programmer stages
+STAGES = (
+    "discovery",
+    "queue",
+    "connect",
+    "compare",
+    "erase",
+    "program",
+    "reset",
+)
+FIELDS = (
+    ("timestamp", "board", "attempt", "result", "error") + STAGES + ("total",)
+)
+METRICS_FORMATS = ("jsonl", "csv")
+
+
+class BatchMetrics(object):
+    """Record the flash attempts and keep the station totals."""
+
+    def __init__(self, output=None, metrics_format="jsonl"):
+        """Declare all instance variables.
+
+        :param output: Optional writable text stream for the records.
+        :param metrics_format: String with one of the METRICS_FORMATS.
+        """
+        if metrics_format not in METRICS_FORMATS:
+            raise ValueError(
+                "Unknown metrics format '{}', it must be one of: {}".format(
+                    metrics_format, ", ".join(METRICS_FORMATS)
+                )
+            )
+        self.output = output
+        self.metrics_format = metrics_format
+        self.start = time.monotonic()
+        self.succeeded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.retries = 0
+        self.stage_totals = dict.fromkeys(STAGES, 0.0)
+        self._attempts = {}
+        self._csv_writer = None
+
+    def record(self, board, timings, error=None, skipped=False):
+        """Record a flash attempt and write it to the output.
+
+        :param board: String with the USB ID of the micro:bit.
+        :param timings: Dictionary with the seconds taken by each stage.
+        :param error: Optional string with the error message if it failed.
+        :param skipped: Boolean, True if the board already contained the hex
+            file and it was not flashed.
+        :return: Dictionary with the values of the FIELDS.
+        """
+        attempt = self._attempts.get(board, 0) + 1
+        self._attempts[board] = attempt
+        if attempt > 1:
+            self.retries += 1
+        if error is not None:
+            self.failed += 1
+            result = "failed"
+        elif skipped:
+            self.skipped += 1
+            result = "skipped"
+        else:
+            self.succeeded += 1
+            result = "ok"
+        row = {
+            "timestamp": round(time.time(), 3),
+            "board": board,
+            "attempt": attempt,
+            "result": result,
+            "error": error or "",
+        }
+        for stage in STAGES:
+            seconds = timings.get(stage, 0.0)
+            self.stage_totals[stage] += seconds
+            row[stage] = round(seconds, 3)
+        row["total"] = round(sum(timings.get(s, 0.0) for s in STAGES), 3)
+        self._write(row)
+        return row
+
+    def _write(self, row):
+        """Write a record to the output in the selected format."""
+        if self.output is None:
+            return
+        if self.metrics_format == "jsonl":
+            self.output.write(json.dumps(row) + "\n")
+        else:
+            if self._csv_writer is None:
+                self._csv_writer = csv.DictWriter(
+                    self.output, FIELDS, lineterminator="\n"
+                )
+                self._csv_writer.writeheader()
+            self._csv_writer.writerow(row)
+        if hasattr(self.output, "flush"):
+            self.output.flush()
+
+    def summary(self):
+        """Summarise the station throughput since the batch started.
+
+        :return: String with the boards flashed per hour, the failure rate,
+            the retries and the stage with the longest average time. The
+            boards skipped are included in the boards per hour.
+        """
+        attempts = self.succeeded + self.skipped + self.failed
+        hours = (time.monotonic() - self.start) / 3600
+        boards = self.succeeded + self.skipped
+        boards_per_hour = boards / hours if hours else 0
+        failure_rate = self.failed / attempts if attempts else 0
+        slowest = max(STAGES, key=lambda stage: self.stage_totals[stage])
+        slowest_average = (
+            self.stage_totals[slowest] / attempts if attempts else 0
+        )
+        skipped = ", {} skipped".format(self.skipped) if self.skipped else ""
+        return (
+            "{} boards flashed{}, {:.0f} boards/hour, {} failed attempts "
+            "({:.1%}), {} retries, slowest stage: {} ({:.2f} s)".format(
+                self.succeeded,
+                skipped,
+                boards_per_hour,
+                self.failed,
+                failure_rate,
+                self.retries,
+                slowest,
+                slowest_average,
+            )
+        )
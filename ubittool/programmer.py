@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """Functions to read data from the micro:bit using PyOCD."""
+import time
+import struct
 from collections import namedtuple
+from contextlib import contextmanager
 
 from pyocd.core.helpers import ConnectHelper
-from pyocd.flash.file_programmer import FileProgrammer
+from pyocd.flash.eraser import FlashEraser
+from pyocd.flash.loader import FlashLoader
+
+from ubittool import compare, formats
 
 
 MemoryRegions = namedtuple(
@@ -12,6 +18,7 @@ MemoryRegions = namedtuple(
     [
         "flash_start",
         "flash_size",
+        "flash_page_size",
         "ram_start",
         "ram_size",
         "uicr_start",
@@ -24,6 +31,7 @@ MemoryRegions = namedtuple(
 MEM_REGIONS_MB_V1 = MemoryRegions(
     flash_start=0x0000_0000,
     flash_size=256 * 1024,
+    flash_page_size=1024,
     ram_start=0x2000_0000,
     ram_size=16 * 1024,
     uicr_start=0x1000_1000,
@@ -34,6 +42,7 @@ MEM_REGIONS_MB_V1 = MemoryRegions(
 MEM_REGIONS_MB_V2 = MemoryRegions(
     flash_start=0x0000_0000,
     flash_size=512 * 1024,
+    flash_page_size=4096,
     ram_start=0x2000_0000,
     ram_size=128 * 1024,
     uicr_start=0x1000_1000,
@@ -53,12 +62,133 @@ MICROBIT_MEM_REGIONS = {
 # Assumes code attached to fixed location instead of using the filesystem
 PYTHON_CODE_START = 0x3E000
 PYTHON_CODE_END = 0x40000
+# The code starts with a header containing a magic value and its length
+PYTHON_CODE_HEADER_FORMAT = "<2sH"
+PYTHON_CODE_MAGIC = b"MP"
 
 # MicroPython will contain unnecessary empty space between end of interpreter
 # and begginning of code at a fixed location, assumes no file system used
 MICROPYTHON_START = 0x0
 MICROPYTHON_END = PYTHON_CODE_START
 
+# MicroPython V1 stores the flash area used by the runtime in the UICR, with a
+# magic word, an end marker, the log2 of the page size, the start page and the
+# number of pages used
+UICR_UPY_LAYOUT_ADDR = 0x1000_10C0
+UICR_UPY_LAYOUT_FORMAT = "<IIIHH"
+UICR_UPY_MAGIC = 0x17EEB07C
+
+# Default number of bytes per transfer when reading memory in chunks
+READ_CHUNK_SIZE = 4 * 1024
+
+# Thumb-1 routine, valid for the Cortex-M0 and M4, calculating the CRC32 of
+# consecutive flash sectors, the same value zlib.crc32() returns. It takes the
+# first sector address in r0, the sector size in r1, the number of sectors in
+# r2 and a pointer to the output words in r3, clobbers r4-r7 and stops at the
+# final breakpoint instruction:
+#
+#         ldr   r7, poly
+#     sector_loop:
+#         movs  r4, #0
+#         mvns  r4, r4
+#         mov   r5, r1
+#     byte_loop:
+#         ldrb  r6, [r0]
+#         adds  r0, #1
+#         eors  r4, r6
+#         movs  r6, #8
+#     bit_loop:
+#         lsrs  r4, r4, #1
+#         bcc   no_xor
+#         eors  r4, r7
+#     no_xor:
+#         subs  r6, #1
+#         bne   bit_loop
+#         subs  r5, #1
+#         bne   byte_loop
+#         mvns  r4, r4
+#         stm   r3!, {r4}
+#         subs  r2, #1
+#         bne   sector_loop
+#         bkpt  #0
+#     poly:
+#         .word 0xEDB88320
+CRC32_ROUTINE = bytes.fromhex(
+    "094f0024e4430d460678013074400826"
+    "640800d37c40013efad1013df4d1e443"
+    "10c3013aedd100be2083b8ed"
+)
+CRC32_ROUTINE_BKPT_OFFSET = 0x26
+# Core registers modified to run the routine, restored afterwards
+CRC32_ROUTINE_REGISTERS = ["r{}".format(i) for i in range(8)] + [
+    "pc",
+    "xpsr",
+    "primask",
+]
+# Thumb state bit in the xPSR register
+XPSR_THUMB = 1 << 24
+# Conservative speed of the routine, to calculate how long to wait for it
+CRC32_BYTES_PER_SECOND = 32 * 1024
+CRC32_MIN_TIMEOUT = 1.0
+
+
+def _plan_transfers(address, count):
+    """Split a memory read into 8-bit and 32-bit wide transfers.
+
+    The word aligned body of the area can be read with 32-bit transfers, which
+    need a quarter of the CMSIS-DAP transactions, leaving only the unaligned
+    head and tail bytes to be read one byte at a time.
+
+    :param address: Integer indicating the start address to read.
+    :param count: Integer, how many bytes to read.
+    :return: A list of tuples with the address, byte count and transfer width
+        in bits (8 or 32), in address order and covering the full area.
+    """
+    body_start = (address + 3) & ~3
+    body_end = (address + count) & ~3
+    if body_end <= body_start:
+        return [(address, count, 8)] if count > 0 else []
+
+    transfers = []
+    if body_start > address:
+        transfers.append((address, body_start - address, 8))
+    transfers.append((body_start, body_end - body_start, 32))
+    if address + count > body_end:
+        transfers.append((body_end, address + count - body_end, 8))
+    return transfers
+
+
+class StageTimings(dict):
+    """Dictionary with the seconds taken by each stage.
+
+    It also keeps the name of the stage running in the current attribute, so
+    it can be reported by a different thread.
+    """
+
+    current = None
+
+
+@contextmanager
+def _timed(timings, stage):
+    """Add the seconds taken by the code in the context to a stage.
+
+    :param timings: Dictionary with the seconds of each stage, or None to not
+        record anything. With a StageTimings instance the stage is also set
+        as the current one while the context runs.
+    :param stage: String with the stage name.
+    """
+    previous_stage = getattr(timings, "current", None)
+    if isinstance(timings, StageTimings):
+        timings.current = stage
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0) + time.monotonic() - start
+        if isinstance(timings, StageTimings):
+            timings.current = previous_stage
+
 
 class MicrobitMcu(object):
     """Read data from main microcontroller on the micro:bit board."""
@@ -105,6 +235,21 @@ class MicrobitMcu(object):
             self.session.close()
         self.session = None
 
+    def connect(self):
+        """Open the connection to the micro:bit and keep it open.
+
+        The same connection is used by all the following operations until
+        close() is called, instead of connecting to the board each time.
+
+        :return: This MicrobitMcu instance.
+        """
+        self._connect()
+        return self
+
+    def close(self):
+        """Close the connection to the micro:bit, if it is open."""
+        self._disconnect()
+
     def __enter__(self):
         """."""
         return self
@@ -113,6 +258,14 @@ class MicrobitMcu(object):
         """."""
         self._disconnect()
 
+    def memory_regions(self):
+        """Get the memory regions of the connected micro:bit.
+
+        :return: The MemoryRegions instance for the board version.
+        """
+        self._connect()
+        return self.mem
+
     def _read_memory(self, address=None, count=None):
         """Read any continuous memory area from the micro:bit.
 
@@ -124,104 +277,211 @@ class MicrobitMcu(object):
 
         :param address: Integer indicating the start address to read.
         :param count: Integer, how many bytes to read.
-        :return: A list of integers, each representing a byte of data.
+        :return: A bytes instance with the data read.
         """
         self._connect()
-        return self.target.read_memory_block8(address, count)
-
-    def read_flash(self, address=None, count=None):
-        """Read data from flash and returns it as a list of bytes.
-
-        :param address: Integer indicating the start address to read.
-        :param count: Integer indicating how many bytes to read.
-        :return: The start address from the read and a list of integers,
-            each representing a byte of data.
+        data = []
+        for t_address, t_count, t_width in _plan_transfers(address, count):
+            if t_width == 32:
+                words = self.target.read_memory_block32(
+                    t_address, t_count // 4
+                )
+                data.append(struct.pack("<{}I".format(len(words)), *words))
+            else:
+                data.append(
+                    bytes(self.target.read_memory_block8(t_address, t_count))
+                )
+        return b"".join(data)
+
+    def _check_region(self, name, address, count, region_start, region_size):
+        """Fill default arguments and check a read is within a memory region.
+
+        :param name: Short description of the region for the error message.
+        :param address: Integer with the start address, None for the region
+            start.
+        :param count: Integer with the number of bytes, None to read until the
+            end of the region.
+        :param region_start: Integer with the region start address.
+        :param region_size: Integer with the region size in bytes.
+        :return: The start address and count to read.
         """
-        self._connect()
-
         if address is None:
-            address = self.mem.flash_start
+            address = region_start
         if count is None:
-            count = self.mem.flash_size
-        flash_end = self.mem.flash_start + self.mem.flash_size
+            count = region_start + region_size - address
+        region_end = region_start + region_size
 
         end = address + count
-        if (
-            not (self.mem.flash_start <= address < flash_end)
-            or end > flash_end
-        ):
+        if not (region_start <= address < region_end) or end > region_end:
             raise ValueError(
-                "Cannot read a flash address out of boundaries.\n"
+                "Cannot read a {} out of boundaries.\n"
                 "Reading from {} to {},\nlimits are from {} to {}".format(
-                    address, end, self.mem.flash_start, flash_end,
+                    name, address, end, region_start, region_end,
                 )
             )
+        return address, count
 
+    def _flash_region(self, address, count):
+        """Validate the arguments to read an area of flash."""
+        self._connect()
+        return self._check_region(
+            "flash address",
+            address,
+            count,
+            self.mem.flash_start,
+            self.mem.flash_size,
+        )
+
+    def _ram_region(self, address, count):
+        """Validate the arguments to read an area of RAM."""
+        self._connect()
+        return self._check_region(
+            "RAM location",
+            address,
+            count,
+            self.mem.ram_start,
+            self.mem.ram_size,
+        )
+
+    def _uicr_region(self, address, count):
+        """Validate the arguments to read an area of UICR."""
+        self._connect()
+        return self._check_region(
+            "UICR location",
+            address,
+            count,
+            self.mem.uicr_start,
+            self.mem.uicr_size,
+        )
+
+    def _iter_memory(
+        self, address, count, chunk_size=READ_CHUNK_SIZE, progress=None
+    ):
+        """Read a continuous memory area in chunks, yielding each one.
+
+        All chunks, except maybe the first and the last, start at an address
+        aligned to the chunk size. As with _read_memory() there is no input
+        sanitation in this function.
+
+        :param address: Integer indicating the start address to read.
+        :param count: Integer, how many bytes to read.
+        :param chunk_size: Integer, maximum number of bytes in each chunk.
+        :param progress: Optional callable invoked after each chunk transfer
+            with the number of bytes read so far and the total to read. If it
+            returns True the read is cancelled after yielding that chunk.
+        :return: Generator of tuples with the chunk start address and the
+            chunk data.
+        """
+        if chunk_size <= 0:
+            raise ValueError("The chunk size must be a positive integer.")
+        self._connect()
+        end = address + count
+        chunk_start = address
+        while chunk_start < end:
+            chunk_end = min((chunk_start // chunk_size + 1) * chunk_size, end)
+            data = self._read_memory(
+                address=chunk_start, count=chunk_end - chunk_start
+            )
+            cancel = progress and progress(chunk_end - address, count)
+            yield chunk_start, data
+            if cancel:
+                return
+            chunk_start = chunk_end
+
+    def read_flash(self, address=None, count=None):
+        """Read data from flash and returns it as bytes.
+
+        :param address: Integer indicating the start address to read.
+        :param count: Integer indicating how many bytes to read.
+        :return: The start address from the read and a bytes instance with
+            the data.
+        """
+        address, count = self._flash_region(address, count)
         return address, self._read_memory(address=address, count=count)
 
+    def read_flash_bytes(self, addresses):
+        """Read single bytes from several flash addresses.
+
+        The reads are queued and sent to the debugger together, which takes
+        far less USB transfers than reading each byte on its own or reading
+        the whole area containing them.
+
+        :param addresses: Iterable of integers with the addresses to read.
+        :return: A bytes instance with a byte per address.
+        """
+        reads = []
+        for address in addresses:
+            self._flash_region(address, 1)
+            reads.append(
+                self.target.read_memory(address, transfer_size=8, now=False)
+            )
+        return bytes(read() for read in reads)
+
+    def iter_flash(self, address=None, count=None, **kwargs):
+        """Read data from flash in chunks, yielding them as they are read.
+
+        :param address: Integer indicating the start address to read.
+        :param count: Integer indicating how many bytes to read.
+        :param kwargs: The chunk_size and progress arguments for
+            _iter_memory().
+        :return: Generator of tuples with the chunk start address and data.
+        """
+        address, count = self._flash_region(address, count)
+        return self._iter_memory(address, count, **kwargs)
+
     def read_ram(self, address=None, count=None):
         """Read the contents of the micro:bit RAM memory.
 
         :param address: Integer indicating the start address to read.
         :param count: Integer indicating how many bytes to read.
-        :return: The start address from the read and a list of integers,
-            each representing a byte of data.
+        :return: The start address from the read and a bytes instance with
+            the data.
         """
-        self._connect()
-
-        if address is None:
-            address = self.mem.ram_start
-        if count is None:
-            count = self.mem.ram_size
-        ram_end = self.mem.ram_start + self.mem.ram_size
-
-        last_byte = address + count
-        if (
-            not (self.mem.ram_start <= address < ram_end)
-            or last_byte > ram_end
-        ):
-            raise ValueError(
-                "Cannot read a RAM location out of boundaries.\n"
-                "Reading from {} to {},\nlimits from {} to {}".format(
-                    address, last_byte, self.mem.ram_start, ram_end
-                )
-            )
+        address, count = self._ram_region(address, count)
         return address, self._read_memory(address=address, count=count)
 
-    def read_uicr(self, address=None, count=None):
-        """Read data from UICR and returns it as a list of bytes.
+    def iter_ram(self, address=None, count=None, **kwargs):
+        """Read the micro:bit RAM in chunks, yielding them as they are read.
 
         :param address: Integer indicating the start address to read.
         :param count: Integer indicating how many bytes to read.
-        :return: The start address from the read and a list of integers,
-            each representing a byte of data.
+        :param kwargs: The chunk_size and progress arguments for
+            _iter_memory().
+        :return: Generator of tuples with the chunk start address and data.
         """
-        self._connect()
-
-        if address is None:
-            address = self.mem.uicr_start
-        if count is None:
-            count = self.mem.uicr_size
-        uicr_end = self.mem.uicr_start + self.mem.uicr_size
+        address, count = self._ram_region(address, count)
+        return self._iter_memory(address, count, **kwargs)
 
-        end = address + count
-        if not (self.mem.uicr_start <= address < uicr_end) or end > uicr_end:
-            raise ValueError(
-                "Cannot read a UICR location out of boundaries.\n"
-                "Reading from {} to {},\nlimits are from {} to {}".format(
-                    address, end, self.mem.uicr_start, uicr_end,
-                )
-            )
+    def read_uicr(self, address=None, count=None):
+        """Read data from UICR and returns it as bytes.
 
+        :param address: Integer indicating the start address to read.
+        :param count: Integer indicating how many bytes to read.
+        :return: The start address from the read and a bytes instance with
+            the data.
+        """
+        address, count = self._uicr_region(address, count)
         return address, self._read_memory(address=address, count=count)
 
+    def iter_uicr(self, address=None, count=None, **kwargs):
+        """Read data from UICR in chunks, yielding them as they are read.
+
+        :param address: Integer indicating the start address to read.
+        :param count: Integer indicating how many bytes to read.
+        :param kwargs: The chunk_size and progress arguments for
+            _iter_memory().
+        :return: Generator of tuples with the chunk start address and data.
+        """
+        address, count = self._uicr_region(address, count)
+        return self._iter_memory(address, count, **kwargs)
+
     def read_uicr_customer(self):
-        """Read all the UICR customer data and return it as a list of bytes.
+        """Read all the UICR customer data and return it as bytes.
 
         :param address: Integer indicating the start address to read.
         :param count: Integer indicating how many bytes to read.
-        :return: The start address from the read and a list of integers,
-            each representing a byte of data.
+        :return: The start address from the read and a bytes instance with
+            the data.
         """
         self._connect()
 
@@ -230,17 +490,302 @@ class MicrobitMcu(object):
             count=self.mem.uicr_customer_size,
         )
 
-    def flash_hex(self, hex_path):
-        """Flash the micro:bit with the provided hex file and reset it.
+    def find_used_flash_end(self, address=None, count=None):
+        """Find where the data ends in a flash area.
+
+        Reads the area backwards one page at a time until it finds a page that
+        is not fully erased (all bytes 0xFF), so only the erased tail of the
+        area and the last used page are read.
 
-        :param hex_path: Path to the hex file to flash.
+        :param address: Integer indicating the start address of the area.
+        :param count: Integer indicating the size of the area in bytes.
+        :return: Integer with the address after the last non-erased page, or
+            the area start address if it is fully erased.
         """
-        self._connect()
+        address, count = self._flash_region(address, count)
+        page_size = self.mem.flash_page_size
+        end = address + count
+        while end > address:
+            page_start = max(((end - 1) // page_size) * page_size, address)
+            data = self._read_memory(
+                address=page_start, count=end - page_start
+            )
+            if data.count(b"\xff") != len(data):
+                return end
+            end = page_start
+        return end
+
+    def find_micropython_end(self):
+        """Find where the MicroPython runtime ends in flash.
+
+        Uses the flash layout MicroPython V1 writes into the UICR and, if it
+        is not present or valid, scans the runtime flash area for the last
+        page with data.
+
+        :return: Integer with the address after the last runtime page.
+        """
+        _, layout = self.read_uicr(
+            address=UICR_UPY_LAYOUT_ADDR,
+            count=struct.calcsize(UICR_UPY_LAYOUT_FORMAT),
+        )
+        magic, _, page_size_log2, start_page, pages_used = struct.unpack(
+            UICR_UPY_LAYOUT_FORMAT, layout
+        )
+        if magic == UICR_UPY_MAGIC and page_size_log2 < 32:
+            end = (start_page + pages_used) << page_size_log2
+            if MICROPYTHON_START < end <= MICROPYTHON_END:
+                return end
+        return self.find_used_flash_end(
+            address=MICROPYTHON_START,
+            count=MICROPYTHON_END - MICROPYTHON_START,
+        )
 
-        self.target.mass_erase()
-        FileProgrammer(self.session).program(hex_path)
+    def flash_sector_crc32(self, address=None, count=None, sector_size=None):
+        """Calculate the CRC32 of each flash sector in the micro:bit itself.
+
+        A small routine is copied to the start of RAM and run by the target,
+        so only one word per sector has to be transferred instead of the full
+        sector contents. The RAM contents and core registers used are saved
+        before and restored afterwards, and the core is left halted.
+
+        :param address: Integer indicating the start address of the area,
+            aligned to the sector size.
+        :param count: Integer indicating the size of the area in bytes, a
+            multiple of the sector size.
+        :param sector_size: Integer with the number of bytes per sector,
+            defaults to the flash page size.
+        :return: A list with the CRC32 integer of each sector, in address
+            order, as calculated by zlib.crc32().
+        """
+        address, count = self._flash_region(address, count)
+        if sector_size is None:
+            sector_size = self.mem.flash_page_size
+        if sector_size <= 0 or address % sector_size or count % sector_size:
+            raise ValueError(
+                "The flash area must be aligned to the sector size.\n"
+                "Area from {} to {}, sector size {}".format(
+                    address, address + count, sector_size
+                )
+            )
+        sectors = count // sector_size
+        if not sectors:
+            return []
+        code_address = self.mem.ram_start
+        output_address = code_address + len(CRC32_ROUTINE)
+        work_size = len(CRC32_ROUTINE) + sectors * 4
+        if work_size > self.mem.ram_size:
+            raise ValueError("Too many sectors to calculate at once.")
+
+        self.target.halt()
+        saved_ram = self._read_memory(address=code_address, count=work_size)
+        saved_registers = self.target.read_core_registers_raw(
+            CRC32_ROUTINE_REGISTERS
+        )
+        try:
+            self.target.write_memory_block8(code_address, CRC32_ROUTINE)
+            xpsr = saved_registers[CRC32_ROUTINE_REGISTERS.index("xpsr")]
+            self.target.write_core_registers_raw(
+                CRC32_ROUTINE_REGISTERS,
+                [address, sector_size, sectors, output_address, 0, 0, 0, 0]
+                + [code_address, xpsr | XPSR_THUMB, 1],
+            )
+            self.target.resume()
+            timeout = max(count / CRC32_BYTES_PER_SECOND, CRC32_MIN_TIMEOUT)
+            deadline = time.monotonic() + timeout
+            while not self.target.is_halted():
+                if time.monotonic() > deadline:
+                    self.target.halt()
+                    raise Exception("Timeout calculating the flash CRCs.")
+                time.sleep(0.01)
+            pc = self.target.read_core_register("pc")
+            if pc != code_address + CRC32_ROUTINE_BKPT_OFFSET:
+                raise Exception(
+                    "The flash CRC routine stopped at an unexpected address "
+                    "{:#x}.".format(pc)
+                )
+            return self.target.read_memory_block32(output_address, sectors)
+        finally:
+            self.target.write_memory_block8(code_address, saved_ram)
+            self.target.write_core_registers_raw(
+                CRC32_ROUTINE_REGISTERS, saved_registers
+            )
+
+    def changed_flash_sectors(self, image, address=None, count=None):
+        """Find the flash sectors that differ from a memory image.
+
+        The CRC32 of each sector, as calculated by the micro:bit, is compared
+        with the image, where the addresses without data are expected to be
+        erased. The area is extended to cover whole sectors.
+
+        :param image: compare.SparseImage with the expected contents.
+        :param address: Integer indicating the start address of the area.
+        :param count: Integer indicating the size of the area in bytes.
+        :return: A list with the start address of each differing sector.
+        """
+        address, count = self._flash_region(address, count)
+        page_size = self.mem.flash_page_size
+        start = address - address % page_size
+        end = -(-(address + count) // page_size) * page_size
+        flash_crcs = self.flash_sector_crc32(address=start, count=end - start)
+        image_crcs = image.sector_crc32(start, end - start, page_size)
+        return [
+            start + i * page_size
+            for i, (flash_crc, image_crc) in enumerate(
+                zip(flash_crcs, image_crcs)
+            )
+            if flash_crc != image_crc
+        ]
+
+    def program_flash_sectors(self, image, sectors, timings=None):
+        """Erase and program flash sectors with the contents of an image.
+
+        The sectors without data in the image are only erased.
+
+        :param image: compare.SparseImage with the new contents.
+        :param sectors: Iterable with the start address of each sector.
+        :param timings: Optional dictionary, the seconds taken to "erase" and
+            "program" are added to it.
+        """
+        self._connect()
+        page_size = self.mem.flash_page_size
+        erase_sectors = []
+        loader = FlashLoader(
+            self.session, chip_erase="sector", smart_flash=False, no_reset=True
+        )
+        program = False
+        for sector in sectors:
+            data = image.read(sector, page_size)
+            if data.count(b"\xff") == len(data):
+                erase_sectors.append(sector)
+            else:
+                loader.add_data(sector, data)
+                program = True
+        if erase_sectors:
+            with _timed(timings, "erase"):
+                eraser = FlashEraser(self.session, FlashEraser.Mode.SECTOR)
+                eraser.erase(erase_sectors)
+        if program:
+            with _timed(timings, "program"):
+                loader.commit()
+
+    def _changed_sectors(self, image, timings=None):
+        """Find the flash sectors that differ from an image.
+
+        The UICR can only be erased with the full chip, so the sectors are
+        not compared if the image contains UICR data that differs from the
+        micro:bit.
+
+        :param image: compare.SparseImage with the new memory contents.
+        :param timings: Optional dictionary, the seconds taken to "compare"
+            are added to it.
+        :return: A list with the start address of each sector that differs,
+            or None if the UICR contents differ.
+        """
+        mem = self.mem
+        uicr_bytes = image.count_inside(mem.uicr_start, mem.uicr_size)
+        flash_bytes = image.count_inside(mem.flash_start, mem.flash_size)
+        if uicr_bytes + flash_bytes != len(image):
+            raise ValueError(
+                "The hex file contains data outside of the flash and UICR."
+            )
+        with _timed(timings, "compare"):
+            if uicr_bytes:
+                _, uicr = self.read_uicr()
+                if image.read(mem.uicr_start, mem.uicr_size) != uicr:
+                    return None
+            return self.changed_flash_sectors(image)
+
+    def reset(self):
+        """Reset the micro:bit microcontroller."""
+        self._connect()
         self.target.reset()
 
+    def flash_hex_sections(
+        self, sections, incremental=False, timings=None, skip_matching=False
+    ):
+        """Flash the micro:bit with a parsed hex file and reset it.
+
+        :param sections: Dictionary with the data areas of each board ID,
+            from formats.parse_universal_hex().
+        :param incremental: Boolean, only erase and program the flash sectors
+            that differ from the hex file, instead of erasing the full chip.
+            The full chip is still erased if the UICR data is different.
+        :param timings: Optional dictionary, the seconds taken by each stage
+            are added to it, with the "connect", "compare", "erase",
+            "program" and "reset" keys.
+        :param skip_matching: Boolean, compare the CRC32 of the flash sectors
+            first and leave the micro:bit untouched if they all match.
+        :return: Boolean, False if the micro:bit was skipped.
+        """
+        with _timed(timings, "connect"):
+            self._connect()
+        image = hex_image(sections, self.board_id)
+
+        changed_sectors = None
+        if incremental or skip_matching:
+            changed_sectors = self._changed_sectors(image, timings)
+            if skip_matching and changed_sectors == []:
+                return False
+        if incremental and changed_sectors is not None:
+            self.program_flash_sectors(image, changed_sectors, timings)
+        else:
+            with _timed(timings, "erase"):
+                self.target.mass_erase()
+            with _timed(timings, "program"):
+                loader = FlashLoader(self.session)
+                for data, offset in image.areas:
+                    loader.add_data(offset, data)
+                loader.commit()
+        with _timed(timings, "reset"):
+            self.target.reset()
+        return True
+
+    def flash_hex(self, hex_path, incremental=False):
+        """Flash the micro:bit with the provided hex file and reset it.
+
+        :param hex_path: Path to the Intel Hex or Universal Hex file to flash.
+        :param incremental: Boolean, only erase and program the flash sectors
+            that differ from the hex file, instead of erasing the full chip.
+            The full chip is still erased if the UICR data is different.
+        """
+        with open(hex_path, encoding="utf-8") as f:
+            sections = formats.parse_universal_hex(f)
+        self.flash_hex_sections(sections, incremental=incremental)
+
+
+def hex_image(sections, board_id):
+    """Get the memory image for a micro:bit from a parsed hex file.
+
+    A Universal Hex section is used for all the boards with the same memory
+    layout as its board ID, so the micro:bit V2 boards use the "9903"
+    section.
+
+    :param sections: Dictionary with the data areas of each board ID, from
+        formats.parse_universal_hex().
+    :param board_id: String with the board ID of the micro:bit.
+    :return: A compare.SparseImage with the contents to flash.
+    """
+    areas = list(sections.get(None, []))
+    board_ids = [b for b in sections if b is not None]
+    if board_ids:
+        if board_id in sections:
+            section_id = board_id
+        else:
+            mem = MICROBIT_MEM_REGIONS.get(board_id)
+            matches = [
+                b
+                for b in board_ids
+                if mem is not None and MICROBIT_MEM_REGIONS.get(b) is mem
+            ]
+            if not matches:
+                raise ValueError(
+                    "The Universal Hex file does not contain data for the "
+                    "micro:bit board ID {}.".format(board_id)
+                )
+            section_id = matches[0]
+        areas += sections[section_id]
+    return compare.SparseImage(areas)
+
 
 def find_microbit_ids():
     """Find all connected micro:bit boards and return their USB unique IDs.
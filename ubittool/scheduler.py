@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Decide when each micro:bit of a batch is flashed.
+
+The number of boards flashed at the same time is limited in total and,
+optionally, per USB hub, as the boards connected to the same hub share its
+bandwidth. The boards that fail are retried after a delay that doubles with
+each attempt, up to a maximum number of attempts, so a saturated hub is not
+flooded with retries.
+"""
+import time
+
+# Seconds before the first retry, doubled for each following retry
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+MAX_ATTEMPTS = 5
+
+# Board states, the final ones are "ok", "skipped" and "gave up"
+STATE_PENDING = "pending"
+STATE_ACTIVE = "flashing"
+STATE_OK = "ok"
+STATE_SKIPPED = "skipped"
+STATE_RETRY = "retry"
+STATE_GAVE_UP = "gave up"
+
+# Error of the retries due when the board is not connected
+NOT_CONNECTED_ERROR = "Board not connected"
+
+
+class BoardState(object):
+    """Scheduling state of a micro:bit in the batch."""
+
+    def __init__(self, board_id, hub, ready_at):
+        """Declare all instance variables.
+
+        :param board_id: String with the USB ID of the micro:bit.
+        :param hub: String identifying the USB hub, or None if unknown.
+        :param ready_at: time.monotonic() value when it can be flashed.
+        """
+        self.board_id = board_id
+        self.hub = hub
+        self.ready_at = ready_at
+        self.state = STATE_PENDING
+        self.attempts = 0
+        self.error = None
+        # Seconds waited before the last retry
+        self.backoff = 0.0
+
+
+class BatchScheduler(object):
+    """Select the boards to flash, limiting the concurrency and the retries."""
+
+    def __init__(
+        self,
+        max_active,
+        max_per_hub=None,
+        max_attempts=MAX_ATTEMPTS,
+        retry_delay=RETRY_DELAY,
+        max_retry_delay=MAX_RETRY_DELAY,
+        hub_of=None,
+    ):
+        """Declare all instance variables.
+
+        :param max_active: Integer, maximum number of boards flashed at the
+            same time.
+        :param max_per_hub: Optional integer, maximum number of boards
+            flashed at the same time in each USB hub. The boards with an
+            unknown hub are not limited.
+        :param max_attempts: Integer, number of times a board is flashed
+            before giving up.
+        :param retry_delay: Seconds before the first retry of a board.
+        :param max_retry_delay: Maximum seconds before a retry.
+        :param hub_of: Optional callable returning the USB hub of a board ID,
+            or None if it is unknown.
+        """
+        self.max_active = max_active
+        self.max_per_hub = max_per_hub
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.hub_of = hub_of or (lambda board_id: None)
+        # Board ID to BoardState, in the order they were found
+        self.boards = {}
+
+    def add(self, board_id, now=None):
+        """Add a connected board, boards already added are ignored.
+
+        :param board_id: String with the USB ID of the micro:bit.
+        :param now: Optional time.monotonic() value for the current time.
+        :return: Boolean, True if the board was not added before.
+        """
+        if board_id in self.boards:
+            return False
+        now = time.monotonic() if now is None else now
+        self.boards[board_id] = BoardState(
+            board_id, self.hub_of(board_id), now
+        )
+        return True
+
+    def _count_active(self):
+        """Count the boards being flashed, in total and per hub.
+
+        :return: Tuple with the total and a dictionary with each hub count.
+        """
+        per_hub = {}
+        total = 0
+        for board in self.boards.values():
+            if board.state == STATE_ACTIVE:
+                total += 1
+                per_hub[board.hub] = per_hub.get(board.hub, 0) + 1
+        return total, per_hub
+
+    def _hub_free(self, board, per_hub):
+        """Check if the USB hub of a board can flash one more board.
+
+        :param board: BoardState of the board.
+        :param per_hub: Dictionary with the boards being flashed in each hub.
+        :return: Boolean, True if the board hub is not at its limit.
+        """
+        return (
+            self.max_per_hub is None
+            or board.hub is None
+            or per_hub.get(board.hub, 0) < self.max_per_hub
+        )
+
+    def start_ready(self, connected_ids, now=None):
+        """Select the connected boards to flash now, and mark them active.
+
+        :param connected_ids: Iterable with the USB IDs of the boards
+            currently connected.
+        :param now: Optional time.monotonic() value for the current time.
+        :return: A list of (board ID, seconds waited since it was ready)
+            tuples, in the order the boards were found.
+        """
+        now = time.monotonic() if now is None else now
+        connected_ids = set(connected_ids)
+        active, per_hub = self._count_active()
+        started = []
+        for board in self.boards.values():
+            if active >= self.max_active:
+                break
+            if (
+                board.state not in (STATE_PENDING, STATE_RETRY)
+                or board.ready_at > now
+                or board.board_id not in connected_ids
+            ):
+                continue
+            if not self._hub_free(board, per_hub):
+                continue
+            board.state = STATE_ACTIVE
+            board.attempts += 1
+            active += 1
+            per_hub[board.hub] = per_hub.get(board.hub, 0) + 1
+            started.append((board.board_id, now - board.ready_at))
+        return started
+
+    def attempt_disconnected(self, connected_ids, now=None):
+        """Select the boards with a retry due that are not connected.
+
+        The retry is counted as an attempt, so the caller must report it as
+        failed with finish(), and a board unplugged after failing gives up
+        after the maximum number of attempts.
+
+        :param connected_ids: Iterable with the USB IDs of the boards
+            currently connected.
+        :param now: Optional time.monotonic() value for the current time.
+        :return: A list with the USB IDs of the boards.
+        """
+        now = time.monotonic() if now is None else now
+        connected_ids = set(connected_ids)
+        attempted = []
+        for board in self.boards.values():
+            if (
+                board.state == STATE_RETRY
+                and board.ready_at <= now
+                and board.board_id not in connected_ids
+            ):
+                board.state = STATE_ACTIVE
+                board.attempts += 1
+                attempted.append(board.board_id)
+        return attempted
+
+    def finish(self, board_id, error=None, now=None, skipped=False):
+        """Record the result of flashing a board.
+
+        A failed board is retried after a delay, doubled for each attempt,
+        unless it has been flashed the maximum number of times.
+
+        :param board_id: String with the USB ID of the micro:bit.
+        :param error: Optional string with the error message if it failed.
+        :param now: Optional time.monotonic() value for the current time.
+        :param skipped: Boolean, True if the board already contained the hex
+            file and it was not flashed.
+        :return: The BoardState of the board.
+        """
+        now = time.monotonic() if now is None else now
+        board = self.boards[board_id]
+        board.error = error
+        if error is None:
+            board.state = STATE_SKIPPED if skipped else STATE_OK
+        elif board.attempts >= self.max_attempts:
+            board.state = STATE_GAVE_UP
+        else:
+            board.state = STATE_RETRY
+            board.backoff = min(
+                self.retry_delay * 2 ** (board.attempts - 1),
+                self.max_retry_delay,
+            )
+            board.ready_at = now + board.backoff
+        return board
+
+    def next_retry(self, connected_ids, now=None):
+        """Get the seconds until the next retry that can be started is due.
+
+        Only the retries of connected boards with a free slot, in total and
+        in their hub, are considered, as start_ready() cannot start the rest
+        until a board finishes.
+
+        :param connected_ids: Iterable with the USB IDs of the boards
+            currently connected.
+        :param now: Optional time.monotonic() value for the current time.
+        :return: Float with the seconds, or None if there are no retries
+            that can be started.
+        """
+        now = time.monotonic() if now is None else now
+        connected_ids = set(connected_ids)
+        active, per_hub = self._count_active()
+        if active >= self.max_active:
+            return None
+        retries = [
+            board.ready_at
+            for board in self.boards.values()
+            if board.state == STATE_RETRY
+            and board.board_id in connected_ids
+            and self._hub_free(board, per_hub)
+        ]
+        return max(min(retries) - now, 0) if retries else None
+
+    def outcome_table(self):
+        """Create a text table with the outcome of each board.
+
+        :return: String with a header line and one line per board.
+        """
+        lines = [
+            "{:<48}  {:<10}  {:>8}  {}".format(
+                "Board", "Hub", "Attempts", "Result"
+            )
+        ]
+        for board in self.boards.values():
+            result = board.state
+            if board.error is not None and board.state != STATE_OK:
+                result = "{} ({})".format(board.state, board.error)
+            lines.append(
+                "{:<48}  {:<10}  {:>8}  {}".format(
+                    board.board_id, board.hub or "-", board.attempts, result
+                )
+            )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Detect the batch flash workers stuck with a micro:bit.
+
+A board can stop responding in the middle of a pyOCD transfer, and the
+worker flashing it would wait forever. Each board sent to the workers gets a
+heartbeat slot in shared memory, where the worker flashing it writes the
+stage it is running every HEARTBEAT_INTERVAL seconds. The main process uses
+them to find the boards taking longer than the timeout of their stage, or
+the workers that stopped writing heartbeats, so the worker can be terminated
+and the board retried.
+
+The slots are written without locks, and each one only by a single worker,
+so a worker terminated while writing its heartbeat cannot block the rest.
+The main process writes the task ID of a board in its slot when the board
+is sent, and clears it once the board has a result, so a worker picking up
+a task that is no longer watched can find out and leave the board alone.
+A board waiting in the pool for a free worker has not sent any heartbeat
+yet, and does not time out until its first one.
+"""
+import time
+from collections import namedtuple
+
+from ubittool.metrics import STAGES
+
+# Seconds between the heartbeats sent by a worker while it flashes a board
+HEARTBEAT_INTERVAL = 1.0
+# Seconds without a heartbeat before a worker is considered stuck
+HEARTBEAT_TIMEOUT = 10.0
+# Maximum seconds each flashing stage can take
+STAGE_TIMEOUTS = {
+    "connect": 30.0,
+    "compare": 30.0,
+    "erase": 30.0,
+    "program": 120.0,
+    "reset": 10.0,
+}
+
+# Integer fields of each heartbeat slot, the task ID is 0 when the slot is
+# not being used by a worker
+SLOT_TASK_ID, SLOT_PID, SLOT_BEATS, SLOT_STAGE = range(4)
+SLOT_FIELDS = 4
+
+# Heartbeat read from a slot: the ID of the task writing it, the worker
+# process ID, the number of heartbeats written, the stage running (or None
+# between stages) and the seconds of each stage so far
+Heartbeat = namedtuple(
+    "Heartbeat", ["task_id", "pid", "beats", "stage", "timings"]
+)
+# Board that timed out, with the worker process ID to terminate, the seconds
+# of each stage, the error, and the heartbeat slot and task ID of the board
+Expired = namedtuple(
+    "Expired", ["board_id", "pid", "timings", "error", "slot", "task_id"]
+)
+
+
+class HeartbeatSlots(object):
+    """Shared memory with a heartbeat slot for each board being flashed."""
+
+    def __init__(self, context, size):
+        """Allocate the shared memory.
+
+        :param context: multiprocessing context used to start the workers.
+        :param size: Number of slots, the maximum boards flashed at the same
+            time.
+        """
+        self.size = size
+        self.fields = context.RawArray("q", size * SLOT_FIELDS)
+        self.timings = context.RawArray("d", size * len(STAGES))
+
+    def write(self, slot, task_id, pid, stage, timings):
+        """Write a heartbeat, from the worker flashing the board of a slot.
+
+        The beats counter is written last, so the main process only reads a
+        new heartbeat once the rest of it has been written.
+
+        :param slot: Integer with the slot index.
+        :param task_id: Integer with the task ID assigned to the slot.
+        :param pid: Integer with the worker process ID.
+        :param stage: String with the stage running, or None.
+        :param timings: Dictionary with the seconds of each finished stage.
+        """
+        base = slot * SLOT_FIELDS
+        self.fields[base + SLOT_TASK_ID] = task_id
+        self.fields[base + SLOT_PID] = pid
+        self.fields[base + SLOT_STAGE] = (
+            STAGES.index(stage) + 1 if stage in STAGES else 0
+        )
+        for i, stage_name in enumerate(STAGES):
+            self.timings[slot * len(STAGES) + i] = timings.get(stage_name, 0)
+        self.fields[base + SLOT_BEATS] += 1
+
+    def assign(self, slot, task_id):
+        """Assign a slot to a task, from the main process sending its board.
+
+        :param slot: Integer with the slot index.
+        :param task_id: Integer with the task ID of the board.
+        """
+        base = slot * SLOT_FIELDS
+        self.fields[base + SLOT_PID] = 0
+        self.fields[base + SLOT_TASK_ID] = task_id
+
+    def clear(self, slot):
+        """Mark a slot as unused, when its board has a result.
+
+        :param slot: Integer with the slot index.
+        """
+        base = slot * SLOT_FIELDS
+        self.fields[base + SLOT_TASK_ID] = 0
+        self.fields[base + SLOT_PID] = 0
+
+    def read(self, slot):
+        """Read the last heartbeat written in a slot.
+
+        :param slot: Integer with the slot index.
+        :return: A Heartbeat tuple.
+        """
+        fields_start = slot * SLOT_FIELDS
+        fields_end = fields_start + SLOT_FIELDS
+        fields = self.fields[fields_start:fields_end]
+        timings_start = slot * len(STAGES)
+        timings_end = timings_start + len(STAGES)
+        stage_timings = self.timings[timings_start:timings_end]
+        return Heartbeat(
+            fields[SLOT_TASK_ID],
+            fields[SLOT_PID],
+            fields[SLOT_BEATS],
+            STAGES[fields[SLOT_STAGE] - 1] if fields[SLOT_STAGE] else None,
+            {s: t for s, t in zip(STAGES, stage_timings) if t},
+        )
+
+
+class _WatchedBoard(object):
+    """Last heartbeat received for a board."""
+
+    def __init__(self, slot, task_id, now):
+        """Declare all instance variables.
+
+        :param slot: Integer with the heartbeat slot index of the board.
+        :param task_id: Integer with the task ID of the board.
+        :param now: time.monotonic() value when the board was sent.
+        """
+        self.slot = slot
+        self.task_id = task_id
+        self.pid = None
+        self.beats = None
+        self.stage = None
+        self.timings = {}
+        self.last_seen = now
+        self.stage_start = now
+
+
+class BatchWatchdog(object):
+    """Track the heartbeats of the boards being flashed by the workers."""
+
+    def __init__(
+        self, slots, stage_timeouts=None, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+    ):
+        """Declare all instance variables.
+
+        :param slots: HeartbeatSlots written by the workers.
+        :param stage_timeouts: Optional dictionary with the timeout of some
+            stages, replacing their value from STAGE_TIMEOUTS.
+        :param heartbeat_timeout: Seconds without a heartbeat before a board
+            times out.
+        """
+        self.slots = slots
+        self.stage_timeouts = dict(STAGE_TIMEOUTS, **(stage_timeouts or {}))
+        self.heartbeat_timeout = heartbeat_timeout
+        # Board ID to _WatchedBoard, for the boards sent to the workers
+        self.boards = {}
+        self._last_task_id = 0
+
+    def start(self, board_id, now=None):
+        """Start watching a board sent to the workers.
+
+        :param board_id: String with the USB ID of the micro:bit.
+        :param now: Optional time.monotonic() value for the current time.
+        :return: Tuple with the heartbeat slot index and the task ID the
+            worker must write in it.
+        """
+        now = time.monotonic() if now is None else now
+        used_slots = {board.slot for board in self.boards.values()}
+        free_slots = [s for s in range(self.slots.size) if s not in used_slots]
+        if not free_slots:
+            raise Exception("There are no free heartbeat slots.")
+        self._last_task_id += 1
+        self.slots.assign(free_slots[0], self._last_task_id)
+        self.boards[board_id] = _WatchedBoard(
+            free_slots[0], self._last_task_id, now
+        )
+        return free_slots[0], self._last_task_id
+
+    def forget(self, board_id):
+        """Stop watching a board, when its result has been recorded.
+
+        The slot of the board is cleared, so a task of the board still
+        waiting for a worker does not flash it.
+
+        :param board_id: String with the USB ID of the micro:bit.
+        """
+        board = self.boards.pop(board_id, None)
+        if board is not None:
+            self.slots.clear(board.slot)
+
+    def receive(self, now=None):
+        """Read the heartbeats written since the last call.
+
+        :param now: Optional time.monotonic() value for the current time.
+        """
+        now = time.monotonic() if now is None else now
+        for board in self.boards.values():
+            heartbeat = self.slots.read(board.slot)
+            if (
+                heartbeat.task_id != board.task_id
+                or not heartbeat.pid
+                or heartbeat.beats == board.beats
+            ):
+                continue
+            if heartbeat.stage != board.stage:
+                board.stage = heartbeat.stage
+                board.stage_start = now
+            board.pid = heartbeat.pid
+            board.beats = heartbeat.beats
+            board.timings = heartbeat.timings
+            board.last_seen = now
+
+    def is_running(self, expired):
+        """Check if the worker of an expired board is still flashing it.
+
+        :param expired: Expired tuple of the board.
+        :return: Boolean, True if the heartbeat slot still belongs to the
+            task of the board and to the same worker.
+        """
+        heartbeat = self.slots.read(expired.slot)
+        return (
+            heartbeat.task_id == expired.task_id
+            and heartbeat.pid == expired.pid
+        )
+
+    def expired(self, now=None):
+        """Find the boards that timed out.
+
+        The boards are still watched until forget() is called, once their
+        worker has been terminated. The boards without any heartbeat are
+        still waiting for a free worker, and never time out.
+
+        :param now: Optional time.monotonic() value for the current time.
+        :return: A list of Expired tuples, the timings include the seconds
+            spent in the stage that timed out.
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        for board_id, board in self.boards.items():
+            if board.pid is None:
+                continue
+            stage_time = now - board.stage_start
+            stage_timeout = self.stage_timeouts.get(board.stage)
+            if stage_timeout is not None and stage_time > stage_timeout:
+                error = "Timed out in the {} stage after {:.0f} s".format(
+                    board.stage, stage_time
+                )
+            elif now - board.last_seen > self.heartbeat_timeout:
+                error = "No heartbeat from the worker for {:.0f} s".format(
+                    now - board.last_seen
+                )
+            else:
+                continue
+            timings = dict(board.timings)
+            if board.stage is not None:
+                timings[board.stage] = timings.get(board.stage, 0) + stage_time
+            expired.append(
+                Expired(
+                    board_id,
+                    board.pid,
+                    timings,
+                    error,
+                    board.slot,
+                    board.task_id,
+                )
+            )
+        return expired